@@ -2,18 +2,139 @@
 # This python file implements the PCFG and can create the pcfg from a training file. #
 ######################################################################################
 
+from collections import Counter, deque
+from itertools import islice
 from nltk.tree import Tree
+import numpy as np
+import hashlib
+import json
+import multiprocessing
+import os
 import re
+import struct
+
+# Header of the compiled grammar file: magic number, format version and length of the json header
+MAGIC = b'PCFG'
+VERSION = 1
+ALIGN = 64
+
+# The arrays stored in the compiled grammar file
+COMPILED_ARRAYS = ['rule_parent', 'rule_left', 'rule_right', 'rule_count', 'rule_logprob',
+                   'lexicon_token', 'lexicon_tag', 'lexicon_count', 'lexicon_prob']
+
+# The number of trees counted by a worker at once when the treebank is read by several processes
+CHUNK_SIZE = 2000
+
+def count_trees(lines, horz_markov=None, vert_markov=0):
+    '''Count the rules and the lexicon of trees, in Chomsky normal form.
+        The trees are walked with an explicit stack, in the same pre-order as a recursive traversal.
+    ------------------------------
+        Input:
+            lines: the trees, one per string
+            horz_markov: the number of siblings kept in the labels of the artificial tags of the binarization, None to keep all of them
+            vert_markov: the number of ancestors added to the labels of the constituents, 0 to add none
+    ------------------------------
+        Return:
+            a Counter of the rules (lhs, rhs), rhs being a tag or a pair of tags, and a Counter of the lexicon (token, tag),
+            both in the order of the first occurrence
+    '''
+    rule_counts = Counter()
+    lexicon_counts = Counter()
+    for line in lines:
+        # the binarization starts under the unlabelled root, so that SENT gets no parent annotation
+        t = Tree.fromstring(line.strip())[0]
+        t.chomsky_normal_form(horzMarkov=horz_markov, vertMarkov=vert_markov)
+        stack = [t]
+        while stack:
+            t = stack.pop()
+            lhs = t.label()
+            if len(t) == 1:
+                if type(t[0]) == str:
+                    lexicon_counts[(str(t[0]), lhs)] += 1
+                else:
+                    rule_counts[(lhs, t[0].label())] += 1
+                    stack.append(t[0])
+            else:
+                assert(len(t) == 2)
+                rule_counts[(lhs, (t[0].label(), t[1].label()))] += 1
+                stack.append(t[1])
+                stack.append(t[0])
+    return rule_counts, lexicon_counts
+
+def count_file(filename, workers=1, chunk_size=CHUNK_SIZE, horz_markov=None, vert_markov=0):
+    '''Count the rules and the lexicon of a treebank file chunk by chunk, in worker processes if workers > 1.
+        The file is streamed: at most 2 * workers chunks are waiting for a worker, so the memory depends on the number of distinct rules, not on the size of the file.
+    ------------------------------
+        Input:
+            filename: the path to the treebank file, one tree per line
+            workers: the number of processes counting the chunks
+            chunk_size: the number of trees of a chunk
+            horz_markov, vert_markov: the markovization orders given to count_trees()
+    ------------------------------
+        Return:
+            a generator of the Counters of the rules and of the lexicon of each chunk, in the order of the file
+    '''
+    with open(filename, 'r') as f:
+        chunks = iter(lambda: list(islice(f, chunk_size)), [])
+        if workers <= 1:
+            for chunk in chunks:
+                yield count_trees(chunk, horz_markov, vert_markov)
+            return
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(count_trees, (chunk, horz_markov, vert_markov)))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+def coarse_label(tag):
+    '''Project a tag onto its base label: 'NP|<DET-NC>' -> 'NP|' and 'NP^<SENT>' -> 'NP'.
+        The artificial tags of the binarization keep the marker '|', so that they are not mixed with the complete constituents.
+    '''
+    base = tag.split('|')[0].split('^')[0]
+    if '|' in tag:
+        return base + '|'
+    return base
+
+def file_hash(filename):
+    '''Compute the sha1 hash of a file
+    ------------------------------
+        Input:
+            filename: the path to the file
+    ------------------------------
+        Return:
+            the hexadecimal digest of the content of the file
+    '''
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
 
 class Grammer(object):
     '''The class Grammer defines the Probabilistic Context-Free Grammar (PCFG), made of.
         --- left-hand-side tags -> right-hand-side tags with its probability, by self.lhs_rhs_prob
         --- tag -> token with the probability of that the token is generating from the tag, by self.token_tag_prob
+       The size of the grammar is controlled when it is created, by the markovization orders of the binarization and by the pruning of the rare rules.
     '''
-    def __init__(self):
+    def __init__(self, horz_markov=None, vert_markov=0, min_count=1, top_n=None):
         '''Init fields of the class.
             They are all empty. Only after self.create_pcfg() is called, they get PCFG from the training set.
+        ------------------------------
+            Input:
+                horz_markov: the number of siblings kept in the labels of the artificial tags of the binarization, None to keep all of them
+                vert_markov: the number of ancestors added to the labels of the constituents (parent annotation), 0 to add none
+                min_count: the rules seen less than min_count times in the training trees are removed
+                top_n: only the top_n most frequent rules of each left-hand-side tag are kept, None to keep all of them
+        ------------------------------
         '''
+        self.horz_markov = horz_markov
+        self.vert_markov = vert_markov
+        self.min_count = min_count
+        self.top_n = top_n
         self.lhs_count = {}
         self.lhs_rhs_count = {}
         self.lhs_rhss_dict = {}
@@ -25,115 +146,437 @@ class Grammer(object):
         self.id2tags = {}
         self.lhs_rhs_prob = {}
         self.token_tag_prob = {}
+        self.train_hash = None
+        self.update_hashes = []
+        self.coarse = None
+
+    def settings(self):
+        '''The build settings of the grammar, stored in the compiled grammar file'''
+        return {'horz_markov': self.horz_markov, 'vert_markov': self.vert_markov, 'min_count': self.min_count, 'top_n': self.top_n}
+
+    def fingerprint(self):
+        '''Identify the training data of the grammar: the hash of the training file, combined with the hashes of the files added by self.update_pcfg()'''
+        if len(self.update_hashes) == 0:
+            return self.train_hash
+        return hashlib.sha1(' '.join([str(self.train_hash)] + self.update_hashes).encode('utf-8')).hexdigest()
+
+    def __compute_probabilities(self, lhss=None, tokens=None):
+        '''Compute the probabilities of the rules and the lexicon from their counts
+        ------------------------------
+            Input:
+                lhss: the left-hand-side tags whose rules are renormalized, None for all of them
+                tokens: the tokens whose lexicon is renormalized, None for all of them
+        ------------------------------
+            Do not return anything, but updates self.lhs_rhs_prob and self.token_tag_prob
+        '''
+        # get lhs to rhs probability
+        if lhss is None:
+            lhss = self.lhs_rhss_dict.keys()
+        for lhs in lhss:
+            for rhs in self.lhs_rhss_dict[lhs]:
+                rule = (lhs, rhs)
+                self.lhs_rhs_prob[rule] = self.lhs_rhs_count[rule] / self.lhs_count[lhs]
+
+        # get token to tag probability
+        if tokens is None:
+            tokens = self.token_tags_dict.keys()
+        for token in tokens:
+            for tag in self.token_tags_dict[token]:
+                lexicon = (token, tag)
+                self.token_tag_prob[lexicon] = self.token_tag_count[lexicon] / self.token_count[token]
 
-    def __clean_tags(self):
-        '''To create two dictionaries: 
-            --- self.tags2id, which maps tag to an unique id
-            --- self.id2tag, the inverse map
+    def __add_tag(self, tag):
+        '''Give the next id to a tag if it has none'''
+        if tag not in self.tags2id:
+            self.tags2id[tag] = len(self.tags)
+            self.id2tags[len(self.tags)] = tag
+            self.tags.append(tag)
+
+    def __add_counts(self, rule_counts, lexicon_counts):
+        '''Add counts of rules and lexicon to the grammar.
+            The new rules of a tag and the new tags of a token are appended after the known ones, and the new tags get the next ids,
+            so that the ids of the known tags and tokens do not change.
+        ------------------------------
+            Input:
+                rule_counts: a dict mapping the rules (lhs, rhs) to their counts
+                lexicon_counts: a dict mapping the lexicon (token, tag) to their counts
+        ------------------------------
+            Do not return anything, but updates the counts and the tag ids
         '''
-        self.tags = list(set(self.tags))
-        for i, tag in enumerate(self.tags):
-            self.tags2id[tag] = i
-            self.id2tags[i] = tag
+        for rule, count in rule_counts.items():
+            lhs, rhs = rule
+            self.__add_tag(lhs)
+            for tag in (rhs if type(rhs) is tuple else (rhs,)):
+                self.__add_tag(tag)
+            if lhs not in self.lhs_count:
+                self.lhs_count[lhs] = 0.
+                self.lhs_rhss_dict[lhs] = []
+            self.lhs_count[lhs] += count
+            if rule not in self.lhs_rhs_count:
+                self.lhs_rhs_count[rule] = 0.
+                self.lhs_rhss_dict[lhs].append(rhs)
+            self.lhs_rhs_count[rule] += count
+
+        for lexicon, count in lexicon_counts.items():
+            token, tag = lexicon
+            self.__add_tag(tag)
+            if token not in self.token_count:
+                self.token_count[token] = 0.
+                self.token_tags_dict[token] = []
+            self.token_count[token] += count
+            if lexicon not in self.token_tag_count:
+                self.token_tag_count[lexicon] = 0.
+                self.token_tags_dict[token].append(tag)
+            self.token_tag_count[lexicon] += count
 
-    def __cross_tree(self, t):
-        '''Traverse the tree produced from a training sentence, in order to store rules.
+    def __prune_rules(self, lhss=None):
+        '''Remove the rules seen less than self.min_count times, then keep the self.top_n most frequent rules of each left-hand-side tag.
+            The kept rules stay in their order, and their probabilities are renormalized by self.__compute_probabilities().
         ------------------------------
             Input:
-                t: nltk Tree object
+                lhss: the left-hand-side tags whose rules are pruned, None for all of them
         ------------------------------
-            Do not return anything, but updates the dictionary of rules
+            Return:
+                the number of removed rules
         '''
-        lhs = t.label()
-        self.tags.append(lhs)
-        if len(t) == 1:
-            if type(t[0]) == str:
-                token = str(t[0])
-                self.__storeLexicon(token, lhs)
+        if self.min_count <= 1 and self.top_n is None:
+            return 0
+        if lhss is None:
+            lhss = list(self.lhs_rhss_dict.keys())
+        removed = 0
+        for lhs in lhss:
+            rhss = [rhs for rhs in self.lhs_rhss_dict[lhs] if self.lhs_rhs_count[(lhs, rhs)] >= self.min_count]
+            if self.top_n is not None and len(rhss) > self.top_n:
+                # the order of the sort is stable, so the ties are kept in their order of first occurrence
+                kept = set(sorted(rhss, key=lambda rhs: -self.lhs_rhs_count[(lhs, rhs)])[:self.top_n])
+                rhss = [rhs for rhs in rhss if rhs in kept]
+            kept = set(rhss)
+            for rhs in self.lhs_rhss_dict[lhs]:
+                if rhs not in kept:
+                    del self.lhs_rhs_count[(lhs, rhs)]
+                    self.lhs_rhs_prob.pop((lhs, rhs), None)
+                    removed += 1
+            if len(rhss) == 0:
+                del self.lhs_rhss_dict[lhs]
+                del self.lhs_count[lhs]
             else:
-                self.tags.append(t[0].label())
-                self.__storeRule(lhs, t[0].label())
-                self.__cross_tree(t[0])
-        else:
-            assert(len(t) == 2)
-            rhs = tuple([t[0].label(), t[1].label()])
-            self.tags.append(rhs[0])
-            self.tags.append(rhs[1])
-            self.__storeRule(lhs, rhs)
-            self.__cross_tree(t[0])
-            self.__cross_tree(t[1])
-            
-
-    def __storeLexicon(self, token, lhs):
-        '''To store a rule tag -> token
-        --------------------------------
+                self.lhs_rhss_dict[lhs] = rhss
+                self.lhs_count[lhs] = sum(self.lhs_rhs_count[(lhs, rhs)] for rhs in rhss)
+        return removed
+
+    def __renumber_tags(self):
+        '''Remove the tags which are neither in a rule nor in the lexicon any more, the other tags keep their order'''
+        used = set(self.lhs_rhss_dict.keys())
+        for rhss in self.lhs_rhss_dict.values():
+            for rhs in rhss:
+                used.update(rhs if type(rhs) is tuple else (rhs,))
+        for tags in self.token_tags_dict.values():
+            used.update(tags)
+        self.tags = [tag for tag in self.tags if tag in used]
+        self.tags2id = {tag: i for i, tag in enumerate(self.tags)}
+        self.id2tags = dict(enumerate(self.tags))
+
+    def create_pcfg(self, filename, workers=1):
+        '''Create the PCFG
+        ------------------------------
             Input:
-                token: the token in this rule
-                lhs: the tag which generates this token
-        --------------------------------
-            Do not return anything, but stores the rule by updating the dictionary
+                filename: the path to the training file
+                workers: the number of processes counting the trees
+        ------------------------------
+            Do not return anything, but stores all rules in the Grammar object
         '''
-        if token in self.token_count.keys():
-            self.token_count[token] += 1.
-            if (token, lhs) in self.token_tag_count.keys():
-                self.token_tag_count[(token, lhs)] += 1.
-            else:
-                self.token_tag_count[(token, lhs)] = 1.
-                self.token_tags_dict[token].append(lhs)
-        else:
-            self.token_count[token] = 1.
-            self.token_tags_dict[token] = [lhs]
-            self.token_tag_count[(token, lhs)] = 1.
-
-    def __storeRule(self, lhs, rhs):
-        '''To store a rule lhs -> rhs
-        -------------------------------
+        self.train_hash = file_hash(filename)
+        for rule_counts, lexicon_counts in count_file(filename, workers, horz_markov=self.horz_markov, vert_markov=self.vert_markov):
+            self.__add_counts(rule_counts, lexicon_counts)
+        if self.__prune_rules() > 0:
+            self.__renumber_tags()
+
+        # get the rule and lexicon probabilities
+        self.__compute_probabilities()
+
+        # get the rule index arrays
+        self.compile()
+
+    def update_pcfg(self, filename, workers=1):
+        '''Add the trees of another treebank file to the PCFG, without counting the training file again.
+            Only the rules of the left-hand-side tags and the lexicon of the tokens seen in the new trees are renormalized.
+            The ids of the known tags and tokens do not change, the new ones are numbered after them.
+            The new trees are binarized with the markovization orders of the grammar. When the grammar is pruned, the rules of the
+            touched tags are pruned again, and the counts of the rules removed before are lost: the result can differ from a full rebuild.
+        ------------------------------
+            Input:
+                filename: the path to the treebank file to add
+                workers: the number of processes counting the trees
+        ------------------------------
+            Return:
+                the list of the new tokens, in the order of their ids
+        '''
+        n_tokens = len(self.token_tags_dict)
+        lhss = set()
+        tokens = set()
+        for rule_counts, lexicon_counts in count_file(filename, workers, horz_markov=self.horz_markov, vert_markov=self.vert_markov):
+            self.__add_counts(rule_counts, lexicon_counts)
+            lhss.update(lhs for lhs, _ in rule_counts)
+            tokens.update(token for token, _ in lexicon_counts)
+        self.__prune_rules(lhss)
+        lhss = [lhs for lhs in lhss if lhs in self.lhs_rhss_dict]
+        self.__compute_probabilities(lhss, tokens)
+        self.update_hashes.append(file_hash(filename))
+        self.compile()
+        return self.id2tokens[n_tokens:]
+
+    def compile(self):
+        '''Compile the rules and the lexicon into integer arrays, used by the vectorized CYK engine and stored by self.save().
+            The rules are enumerated in the iteration order of self.lhs_rhss_dict, so that ties are broken as in PCYK.
+        ------------------------------
+            Do not return anything, but stores
+            --- self.id2tokens, self.tokens2id: the maps between tokens and their unique ids
+            --- self.rule_parent, self.rule_left, self.rule_right, self.rule_count, self.rule_logprob: one entry per rule, rule_right is -1 for unary rules
+            --- self.lexicon_token, self.lexicon_tag, self.lexicon_count, self.lexicon_prob: one entry per (token, tag)
+            --- the index arrays computed by self.__index_rules()
+        '''
+        rules = [(lhs, rhs) for lhs, rhss in self.lhs_rhss_dict.items() for rhs in rhss]
+        self.rule_parent = np.array([self.tags2id[lhs] for lhs, _ in rules], dtype=np.int32)
+        self.rule_left = np.array([self.tags2id[rhs[0] if type(rhs) is tuple else rhs] for _, rhs in rules], dtype=np.int32)
+        self.rule_right = np.array([self.tags2id[rhs[1]] if type(rhs) is tuple else -1 for _, rhs in rules], dtype=np.int32)
+        self.rule_count = np.array([self.lhs_rhs_count[rule] for rule in rules], dtype=np.float64)
+        self.rule_logprob = np.log(np.array([self.lhs_rhs_prob[rule] for rule in rules], dtype=np.float64))
+
+        self.id2tokens = list(self.token_tags_dict.keys())
+        self.tokens2id = {token: i for i, token in enumerate(self.id2tokens)}
+        lexicons = [(token, tag) for token, tags in self.token_tags_dict.items() for tag in tags]
+        self.lexicon_token = np.array([self.tokens2id[token] for token, _ in lexicons], dtype=np.int32)
+        self.lexicon_tag = np.array([self.tags2id[tag] for _, tag in lexicons], dtype=np.int32)
+        self.lexicon_count = np.array([self.token_tag_count[lexicon] for lexicon in lexicons], dtype=np.float64)
+        self.lexicon_prob = np.array([self.token_tag_prob[lexicon] for lexicon in lexicons], dtype=np.float64)
+
+        self.__index_rules()
+
+    def __index_rules(self):
+        '''Split the compiled rules into the index arrays used by the vectorized CYK engine.
+        ------------------------------
+            Do not return anything, but stores
+            --- self.binary_parent, self.binary_left, self.binary_right, self.binary_logprob: one entry per binary rule A -> B C
+            --- self.binary_starts: the index of the first binary rule of each parent (rules of a parent are contiguous)
+            --- self.unary_parent, self.unary_child, self.unary_logprob: one entry per unary rule A -> B
+            --- the unary closure computed by self.__unary_closure()
+        '''
+        binary = self.rule_right >= 0
+        self.binary_parent = np.ascontiguousarray(self.rule_parent[binary])
+        self.binary_left = np.ascontiguousarray(self.rule_left[binary])
+        self.binary_right = np.ascontiguousarray(self.rule_right[binary])
+        self.binary_logprob = np.ascontiguousarray(self.rule_logprob[binary])
+        self.binary_starts = np.flatnonzero(np.r_[True, self.binary_parent[1:] != self.binary_parent[:-1]]).astype(np.int32)
+        self.unary_parent = np.ascontiguousarray(self.rule_parent[~binary])
+        self.unary_child = np.ascontiguousarray(self.rule_left[~binary])
+        self.unary_logprob = np.ascontiguousarray(self.rule_logprob[~binary])
+
+        self.__unary_closure()
+
+    def __unary_closure(self):
+        '''Compute the best chain of unary rules between every two tags of the unary rules, by the Floyd-Warshall algorithm in log space.
+            The chains have no positive cycle because all the probabilities are at most 1.
+        ------------------------------
+            Do not return anything, but stores
+            --- self.unary_tags: the ids of the tags appearing in the unary rules
+            --- self.unary_closure: the log probability of the best chain A ->* B between the tags of self.unary_tags,
+                0 on the diagonal (the empty chain) and -inf if there is no chain
+            --- self.unary_next: the id of the tag after A in the best chain A ->* B
+        '''
+        self.coarse = None
+        self.unary_tags = np.unique(np.r_[self.unary_parent, self.unary_child]).astype(np.int32)
+        u = len(self.unary_tags)
+        pos = np.searchsorted(self.unary_tags, np.r_[self.unary_parent, self.unary_child])
+        parent_pos, child_pos = pos[:len(self.unary_parent)], pos[len(self.unary_parent):]
+
+        closure = np.full((u, u), -np.inf)
+        closure[parent_pos, child_pos] = self.unary_logprob
+        np.fill_diagonal(closure, 0.)
+        unary_next = np.tile(self.unary_tags, (u, 1))
+        for k in range(u):
+            via = closure[:, k:k+1] + closure[k:k+1, :]
+            better = via > closure
+            closure = np.where(better, via, closure)
+            unary_next = np.where(better, unary_next[:, k:k+1], unary_next)
+        self.unary_closure = closure
+        self.unary_next = unary_next.astype(np.int32)
+
+    def coarse_grammar(self):
+        '''Get the coarse grammar projected from the compiled grammar, built at the first call'''
+        if self.coarse is None:
+            self.coarse = CoarseGrammer(self)
+        return self.coarse
+
+    def save(self, filename):
+        '''Save the compiled grammar to a binary file, which can be loaded back by self.load()
+            The file is made of a json header (hash of the training file, build settings, tags, tokens and array layout) followed by the raw arrays.
+        ------------------------------
+            Input:
+                filename: the path to the compiled grammar file
+        ------------------------------
+            Do not return anything, but writes the file
+        '''
+        arrays = {}
+        offset = 0
+        for name in COMPILED_ARRAYS:
+            array = getattr(self, name)
+            arrays[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset += -(-array.nbytes // ALIGN) * ALIGN
+        header = json.dumps({'train_hash': self.train_hash, 'update_hashes': self.update_hashes, 'settings': self.settings(), 'tags': [self.id2tags[i] for i in range(len(self.id2tags))],
+                             'tokens': self.id2tokens, 'arrays': arrays}).encode('utf-8')
+        start = -(-(len(MAGIC) + 12 + len(header)) // ALIGN) * ALIGN
+
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(MAGIC + struct.pack('<IQ', VERSION, len(header)) + header)
+            for name in COMPILED_ARRAYS:
+                f.seek(start + arrays[name]['offset'])
+                f.write(np.ascontiguousarray(getattr(self, name)).tobytes())
+            f.truncate(start + offset)
+        os.replace(tmp_filename, filename)
+
+    @staticmethod
+    def read_header(filename):
+        '''Read the header of a compiled grammar file
+        ------------------------------
             Input:
-                lhs: the left-hand-side tag
-                rhs: the right-hand-side tag
-        -------------------------------
-            Do not return anything, but stores the rule by updating the dictionary
+                filename: the path to the compiled grammar file
+        ------------------------------
+            Return:
+                the header as a dictionary, and the offset of the arrays in the file. None, None if it is not a valid file.
+        '''
+        with open(filename, 'rb') as f:
+            prefix = f.read(len(MAGIC) + 12)
+            if len(prefix) < len(MAGIC) + 12 or prefix[:len(MAGIC)] != MAGIC:
+                return None, None
+            version, length = struct.unpack('<IQ', prefix[len(MAGIC):])
+            if version != VERSION:
+                return None, None
+            header = json.loads(f.read(length).decode('utf-8'))
+        start = -(-(len(MAGIC) + 12 + length) // ALIGN) * ALIGN
+        return header, start
+
+    def load(self, filename):
+        '''Load the compiled grammar saved by self.save(). The arrays are memory-mapped, and the dictionaries are rebuilt from them.
+        ------------------------------
+            Input:
+                filename: the path to the compiled grammar file
+        ------------------------------
+            Do not return anything, but stores all rules in the Grammar object
         '''
-        if lhs in self.lhs_count.keys():
-            self.lhs_count[lhs] += 1.
-            if (lhs, rhs) in self.lhs_rhs_count.keys():
-                self.lhs_rhs_count[(lhs, rhs)] += 1.
+        header, start = Grammer.read_header(filename)
+        if header is None:
+            raise ValueError(filename + " is not a compiled grammar file")
+        self.__init__(**header.get('settings', {}))
+        self.train_hash = header['train_hash']
+        self.update_hashes = header.get('update_hashes', [])
+        self.tags = header['tags']
+        self.id2tags = dict(enumerate(self.tags))
+        self.tags2id = {tag: i for i, tag in enumerate(self.tags)}
+        self.id2tokens = header['tokens']
+        self.tokens2id = {token: i for i, token in enumerate(self.id2tokens)}
+        for name, layout in header['arrays'].items():
+            if np.prod(layout['shape']) == 0:
+                setattr(self, name, np.zeros(layout['shape'], dtype=layout['dtype']))
             else:
-                self.lhs_rhs_count[(lhs, rhs)] = 1.
+                setattr(self, name, np.memmap(filename, dtype=layout['dtype'], mode='r', offset=start + layout['offset'], shape=tuple(layout['shape'])))
+
+        tags = self.tags
+        for parent, left, right, count in zip(self.rule_parent.tolist(), self.rule_left.tolist(), self.rule_right.tolist(), self.rule_count.tolist()):
+            lhs = tags[parent]
+            rhs = tuple([tags[left], tags[right]]) if right >= 0 else tags[left]
+            if lhs in self.lhs_rhss_dict:
                 self.lhs_rhss_dict[lhs].append(rhs)
-        else:
-            self.lhs_count[lhs] = 1.
-            self.lhs_rhss_dict[lhs] = [rhs]
-            self.lhs_rhs_count[(lhs, rhs)] = 1.
+                self.lhs_count[lhs] += count
+            else:
+                self.lhs_rhss_dict[lhs] = [rhs]
+                self.lhs_count[lhs] = count
+            self.lhs_rhs_count[(lhs, rhs)] = count
 
-    def create_pcfg(self, filename):
-        '''Create the PCFG
+        tokens = self.id2tokens
+        for token_id, tag_id, count in zip(self.lexicon_token.tolist(), self.lexicon_tag.tolist(), self.lexicon_count.tolist()):
+            token = tokens[token_id]
+            tag = tags[tag_id]
+            if token in self.token_tags_dict:
+                self.token_tags_dict[token].append(tag)
+                self.token_count[token] += count
+            else:
+                self.token_tags_dict[token] = [tag]
+                self.token_count[token] = count
+            self.token_tag_count[(token, tag)] = count
+
+        self.__compute_probabilities()
+        self.__index_rules()
+
+    def get_pcfg(self, train_filename, compiled_filename, workers=1):
+        '''Load the compiled grammar if it was built from the current training file with the same settings, else create the PCFG and save it.
+            A loaded grammar keeps the files added to it by self.update_pcfg().
         ------------------------------
             Input:
-                filename: the path to the training file
+                train_filename: the path to the training file
+                compiled_filename: the path to the compiled grammar file
+                workers: the number of processes counting the trees when the PCFG is created
         ------------------------------
             Do not return anything, but stores all rules in the Grammar object
         '''
-        with open(filename, 'r') as f:
-            for i, line in enumerate(f):
-                t = Tree.fromstring(line.strip())
-                t.chomsky_normal_form()
-                self.__cross_tree(t[0])
-                
-        # get tag2id and id2tag dictionary
-        self.__clean_tags()
-        
-        # get lhs to rhs probability
-        for rule, value in self.lhs_rhs_count.items():
-            lhs = rule[0]
-            prob = value / self.lhs_count[lhs]
-            self.lhs_rhs_prob[rule] = prob
-            # print(lhs, " -> ", rule[1], ": ", prob)
+        if os.path.exists(compiled_filename):
+            header, _ = Grammer.read_header(compiled_filename)
+            if header is not None and header['train_hash'] == file_hash(train_filename) and header.get('settings', Grammer().settings()) == self.settings():
+                self.load(compiled_filename)
+                return
+        self.create_pcfg(train_filename, workers)
+        self.save(compiled_filename)
 
-        # get token to tag probability
-        for lexicon, value in self.token_tag_count.items():
-            token = lexicon[0]
-            prob = value / self.token_count[token]
-            self.token_tag_prob[lexicon] = prob
-            # print(token, ", ", lexicon[1], ": ", prob)
 
+class CoarseGrammer(object):
+    '''The class CoarseGrammer is the projection of a compiled grammar onto the base labels given by coarse_label().
+        The probabilities of the coarse rules are estimated from the counts of the fine rules, as if the treebank had been projected.
+        --- self.tags, self.tags2id, self.coarse_of: the coarse labels, their ids, and the coarse label id of each fine tag id
+        --- self.fine_onehot: the (|fine tags|, |coarse labels|) matrix of the projection
+        --- self.binary_left, self.binary_right, self.binary_prob: one entry per coarse binary rule
+        --- self.binary_tensor: the dense (|coarse labels|, |coarse labels|, |coarse labels|) array of the probabilities of the rules A -> B C
+        --- self.unary_closure: the total probability of the unary chains A ->* B, 1 on the diagonal for the empty chain
+    '''
+    def __init__(self, grammer):
+        '''Project a grammar
+        ------------------------------
+            Input:
+                grammer: a compiled Grammer object
+        ------------------------------
+        '''
+        tags = grammer.tags
+        coarse_tags = {}
+        for i in range(len(tags)):
+            coarse_tags.setdefault(coarse_label(grammer.id2tags[i]), len(coarse_tags))
+        self.tags = list(coarse_tags)
+        self.tags2id = coarse_tags
+        self.coarse_of = np.array([coarse_tags[coarse_label(grammer.id2tags[i])] for i in range(len(tags))], dtype=np.int32)
+        C = len(self.tags)
+        self.fine_onehot = np.zeros((len(tags), C))
+        self.fine_onehot[np.arange(len(tags)), self.coarse_of] = 1.
+
+        # the count of each coarse parent is the count of its fine parents, with their unary rules
+        parent_count = np.bincount(self.coarse_of[grammer.rule_parent], weights=grammer.rule_count, minlength=C)
+        binary = grammer.rule_right >= 0
+        rules = {}
+        for parent, left, right, count in zip(self.coarse_of[grammer.rule_parent[binary]].tolist(), self.coarse_of[grammer.rule_left[binary]].tolist(),
+                                              self.coarse_of[grammer.rule_right[binary]].tolist(), grammer.rule_count[binary].tolist()):
+            rules[(parent, left, right)] = rules.get((parent, left, right), 0.) + count
+        keys = np.array(list(rules.keys()), dtype=np.int32).reshape(-1, 3)
+        self.binary_parent, self.binary_left, self.binary_right = keys[:, 0], keys[:, 1], keys[:, 2]
+        self.binary_prob = np.array(list(rules.values())) / parent_count[self.binary_parent]
+        self.binary_tensor = np.zeros((C, C, C))
+        self.binary_tensor[self.binary_parent, self.binary_left, self.binary_right] = self.binary_prob
+
+        unary = np.zeros((C, C))
+        np.add.at(unary, (self.coarse_of[grammer.rule_parent[~binary]], self.coarse_of[grammer.rule_left[~binary]]), grammer.rule_count[~binary])
+        unary /= np.maximum(parent_count, 1.)[:, None]
+        # the projection can create cycles such as NP -> PP -> NP, the chains are summed up to the number of labels
+        closure = np.eye(C)
+        power = np.eye(C)
+        for _ in range(C):
+            power = power.dot(unary)
+            if not power.any():
+                break
+            closure += power
+        self.unary_closure = closure
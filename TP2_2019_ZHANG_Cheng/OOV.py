@@ -4,11 +4,27 @@
 
 import numpy as np
 import pandas as pd
+import json
+import os
+import pickle
 import re
+import struct
+from collections import OrderedDict
+from Grammer import ALIGN, file_hash
 
 # Noramlize digits by replacing them with #
 DIGITS = re.compile("[0-9]", re.UNICODE)
 
+# The format of the memory-mappable embedding file
+EMBEDDING_MAGIC = b'EMBD'
+EMBEDDING_VERSION = 1
+
+# The clustered index of the embeddings: the number of k-means iterations, the largest number of vectors the clusters are trained on,
+# and the number of clusters searched by a query
+INDEX_ITERATIONS = 10
+INDEX_SAMPLE = 100000
+INDEX_NPROBE = 8
+
 def Damerau_Levenshtein_distance(word, token):
     '''Define the Damerau-Levenshein distance between two strings.
        Implemented by dynamic programming.
@@ -41,46 +57,522 @@ def Damerau_Levenshtein_distance(word, token):
 
 
 
+def bounded_Damerau_Levenshtein_distance(word, token, k):
+    '''The Damerau-Levenshtein distance between two strings, if it is at most k.
+       Only the diagonal band of width k of the dynamic programming table is computed,
+       and it stops as soon as a whole row of the band is above k.
+    -----------------------------------
+        Input:
+            word: the first string
+            token: the second string
+            k: the largest distance of interest
+    -----------------------------------
+        Return:
+            the Damerau-Levenshein distance between the two strings if it is at most k, else k+1
+    '''
+    l1 = len(word)
+    l2 = len(token)
+    if abs(l1 - l2) > k:
+        return k + 1
+    far = k + 1
+    prev2 = None
+    prev = [j if j <= k else far for j in range(l2+1)]
+    for i in range(1, l1+1):
+        cur = [far] * (l2+1)
+        if i <= k:
+            cur[0] = i
+        for j in range(max(1, i-k), min(l2, i+k) + 1):
+            cost = 0 if word[i-1] == token[j-1] else 1
+            d = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + cost) # deletion, insertion and substitution
+            # transpose
+            if i > 1 and j > 1 and word[i-1] == token[j-2] and word[i-2] == token[j-1]:
+                d = min(d, prev2[j-2] + cost)
+            cur[j] = min(d, far)
+        if min(cur[max(0, i-k):min(l2, i+k) + 1]) > k:
+            return far
+        prev2, prev = prev, cur
+    return prev[l2]
+
+def Damerau_Levenshtein_within(word, tokens, k):
+    '''The bounded Damerau-Levenshtein distances between a word and many tokens at once.
+       The dynamic programming is vectorized over the tokens, and only computes the diagonal band of width k.
+    -----------------------------------
+        Input:
+            word: the string to compare
+            tokens: the list of strings to compare with
+            k: the largest distance of interest
+    -----------------------------------
+        Return:
+            an array with the distance to each token if it is at most k, else k+1
+    '''
+    N = len(tokens)
+    l1 = len(word)
+    far = k + 1
+    lengths = np.array([len(token) for token in tokens], dtype=np.int64)
+    result = np.full(N, far, dtype=np.int64)
+    close = np.flatnonzero(np.abs(lengths - l1) <= k)
+    if len(close) == 0:
+        return result
+    lengths = lengths[close]
+    l2 = int(lengths.max())
+    # the characters of the tokens, -1 after their end
+    chars = np.full((len(close), l2), -1, dtype=np.int64)
+    for r, idx in enumerate(close):
+        chars[r, :lengths[r]] = [ord(c) for c in tokens[idx]]
+    codes = [ord(c) for c in word]
+
+    prev2 = None
+    prev = np.minimum(np.arange(l2+1), far)[None, :].repeat(len(close), axis=0)
+    for i in range(1, l1+1):
+        cur = np.full((len(close), l2+1), far, dtype=np.int64)
+        if i <= k:
+            cur[:, 0] = i
+        for j in range(max(1, i-k), min(l2, i+k) + 1):
+            cost = (chars[:, j-1] != codes[i-1]).astype(np.int64)
+            d = np.minimum(np.minimum(prev[:, j] + 1, cur[:, j-1] + 1), prev[:, j-1] + cost) # deletion, insertion and substitution
+            # transpose
+            if i > 1 and j > 1:
+                swap = (chars[:, j-2] == codes[i-1]) & (chars[:, j-1] == codes[i-2])
+                d = np.where(swap, np.minimum(d, prev2[:, j-2] + cost), d)
+            cur[:, j] = np.minimum(d, far)
+        if cur[:, max(0, i-k):min(l2, i+k) + 1].min() > k:
+            return result
+        prev2, prev = prev, cur
+    result[close] = prev[np.arange(len(close)), lengths]
+    return result
+
+def deletes(word, k):
+    '''Generate all the strings obtained by deleting at most k characters from a word
+    -----------------------------------
+        Input:
+            word: the string
+            k: the maximum number of deleted characters
+    -----------------------------------
+        Return:
+            the set of strings, including the word itself
+    '''
+    results = {word}
+    frontier = {word}
+    for _ in range(k):
+        frontier = {w[:i] + w[i+1:] for w in frontier for i in range(len(w))}
+        results |= frontier
+    return results
+
+
+def convert_embeddings(pickle_file, mapped_file):
+    '''Convert the pickled word embeddings into a memory-mappable file, made of a json header followed by the raw arrays:
+        the utf-8 words sorted by bytes (blob and offsets), the original row of each sorted word (order) and the float32 matrix (matrix).
+    ------------------------------
+        Input:
+            pickle_file: the pickle file containing the words and their embeddings
+            mapped_file: the path to the converted file
+    ------------------------------
+        Do not return anything, but writes the file
+    '''
+    words, embeddings = pd.read_pickle(pickle_file)
+    # the last row of a repeated word wins, as in a dictionary
+    rows = {}
+    for i, w in enumerate(words):
+        rows[w.encode('utf-8')] = i
+    keys = sorted(rows.keys())
+    arrays = {'matrix': np.ascontiguousarray(embeddings, dtype=np.float32),
+              'offsets': np.cumsum([0] + [len(key) for key in keys]).astype(np.int64),
+              'blob': np.frombuffer(b''.join(keys), dtype=np.uint8),
+              'order': np.array([rows[key] for key in keys], dtype=np.int32)}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    stat = os.stat(pickle_file)
+    header = json.dumps({'source_hash': file_hash(pickle_file), 'source_size': stat.st_size, 'source_mtime': stat.st_mtime,
+                         'arrays': layout}).encode('utf-8')
+    start = -(-(len(EMBEDDING_MAGIC) + 12 + len(header)) // ALIGN) * ALIGN
+
+    tmp_file = mapped_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(EMBEDDING_MAGIC + struct.pack('<IQ', EMBEDDING_VERSION, len(header)) + header)
+        for name, array in arrays.items():
+            f.seek(start + layout[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp_file, mapped_file)
+
+def read_embedding_header(mapped_file):
+    '''Read the header of a converted embedding file
+    ------------------------------
+        Input:
+            mapped_file: the path to the converted file
+    ------------------------------
+        Return:
+            the header as a dictionary, and the offset of the arrays in the file. None, None if it is not a valid file.
+    '''
+    with open(mapped_file, 'rb') as f:
+        prefix = f.read(len(EMBEDDING_MAGIC) + 12)
+        if len(prefix) < len(EMBEDDING_MAGIC) + 12 or prefix[:len(EMBEDDING_MAGIC)] != EMBEDDING_MAGIC:
+            return None, None
+        version, length = struct.unpack('<IQ', prefix[len(EMBEDDING_MAGIC):])
+        if version != EMBEDDING_VERSION:
+            return None, None
+        header = json.loads(f.read(length).decode('utf-8'))
+    start = -(-(len(EMBEDDING_MAGIC) + 12 + length) // ALIGN) * ALIGN
+    return header, start
+
+def load_embeddings(mapped_file):
+    '''Memory-map a converted embedding file, only the rows which are looked up are read from the disk
+    ------------------------------
+        Input:
+            mapped_file: the path to the converted file
+    ------------------------------
+        Return:
+            the vocabulary as a MappedVocab, the embedding matrix and the header
+    '''
+    header, start = read_embedding_header(mapped_file)
+    if header is None:
+        raise ValueError(mapped_file + " is not a converted embedding file")
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        if np.prod(layout['shape']) == 0:
+            arrays[name] = np.zeros(layout['shape'], dtype=layout['dtype'])
+        else:
+            arrays[name] = np.memmap(mapped_file, dtype=layout['dtype'], mode='r', offset=start + layout['offset'], shape=tuple(layout['shape']))
+    return MappedVocab(arrays['blob'], arrays['offsets'], arrays['order']), arrays['matrix'], header
+
+
+class MappedVocab(object):
+    '''The class MappedVocab maps the words of a converted embedding file to their rows, by binary search in the sorted words.
+       It can be used like the dictionary of the words, without loading them.
+    '''
+    def __init__(self, blob, offsets, order):
+        '''Init the vocabulary
+        ---------------------------
+            Input:
+                blob: the utf-8 bytes of the sorted words
+                offsets: the start of each word in blob, followed by the length of blob
+                order: the row of each sorted word in the embedding matrix
+        ---------------------------
+        '''
+        self.blob = blob
+        self.offsets = offsets
+        self.order = order
+
+    def find(self, word):
+        '''Find the row of a word
+        ---------------------------
+            Input:
+                word: the word to look up
+        ---------------------------
+            Return:
+                the row of the word in the embedding matrix, -1 if the word is not in the vocabulary
+        '''
+        key = word.encode('utf-8')
+        low, high = 0, len(self.order)
+        while low < high:
+            mid = (low + high) // 2
+            if self.blob[self.offsets[mid]:self.offsets[mid+1]].tobytes() < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self.order) and self.blob[self.offsets[low]:self.offsets[low+1]].tobytes() == key:
+            return int(self.order[low])
+        return -1
+
+    def __contains__(self, word):
+        return self.find(word) >= 0
+
+    def __getitem__(self, word):
+        row = self.find(word)
+        if row < 0:
+            raise KeyError(word)
+        return row
+
+    def get(self, word, default=None):
+        row = self.find(word)
+        return row if row >= 0 else default
+
+    def __len__(self):
+        return len(self.order)
+
+    def word(self, i):
+        '''Get the i-th word in the sorted order, whose row is self.order[i]'''
+        return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes().decode('utf-8')
+
+
+class LRUCache(object):
+    '''The class LRUCache is a dictionary of bounded size, which evicts the least recently used entry when it is full.
+        --- self.capacity: the largest number of entries
+        --- self.hits, self.misses: the number of successful and failed lookups
+    '''
+    def __init__(self, capacity):
+        '''Init an empty cache
+        ---------------------------
+            Input:
+                capacity: the largest number of entries
+        ---------------------------
+        '''
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''Look up a key and mark it as the most recently used
+        ---------------------------
+            Input:
+                key: the key to look up
+        ---------------------------
+            Return:
+                the cached value, None if the key is not cached
+        '''
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        '''Store a value, and evict the least recently used entries beyond the capacity
+        ---------------------------
+            Input:
+                key: the key
+                value: the value, which should not be None
+        ---------------------------
+        '''
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        '''Get the size, hits and misses of the cache as a dict'''
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def normalize_rows(matrix):
+    '''Divide the rows of a matrix by their norm, in float32, the zero rows stay zero'''
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.
+    return matrix / norms
+
+
+class EmbeddingIndex(object):
+    '''The class EmbeddingIndex finds the approximate nearest neighbours of a vector by cosine similarity, with an inverted file index:
+        the normalized vectors are clustered by spherical k-means, and a query is only compared to the vectors of the clusters
+        whose centroids are the most similar to it.
+        --- self.centroids: the normalized centroids of the clusters
+        --- self.vectors: the normalized vectors, sorted by cluster, so that each cluster is a contiguous block
+        --- self.ids: the id of each vector of self.vectors
+        --- self.starts: the index of the first vector of each cluster in self.vectors, followed by the number of vectors
+    '''
+    def __init__(self, centroids, vectors, ids, starts):
+        '''Init the index from its arrays, computed by EmbeddingIndex.build()'''
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.starts = starts
+
+    @staticmethod
+    def build(matrix, ids, n_clusters=None, iterations=INDEX_ITERATIONS, sample=INDEX_SAMPLE, seed=0):
+        '''Cluster the vectors and build the index
+        ---------------------------
+            Input:
+                matrix: the vectors, one per row
+                ids: the id of each vector, returned by the queries
+                n_clusters: the number of clusters, None for the square root of the number of vectors
+                iterations: the number of iterations of k-means
+                sample: the largest number of vectors the centroids are trained on, the others are only assigned to them
+                seed: the seed of the random choice of the initial centroids and of the sample
+        ---------------------------
+            Return:
+                the EmbeddingIndex
+        '''
+        vectors = normalize_rows(matrix)
+        N = len(vectors)
+        if n_clusters is None:
+            n_clusters = max(1, int(np.sqrt(N)))
+        n_clusters = min(n_clusters, N)
+        rng = np.random.RandomState(seed)
+        train = vectors[rng.choice(N, sample, replace=False)] if N > sample else vectors
+        centroids = train[rng.choice(len(train), n_clusters, replace=False)]
+        for _ in range(iterations):
+            assign = np.argmax(train.dot(centroids.T), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            # an empty cluster keeps its centroid
+            empty = np.bincount(assign, minlength=n_clusters) == 0
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+
+        assign = np.argmax(vectors.dot(centroids.T), axis=1)
+        order = np.argsort(assign, kind='stable')
+        starts = np.searchsorted(assign[order], np.arange(n_clusters + 1)).astype(np.int64)
+        return EmbeddingIndex(centroids, np.ascontiguousarray(vectors[order]), np.asarray(ids)[order], starts)
+
+    def search(self, vec, k=10, nprobe=INDEX_NPROBE):
+        '''Find the approximate k nearest neighbours of a vector
+        ---------------------------
+            Input:
+                vec: the query vector, it does not need to be normalized
+                k: the number of neighbours
+                nprobe: the number of clusters searched, the most similar to the query
+        ---------------------------
+            Return:
+                the ids of the neighbours and their cosine similarities, from the most similar, ties broken by the order of the ids
+        '''
+        q = normalize_rows(vec)
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-self.centroids.dot(q), nprobe - 1)[:nprobe] if nprobe < len(self.centroids) else np.arange(len(self.centroids))
+        # the clusters are contiguous blocks, they are scored without copying their vectors
+        blocks = [(start, end) for start, end in zip(self.starts[probes].tolist(), self.starts[probes + 1].tolist())]
+        simis = np.concatenate([self.vectors[start:end].dot(q) for start, end in blocks])
+        ids = np.concatenate([self.ids[start:end] for start, end in blocks])
+        return self.__top(simis, ids, k)
+
+    def exact_search(self, vec, k=10):
+        '''Find the exact k nearest neighbours of a vector by comparing it to all the vectors, with the same output as self.search()'''
+        return self.__top(self.vectors.dot(normalize_rows(vec)), self.ids, k)
+
+    @staticmethod
+    def __top(simis, ids, k):
+        '''Select the k most similar ids, sorted by decreasing similarity and then by id'''
+        k = min(k, len(simis))
+        if k == 0:
+            return ids[:0], simis[:0]
+        top = np.argpartition(-simis, k - 1)[:k] if k < len(simis) else np.arange(len(simis))
+        top = top[np.lexsort((ids[top], -simis[top]))]
+        return ids[top], simis[top]
+
+    def nbytes(self):
+        '''Get the memory used by the arrays of the index, in bytes'''
+        return self.centroids.nbytes + self.vectors.nbytes + self.ids.nbytes + self.starts.nbytes
+
+
+class SparseBigram(object):
+    '''The class SparseBigram stores the bigram transition probabilities of the observed bigrams only.
+        --- self.keys: the sorted flat indices prev * size + next of the observed bigrams
+        --- self.counts: the count of each observed bigram
+        --- self.totals: the count of all bigrams starting from each index
+        --- self.smoothing: the additive smoothing, 0 gives the counts normalized as the dense matrix did
+       The probability of next after prev is (count + smoothing) / (total of next + smoothing * size): the dense matrix was divided
+       by its row sums broadcast over the columns, so each count is divided by the total of the row of the next index.
+    '''
+    def __init__(self, pair_counts, size, smoothing=0.):
+        '''Init the bigram model.
+        ---------------------------
+            Input:
+                pair_counts: a dict mapping the flat index prev * size + next to the count of the bigram
+                size: the number of indices, the tokens and the index shared by the beginning and the end of sentence
+                smoothing: the additive smoothing, default: 0
+        ---------------------------
+            Stores the sorted keys, their counts and the totals of each row
+        '''
+        self.shape = (size, size)
+        self.smoothing = smoothing
+        self.keys = np.array(sorted(pair_counts.keys()), dtype=np.int64)
+        self.counts = np.array([pair_counts[key] for key in self.keys.tolist()], dtype=np.float64)
+        self.totals = np.bincount(self.keys // size, weights=self.counts, minlength=size)
+
+    def probs(self, prevs, nexts):
+        '''Get the transition probabilities of many bigrams at once
+        ---------------------------
+            Input:
+                prevs: the indices of the previous words
+                nexts: the indices of the next words
+        ---------------------------
+            Return:
+                an array of the probabilities of each next word after its previous word, 0 for a row without any bigram
+        '''
+        size = self.shape[0]
+        prevs, nexts = np.broadcast_arrays(np.asarray(prevs, dtype=np.int64), np.asarray(nexts, dtype=np.int64))
+        query = prevs * size + nexts
+        pos = np.minimum(np.searchsorted(self.keys, query), max(len(self.keys) - 1, 0))
+        counts = np.zeros(query.shape)
+        if len(self.keys) > 0:
+            found = self.keys[pos] == query
+            counts[found] = self.counts[pos[found]]
+        denominators = self.totals[nexts] + self.smoothing * size
+        probas = np.zeros(query.shape)
+        np.divide(counts + self.smoothing, denominators, out=probas, where=denominators > 0)
+        return probas
+
+    def __getitem__(self, index):
+        '''Get the transition probability of the bigram index = (prev, next)'''
+        prev, next_ = index
+        return float(self.probs(prev, next_))
+
+    def nbytes(self):
+        '''The memory used by the arrays of the model, in bytes'''
+        return self.keys.nbytes + self.counts.nbytes + self.totals.nbytes
+
+
 class OoV(object):
     '''The class OoV defines the out of vocabulary module.
         --- self.grammer: it is related to a specific grammar because the out-of-vocabulary words are related to the already seen words in the grammar.
         --- self.vocab, self.embeddings: it is related to a specific word embedding bacause the similarity relies on the word embeddings.
+        --- self.token_matrix, self.token_rows: the row-normalized embeddings of the tokens of the grammar which have one, and the row of each of these tokens.
+        --- self.index: the approximate nearest neighbour index over the whole embedding vocabulary, built by self.get_embedding_index().
+        --- self.word_cache, self.context_cache: the LRU caches of the context-free part of the resolution of a word and of the chosen token in a context.
     '''
-    def __init__(self, grammer):
+    def __init__(self, grammer, word_cache_size=10000, context_cache_size=50000):
         '''Init the OoV module.
         ---------------------------
             Input:
                 grammer: an object of Grammer class
+                word_cache_size: the number of words whose candidates and embedding neighbours are cached
+                context_cache_size: the number of (previous word, word, next word) whose chosen token is cached
         ---------------------------
-            initialize the grammer, and vocab and embeddings by None
+            initialize the grammer, empty caches, and vocab, embeddings, the token matrix and the candidate index by None
         '''
         self.grammer = grammer
         self.vocab = None
         self.embeddings = None
+        self.embedding_hash = None
+        self.token_matrix = None
+        self.token_rows = None
+        self.row_ids = None
+        self.index = None
+        self.delete_index = None
+        self.index_k = 0
+        self.bigram_hash = None
+        self.word_cache = LRUCache(word_cache_size)
+        self.context_cache = LRUCache(context_cache_size)
         
     def get_embeddings(self, filename):
-        '''Get the word embeddings from a pkl file
+        '''Get the word embeddings from a pkl file. It is converted once to filename + '.mapped', which is then memory-mapped,
+            so that only the looked up words and rows are read. The conversion is done again when the pkl file changes.
         -------------------------------
             Input:
                 filename: the pickle file containing the word embeddings
         -------------------------------
-            Updates self.vocab and self.embeddings from the input file
+            Updates self.vocab, self.embeddings and self.embedding_hash from the input file
         '''
-        words, embeddings = pd.read_pickle(filename)
-        vocab = {}
-        for i, w in enumerate(words):
-            vocab[w] = i
-        self.vocab = vocab
-        self.embeddings = embeddings
+        mapped_file = filename + '.mapped'
+        header = None
+        if os.path.exists(mapped_file):
+            header, _ = read_embedding_header(mapped_file)
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            if header is None or header['source_size'] != stat.st_size or header['source_mtime'] != stat.st_mtime:
+                convert_embeddings(filename, mapped_file)
+        self.vocab, self.embeddings, header = load_embeddings(mapped_file)
+        self.embedding_hash = header['source_hash']
+        self.index = None
 
-    def get_bigram(self, filename):
-        '''Get the Bigram transition matrix.
+    def get_bigram(self, filename, smoothing=0.):
+        '''Get the Bigram transition model, the index len(self.token2id) stands for the beginning and the end of sentence.
         ------------------------------
             Input:
                 filename: the file containing raw training sentences without tags
+                smoothing: the additive smoothing of the transition probabilities, default: 0
         ------------------------------
-            Updates self.bigram
+            Updates self.bigram and self.bigram_hash
         '''
+        self.bigram_hash = (file_hash(filename), smoothing)
         all_tokens = list(self.grammer.token_count.keys())
         l = len(all_tokens)
         self.token2id = {}
@@ -88,16 +580,253 @@ class OoV(object):
         for i, key in enumerate(all_tokens):
             self.token2id[key] = i
             self.id2token[i] = key
-        self.bigram = np.zeros((l+1, l+1))
+        size = l + 1
+        pair_counts = {}
         with open(filename, 'r') as f:
             lines = f.read().splitlines()
             for line in lines:
                 words = line.strip().split(' ')
-                self.bigram[l, self.token2id[words[0]]] += 1
-                for i in range(len(words) - 1):
-                    self.bigram[self.token2id[words[i]], self.token2id[words[i+1]]] += 1
-                self.bigram[self.token2id[words[-1]], l] += 1
-        self.bigram = self.bigram / np.sum(self.bigram, axis=1)
+                ids = [l] + [self.token2id[w] for w in words] + [l]
+                for i in range(len(ids) - 1):
+                    key = ids[i] * size + ids[i+1]
+                    pair_counts[key] = pair_counts.get(key, 0) + 1
+        self.bigram = SparseBigram(pair_counts, size, smoothing)
+        self.build_candidate_index()
+
+    def build_candidate_index(self, k=2):
+        '''Build the symmetric delete index of the tokens, to find the tokens within a distance without scanning all of them.
+            Two strings within Damerau-Levenshtein distance k always share a string obtained by deleting at most k characters from each.
+        ------------------------------
+            Input:
+                k: the largest distance the index can answer, default: 2
+        ------------------------------
+            Updates self.index_k and self.delete_index, mapping each deleted string to the ids of the tokens it comes from
+        '''
+        self.index_k = k
+        self.delete_index = {}
+        for token, i in self.token2id.items():
+            for d in deletes(token, k):
+                if d in self.delete_index:
+                    self.delete_index[d].append(i)
+                else:
+                    self.delete_index[d] = [i]
+
+    def update_tokens(self):
+        '''Add the tokens added to the grammar by Grammer.update_pcfg() after the known ones, without rebuilding the candidate index,
+            the token matrix and the bigram model. The sentence boundary index of the bigram model moves after the new tokens.
+        ------------------------------
+            Return:
+                the list of the new tokens
+        '''
+        l = len(self.token2id)
+        new_tokens = [token for token in self.grammer.token_count.keys() if token not in self.token2id]
+        if len(new_tokens) == 0:
+            return new_tokens
+        for i, token in enumerate(new_tokens, l):
+            self.token2id[token] = i
+            self.id2token[i] = token
+            if self.delete_index is not None:
+                for d in deletes(token, self.index_k):
+                    if d in self.delete_index:
+                        self.delete_index[d].append(i)
+                    else:
+                        self.delete_index[d] = [i]
+
+        if self.token_matrix is not None:
+            row_ids = []
+            rows = []
+            for token in new_tokens:
+                t = self.normalize(token)
+                if t in self.vocab:
+                    row_ids.append(self.token2id[token])
+                    rows.append(self.vocab[t])
+            matrix = np.asarray(self.embeddings)[rows].astype(np.float32).reshape(len(rows), self.token_matrix.shape[1])
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.
+            self.set_token_matrix(np.concatenate([self.token_matrix, matrix / norms]),
+                                  np.concatenate([self.row_ids, np.array(row_ids, dtype=np.int64)]))
+
+        # renumber the sentence boundary of the known bigrams
+        old_size, size = l + 1, len(self.token2id) + 1
+        prevs, nexts = self.bigram.keys // old_size, self.bigram.keys % old_size
+        prevs[prevs == l] = size - 1
+        nexts[nexts == l] = size - 1
+        keys = prevs * size + nexts
+        self.bigram = SparseBigram(dict(zip(keys.tolist(), self.bigram.counts.tolist())), size, self.bigram.smoothing)
+        self.word_cache = LRUCache(self.word_cache.capacity)
+        self.context_cache = LRUCache(self.context_cache.capacity)
+        return new_tokens
+
+    def update_bigram(self, filename):
+        '''Add the bigrams of other raw sentences to the bigram model, without reading the training sentences again.
+            The tokens added to the grammar are added first by self.update_tokens().
+        ------------------------------
+            Input:
+                filename: the file containing the new raw sentences, whose words are tokens of the grammar
+        ------------------------------
+            Updates self.bigram and self.bigram_hash
+        '''
+        self.update_tokens()
+        l = len(self.token2id)
+        size = l + 1
+        pair_counts = dict(zip(self.bigram.keys.tolist(), self.bigram.counts.tolist()))
+        with open(filename, 'r') as f:
+            for line in f.read().splitlines():
+                words = line.strip().split(' ')
+                ids = [l] + [self.token2id[w] for w in words] + [l]
+                for i in range(len(ids) - 1):
+                    key = ids[i] * size + ids[i+1]
+                    pair_counts[key] = pair_counts.get(key, 0) + 1
+        self.bigram = SparseBigram(pair_counts, size, self.bigram.smoothing)
+        self.bigram_hash = self.bigram_hash + (file_hash(filename),)
+        self.word_cache = LRUCache(self.word_cache.capacity)
+        self.context_cache = LRUCache(self.context_cache.capacity)
+
+    def build_token_matrix(self):
+        '''Build the row-normalized embedding matrix of the tokens whose normalized form is in the embedding vocabulary,
+            so that the cosine similarities between a word and all these tokens are a single matrix-vector product.
+        ------------------------------
+            Updates self.token_matrix, self.row_ids (the token id of each row) and self.token_rows (the row of each token)
+        '''
+        row_ids = []
+        rows = []
+        for token, i in self.token2id.items():
+            t = self.normalize(token)
+            if t in self.vocab:
+                row_ids.append(i)
+                rows.append(self.vocab[t])
+        matrix = np.asarray(self.embeddings)[rows].astype(np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.
+        self.set_token_matrix(matrix / norms, np.array(row_ids, dtype=np.int64))
+
+    def set_token_matrix(self, matrix, row_ids):
+        '''Set the token matrix and its index
+        ------------------------------
+            Input:
+                matrix: the row-normalized embeddings of the tokens
+                row_ids: the token id of each row of the matrix
+        ------------------------------
+            Updates self.token_matrix, self.row_ids and self.token_rows
+        '''
+        self.token_matrix = matrix
+        self.row_ids = row_ids
+        self.token_rows = {self.id2token[i]: row for row, i in enumerate(row_ids.tolist())}
+
+    def get_token_matrix(self, cache_file):
+        '''Load the token matrix if the cache was built from the current embedding file and grammar, else build it and save it.
+        ------------------------------
+            Input:
+                cache_file: the path to the npz file caching the token matrix
+        ------------------------------
+            Updates self.token_matrix, self.row_ids and self.token_rows
+        '''
+        fingerprint = np.array([str(self.embedding_hash), str(self.grammer.fingerprint())])
+        if os.path.exists(cache_file):
+            cache = np.load(cache_file)
+            if np.array_equal(cache['fingerprint'], fingerprint):
+                self.set_token_matrix(cache['matrix'], cache['row_ids'])
+                return
+        self.build_token_matrix()
+        self.save_token_matrix(cache_file)
+
+    def save_token_matrix(self, cache_file):
+        '''Save the token matrix with the fingerprint of the embedding file and the grammar, to be loaded by self.get_token_matrix()
+        ------------------------------
+            Input:
+                cache_file: the path to the npz file caching the token matrix
+        ------------------------------
+            Do not return anything, but writes the file if both the embeddings and the grammar are identified by a hash
+        '''
+        if self.embedding_hash is None or self.grammer.fingerprint() is None:
+            return
+        fingerprint = np.array([str(self.embedding_hash), str(self.grammer.fingerprint())])
+        # np.savez adds the .npz extension to names without it
+        tmp_file = cache_file + '.tmp.npz'
+        np.savez(tmp_file, fingerprint=fingerprint, matrix=self.token_matrix, row_ids=self.row_ids)
+        os.replace(tmp_file, cache_file)
+
+    def token_similarities(self, word):
+        '''Compute the cosine similarity between a word of the embedding vocabulary and every token
+        -------------------------------
+            Input:
+                word: the word, already normalized
+        -------------------------------
+            Return:
+                an array of similarities in the order of self.token2id, 0 for the tokens without embedding
+        '''
+        if self.token_matrix is None:
+            self.build_token_matrix()
+        vec = np.asarray(self.embeddings[self.vocab[word]], dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        simis = np.zeros(len(self.token2id))
+        if norm > 0:
+            simis[self.row_ids] = self.token_matrix.dot(vec / norm)
+        return simis
+
+    def most_similar(self, word, n=1):
+        '''Find the tokens with the most similar embeddings to a word
+        -------------------------------
+            Input:
+                word: the word, already normalized
+                n: the number of tokens to return
+        -------------------------------
+            Return:
+                the list of the n most similar tokens, from the most similar, ties broken by the order of self.token2id
+        '''
+        simis = self.token_similarities(word)
+        n = min(n, len(simis))
+        if n == 1:
+            return [self.id2token[int(np.argmax(simis))]]
+        top = np.argpartition(-simis, n-1)[:n]
+        top = top[np.lexsort((top, -simis[top]))]
+        return [self.id2token[i] for i in top.tolist()]
+
+    def get_embedding_index(self, cache_file=None, n_clusters=None):
+        '''Build the approximate nearest neighbour index over all the words of the embedding vocabulary, or load it from the cache
+            if it was built from the current embedding file. The cache only keeps the clusters, the vectors are read again from the embeddings.
+        ------------------------------
+            Input:
+                cache_file: the path to the npz file caching the index, None to not cache it
+                n_clusters: the number of clusters, None for the square root of the vocabulary size
+        ------------------------------
+            Updates self.index, whose ids are the positions of the words in self.vocab (MappedVocab.word())
+        '''
+        order = np.asarray(self.vocab.order)
+        fingerprint = np.array([str(self.embedding_hash)])
+        if cache_file is not None and os.path.exists(cache_file):
+            cache = np.load(cache_file)
+            if np.array_equal(cache['fingerprint'], fingerprint) and (n_clusters is None or n_clusters == len(cache['centroids'])):
+                ids = cache['ids']
+                self.index = EmbeddingIndex(cache['centroids'], normalize_rows(np.asarray(self.embeddings)[order[ids]]), ids, cache['starts'])
+                return
+        self.index = EmbeddingIndex.build(np.asarray(self.embeddings)[order], np.arange(len(order)), n_clusters)
+        if cache_file is not None and self.embedding_hash is not None:
+            tmp_file = cache_file + '.tmp.npz'
+            np.savez(tmp_file, fingerprint=fingerprint, centroids=self.index.centroids, ids=self.index.ids, starts=self.index.starts)
+            os.replace(tmp_file, cache_file)
+
+    def nearest_words(self, word, n=10, nprobe=INDEX_NPROBE):
+        '''Find the words of the whole embedding vocabulary with the most similar embeddings to a word, with the approximate index
+        -------------------------------
+            Input:
+                word: the word, normalized by self.normalize() if it is not in the vocabulary
+                n: the number of words to return
+                nprobe: the number of clusters of the index searched
+        -------------------------------
+            Return:
+                the list of (word, cosine similarity) of the n nearest words, from the most similar, without the word itself.
+                Empty if the word has no embedding.
+        '''
+        word = self.normalize(word)
+        row = self.vocab.find(word)
+        if row < 0:
+            return []
+        if self.index is None:
+            self.get_embedding_index()
+        ids, simis = self.index.search(self.embeddings[row], n + 1, nprobe)
+        words = [(self.vocab.word(i), float(simi)) for i, simi in zip(ids.tolist(), simis.tolist())]
+        return [(w, simi) for w, simi in words if w != word][:n]
 
     def case_normalizer(self, word):
         '''Normalize the word case if it is not in the embedding vocabulary
@@ -146,8 +875,8 @@ class OoV(object):
         '''
         word_vec = self.embeddings[self.vocab[word]]
         candidate_vec = self.embeddings[self.vocab[candidate]]
-        similarity = np.dot(np.reshape(word_vec, (1, -1)), np.reshape(candidate_vec, (-1, 1))) / (np.linalg.norm(word_vec) * np.linalg.norm(candidate_vec))
-        return similarity
+        similarity = np.dot(word_vec, candidate_vec) / (np.linalg.norm(word_vec) * np.linalg.norm(candidate_vec))
+        return float(similarity)
     
     def generate_candidates(self, word, k=2):
         '''Generate candidates which are within distance k to the unseen word
@@ -157,13 +886,18 @@ class OoV(object):
                 k: the tolerance of distance, defaut: 2
         --------------------------------
             Return:
-                a list of candidates
+                a list of candidates, in the order of self.token2id
         '''
-        candidates = []
-        for token in self.token2id.keys():
-            if Damerau_Levenshtein_distance(word, token) <= k:
-                candidates.append(token)
-        return candidates
+        if self.delete_index is None or k > self.index_k:
+            tokens = list(self.token2id.keys())
+        else:
+            ids = set()
+            for d in deletes(word, k):
+                ids.update(self.delete_index.get(d, ()))
+            # keep the order of self.token2id, as the scan does
+            tokens = [self.id2token[i] for i in sorted(ids)]
+        distances = Damerau_Levenshtein_within(word, tokens, k)
+        return [token for token, distance in zip(tokens, distances) if distance <= k]
 
     def get_bigram_proba(self, prev_word, next_word, candidates):
         '''Get Bigram probability of each candidates
@@ -177,24 +911,19 @@ class OoV(object):
                 a list of probabilities corresponding to each condidate
         '''
         l = self.bigram.shape[0] - 1
-        lefts = []
-        rights = []
+        ids = [self.token2id[candidate] for candidate in candidates]
         if prev_word is None :
-            for candidate in candidates:
-                lefts.append(self.bigram[l, self.token2id[candidate]])
+            lefts = self.bigram.probs(l, ids)
         else:
-            if prev_word in self.token2id.keys():
-                for candidate in candidates:
-                    lefts.append(self.bigram[self.token2id[prev_word], self.token2id[candidate]])
+            if prev_word in self.token2id:
+                lefts = self.bigram.probs(self.token2id[prev_word], ids)
             else:
                 lefts = [1.] * len(candidates)
         if next_word is None:
-            for candidate in candidates:
-                rights.append(self.bigram[self.token2id[candidate], l])
+            rights = self.bigram.probs(ids, l)
         else:
-            if next_word in self.token2id.keys():
-                for candidate in candidates:
-                    rights.append(self.bigram[self.token2id[candidate], self.token2id[next_word]])
+            if next_word in self.token2id:
+                rights = self.bigram.probs(ids, self.token2id[next_word])
             else:
                 rights = [1.] * len(candidates)
         
@@ -205,7 +934,45 @@ class OoV(object):
             probas = probas / sum(probas)
         return probas
 
-    def assign_similar_token(self, word, prev_word, next_word, k=2, lamda=1000):
+    def resolve_word(self, word, k=2, probe=None):
+        '''The context-free part of the resolution of an unseen word, cached by self.word_cache
+        --------------------------------
+            Input:
+                word: the unseen word
+                k: the tolerance of distance
+                probe: the Probe counting the cache hits and the candidates, None to disable it
+        --------------------------------
+            Return:
+                ('token', token) if the chosen token does not depend on the context,
+                ('embedding', candidates, similarities, best_id, best_similarity) if the word has an embedding,
+                    with the embedding similarities of the candidates, and the most similar token out of the candidates,
+                ('bigram', candidates) otherwise, candidates being None for all the tokens
+        '''
+        entry = self.word_cache.get((word, k))
+        if entry is not None:
+            if probe is not None:
+                probe.count('oov_word_hits')
+            return entry
+        w = self.normalize(word)
+        candidates = self.generate_candidates(word, k)
+        if probe is not None:
+            probe.count('oov_candidates', len(candidates))
+        if w in self.vocab:
+            if len(candidates) == 0:
+                entry = ('token', self.most_similar(w)[0])
+            else:
+                simis = self.token_similarities(w)
+                ids = [self.token2id[candidate] for candidate in candidates]
+                candidate_simis = simis[ids]
+                simis[ids] = -np.inf
+                best_id = int(np.argmax(simis))
+                entry = ('embedding', candidates, candidate_simis, best_id, simis[best_id])
+        else:
+            entry = ('bigram', candidates if len(candidates) > 0 else None)
+        self.word_cache.put((word, k), entry)
+        return entry
+
+    def assign_similar_token(self, word, prev_word, next_word, k=2, lamda=1000, probe=None):
         '''Assign an unique similar token to the unseen word
         --------------------------------
             Input:
@@ -214,36 +981,80 @@ class OoV(object):
                 next_word: the next word
                 k: the tolerance of distance
                 lamda: the hyperparameter to adjust the importance of two aimilarities
+                probe: the Probe counting the cache hits and the candidates, None to disable it
         --------------------------------
             Return:
                 the unique similar token
         '''
-        w = self.normalize(word)
-        if w in self.vocab.keys():
-            all_tokens = list(self.token2id.keys())
-            simis = np.zeros(len(all_tokens))
-            for _, token in enumerate(all_tokens):
-                t = self.normalize(token)
-                if t in self.vocab.keys():
-                    simis[self.token2id[token]] = self.Embedding_similarity(w, t)
-            
-            candidates = self.generate_candidates(word, k)
-            if len(candidates) == 0:
-                return self.id2token[np.argmax(simis)]
+        key = (prev_word, word, next_word, k, lamda)
+        token = self.context_cache.get(key)
+        if token is not None:
+            if probe is not None:
+                probe.count('oov_context_hits')
+            return token
+        entry = self.resolve_word(word, k, probe)
+        if entry[0] == 'token':
+            token = entry[1]
+        elif entry[0] == 'embedding':
+            _, candidates, candidate_simis, best_id, best_simi = entry
+            scores = candidate_simis + lamda * self.get_bigram_proba(prev_word, next_word, candidates)
+            i = int(np.argmax(scores))
+            # the first token in the order of self.token2id wins the ties
+            if scores[i] > best_simi or (scores[i] == best_simi and self.token2id[candidates[i]] < best_id):
+                token = candidates[i]
             else:
-                bigram_probas = self.get_bigram_proba(prev_word, next_word, candidates)
-                for i, candidate in enumerate(candidates):
-                    idx = self.token2id[candidate]
-                    simis[idx] += lamda * bigram_probas[i]
-                return self.id2token[np.argmax(simis)]
+                token = self.id2token[best_id]
         else:
-            candidates = self.generate_candidates(word, k)
-            if len(candidates) == 0:
-                candidates = list(self.token2id.keys())
+            candidates = entry[1] if entry[1] is not None else list(self.token2id.keys())
             bigram_probas = self.get_bigram_proba(prev_word, next_word, candidates)
-            return candidates[np.argmax(bigram_probas)]
-    
-    
+            token = candidates[np.argmax(bigram_probas)]
+        self.context_cache.put(key, token)
+        return token
+
+    def cache_stats(self):
+        '''Get the size, hits and misses of both caches'''
+        return {'word': self.word_cache.stats(), 'context': self.context_cache.stats()}
+
+    def cache_fingerprint(self):
+        '''The hashes of the embeddings, the grammar and the bigram model the cached resolutions depend on'''
+        return (self.embedding_hash, self.grammer.fingerprint(), self.bigram_hash)
+
+    def save_cache(self, filename):
+        '''Save the entries of both caches, with the fingerprint of the models, to a pickle file
+        --------------------------------
+            Input:
+                filename: the path to the cache file
+        --------------------------------
+            Do not return anything, but writes the file
+        '''
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump({'fingerprint': self.cache_fingerprint(),
+                         'word': list(self.word_cache.entries.items()),
+                         'context': list(self.context_cache.entries.items())}, f)
+        os.replace(filename + '.tmp', filename)
+
+    def load_cache(self, filename):
+        '''Fill both caches from a file written by self.save_cache(), if it was saved with the same models
+        --------------------------------
+            Input:
+                filename: the path to the cache file
+        --------------------------------
+            Return:
+                True if the entries were loaded, False if the file is missing or was saved with other models
+        '''
+        if not os.path.exists(filename):
+            return False
+        with open(filename, 'rb') as f:
+            saved = pickle.load(f)
+        if saved['fingerprint'] != self.cache_fingerprint():
+            return False
+        for key, value in saved['word']:
+            self.word_cache.put(key, value)
+        for key, value in saved['context']:
+            self.context_cache.put(key, value)
+        return True
+
+
     # def assign_similar_token(self, word, prev_word, next_word, k=2, lamda=0.01):
     #     '''The naive implementation of assign similar token. You can try this one to compare with the other.
     #     --------------------------------
@@ -259,12 +1070,12 @@ class OoV(object):
     #     '''
     #     candidates = self.generate_candidates(word, k)
     #     word = self.normalize(word)
-    #     if len(candidates) == 0 and word in self.vocab.keys():
+    #     if len(candidates) == 0 and word in self.vocab:
     #         candidates = list(self.token2id.keys())
     #         simis = np.zeros(len(candidates))
     #         for i, candidate in enumerate(candidates):
     #             candidate = self.normalize(candidate)
-    #             if candidate in self.vocab.keys():
+    #             if candidate in self.vocab:
     #                 simis[i] = self.Embedding_similarity(word, candidate)
     #         return candidates[np.argmax(simis)]
         
@@ -274,11 +1085,11 @@ class OoV(object):
 
     #     bigram_probas = self.get_bigram_proba(prev_word, next_word, candidates)
 
-    #     if word not in self.vocab.keys():
+    #     if word not in self.vocab:
     #         return candidates[np.argmax(bigram_probas)]
     #     for i, candidate in enumerate(candidates):
     #         candidate = self.normalize(candidate)
-    #         if candidate in self.vocab.keys():
+    #         if candidate in self.vocab:
     #             simi = self.Embedding_similarity(word, candidate)
     #             bigram_probas[i] += lamda * simi
     #     return candidates[np.argmax(bigram_probas)]
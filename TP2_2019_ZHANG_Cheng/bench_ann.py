@@ -0,0 +1,91 @@
+#####################################################################################################################
+# This python file measures the approximate nearest neighbour index of OOV.py over the whole embedding vocabulary: #
+# the query time and the recall@k against the exact search, for several numbers of searched clusters.             #
+#####################################################################################################################
+
+import sys
+import time
+import numpy as np
+from OOV import EmbeddingIndex, OoV
+from main import pop_option
+
+# The numbers of clusters searched by a query to compare
+NPROBES = [1, 2, 4, 8, 16, 32]
+
+def synthetic_vectors(n, dim=64, n_centers=1000, spread=1., seed=0):
+    '''Draw clustered vectors around random centers, a stand-in for word embeddings which does not need the embedding file
+    -------------------------------------
+        Input:
+            n: the number of vectors
+            dim: the dimension of the vectors
+            n_centers: the number of centers
+            spread: the standard deviation of the vectors around their center, relative to the norm of the centers
+            seed: the seed of the random generator
+    -------------------------------------
+        Return:
+            the (n, dim) float32 matrix of the vectors
+    '''
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(n_centers, dim)
+    return (centers[rng.randint(n_centers, size=n)] + spread * rng.randn(n, dim)).astype(np.float32)
+
+def bench_index(matrix, k=10, n_queries=1000, n_clusters=None):
+    '''Build the index over the rows of a matrix, then query it with random rows and compare to the exact search
+    -------------------------------------
+        Input:
+            matrix: the (n, dim) matrix of the vectors
+            k: the number of neighbours of a query
+            n_queries: the number of query rows
+            n_clusters: the number of clusters of the index, None for the square root of the number of rows
+    -------------------------------------
+        Do not return anything, but prints the results
+    '''
+    start = time.time()
+    index = EmbeddingIndex.build(matrix, np.arange(len(matrix)), n_clusters)
+    print('{} words, {} dimensions, {} clusters, built in {:.2f} s, {:.1f} MB'.format(
+        len(index.ids), index.vectors.shape[1], len(index.centroids), time.time() - start, index.nbytes() / 2.**20))
+
+    rng = np.random.RandomState(0)
+    queries = matrix[rng.choice(len(matrix), min(n_queries, len(matrix)), replace=False)]
+    start = time.time()
+    exact = [set(index.exact_search(q, k)[0].tolist()) for q in queries]
+    exact_ms = (time.time() - start) * 1000 / len(queries)
+
+    print('{:<8} {:>10} {:>10} {:>10}'.format('nprobe', 'ms/query', 'speedup', 'recall@' + str(k)))
+    print('{:<8} {:>10.3f} {:>10.1f} {:>10.3f}'.format('exact', exact_ms, 1., 1.))
+    for nprobe in NPROBES:
+        if nprobe > len(index.centroids):
+            break
+        start = time.time()
+        found = [index.search(q, k, nprobe)[0] for q in queries]
+        elapsed = (time.time() - start) * 1000 / len(queries)
+        recall = np.mean([len(truth.intersection(ids.tolist())) / len(truth) for truth, ids in zip(exact, found)])
+        print('{:<8} {:>10.3f} {:>10.1f} {:>10.3f}'.format(nprobe, elapsed, exact_ms / elapsed, recall))
+
+def bench_ann(embedding_file='./embedding/polyglot-fr.pkl', k=10, n_queries=1000, n_clusters=None):
+    '''Benchmark the index over all the words of the embedding file, in the order of the mapped vocabulary as OoV.get_embedding_index()
+    -------------------------------------
+        Input:
+            embedding_file: the path to the pickle file containing the word embeddings
+            k: the number of neighbours of a query
+            n_queries: the number of query words
+            n_clusters: the number of clusters of the index, None for the square root of the vocabulary size
+    -------------------------------------
+        Do not return anything, but prints the results
+    '''
+    oov = OoV(None)
+    oov.get_embeddings(embedding_file)
+    bench_index(np.asarray(oov.embeddings)[np.asarray(oov.vocab.order)], k, n_queries, n_clusters)
+
+
+if __name__ == "__main__":
+    args = list(sys.argv)
+    synthetic = pop_option(args, '--synthetic', None)
+    if len(args) != 1 and len(args) != 3:
+        print("Error: do not have correct number of arguments (expected 0 or 2)!")
+    if synthetic is not None:
+        bench_index(synthetic_vectors(int(synthetic)), *([int(args[2])] if len(args) == 3 else []))
+    elif len(args) == 1:
+        bench_ann()
+    elif len(args) == 3:
+        bench_ann(args[1], int(args[2]))
@@ -0,0 +1,51 @@
+#####################################################################################################################
+# This python file compares the Damerau-Levenshtein kernels of OOV.py, by scanning all the tokens of the grammar. #
+#####################################################################################################################
+
+import sys
+import time
+from Grammer import Grammer
+from OOV import Damerau_Levenshtein_distance, bounded_Damerau_Levenshtein_distance, Damerau_Levenshtein_within
+
+# Some misspelled or unseen words to look up
+WORDS = ['gouvernment', 'présidnet', 'économiques', 'Pariss', 'reformé', 'millards', 'internationnal', 'a']
+
+def bench_distance(train_file_path='./data/train', k=2):
+    '''Find the tokens of the grammar within distance k of each word of WORDS with each kernel,
+       check that they agree, and print the time per word
+    -------------------------------------
+        Input:
+            train_file_path: the path to the training trees
+            k: the largest distance of the candidates
+    -------------------------------------
+        Do not return anything, but prints the results
+    '''
+    grammer = Grammer()
+    grammer.get_pcfg(train_file_path, train_file_path + '.grammar')
+    tokens = list(grammer.token_tags_dict.keys())
+    kernels = [('full', lambda word: [t for t in tokens if Damerau_Levenshtein_distance(word, t) <= k]),
+               ('bounded', lambda word: [t for t in tokens if bounded_Damerau_Levenshtein_distance(word, t, k) <= k]),
+               ('batch', lambda word: [t for t, d in zip(tokens, Damerau_Levenshtein_within(word, tokens, k)) if d <= k])]
+
+    print('{} tokens, k = {}'.format(len(tokens), k))
+    print('{:<10} {:>12} {:>10}'.format('kernel', 'ms/word', 'speedup'))
+    reference = None
+    for name, kernel in kernels:
+        start = time.time()
+        results = [kernel(word) for word in WORDS]
+        elapsed = (time.time() - start) * 1000 / len(WORDS)
+        if reference is None:
+            reference = (results, elapsed)
+        elif results != reference[0]:
+            print('Error: the {} kernel does not find the same candidates!'.format(name))
+        print('{:<10} {:>12.2f} {:>10.1f}'.format(name, elapsed, reference[1] / elapsed))
+
+
+if __name__ == "__main__":
+    args = sys.argv
+    if len(args) != 1 and len(args) != 3:
+        print("Error: do not have correct number of arguments (expected 0 or 2)!")
+    if len(args) == 1:
+        bench_distance()
+    if len(args) == 3:
+        bench_distance(args[1], int(args[2]))
@@ -0,0 +1,205 @@
+##############################################################################################################################
+# This python file benchmarks the parsing pipeline: model building, OOV resolution, parsing by sentence length and output. #
+##############################################################################################################################
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import parser
+from Grammer import Grammer
+from OOV import OoV
+from main import engine_options, pop_option, to_bracket
+from probe import Probe
+
+# The upper bounds of the sentence length buckets, the last bucket takes the longer sentences
+LENGTH_BUCKETS = [10, 20, 30, 40, 60]
+
+def peak_memory():
+    '''Get the peak resident memory of the process, in MB'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def latency_stats(times):
+    '''Summarize a list of durations
+    -------------------------------------
+        Input:
+            times: the durations, in seconds
+    -------------------------------------
+        Return:
+            a dict with the count, the total, the mean and the 50th, 95th and 99th percentiles in milliseconds, and the throughput per second
+    '''
+    if len(times) == 0:
+        return {'count': 0}
+    times = np.array(times)
+    return {'count': len(times), 'total_s': float(times.sum()), 'mean_ms': float(times.mean() * 1000),
+            'p50_ms': float(np.percentile(times, 50) * 1000), 'p95_ms': float(np.percentile(times, 95) * 1000),
+            'p99_ms': float(np.percentile(times, 99) * 1000), 'per_s': float(len(times) / times.sum()) if times.sum() > 0 else None}
+
+def bucket_name(length):
+    '''Get the name of the length bucket of a sentence'''
+    low = 1
+    for high in LENGTH_BUCKETS:
+        if length <= high:
+            return '{}-{}'.format(low, high)
+        low = high + 1
+    return '{}+'.format(low)
+
+def git_commit():
+    '''Get the current git commit of the repository, None outside of a git repository'''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def bench_parser(test_files=('./data/dev', './data/test'), train_file_path='./data/train', train_sent_file='./data/train_sent',
+                 embedding_file='./embedding/polyglot-fr.pkl', engine='vectorized', beam_size=None, beam_threshold=None, coarse_threshold=None, limit=None):
+    '''Benchmark the parsing pipeline on the test files
+    -------------------------------------
+        Input:
+            test_files: the paths to the files of sentences to parse
+            train_file_path: the path to the training trees
+            train_sent_file: the path to the training sentences
+            embedding_file: the path to the pickle file of the word embeddings
+            engine: the name of the parsing engine in parser.ENGINES
+            beam_size, beam_threshold: the beam of the 'vectorized' engine, None for no pruning
+            coarse_threshold: the posterior threshold of the coarse-to-fine pruning of the 'vectorized' engine, None for no pruning
+            limit: the largest number of sentences read from each test file, None for all of them
+    -------------------------------------
+        Return:
+            a dict of the results, which can be dumped as json
+    '''
+    results = {'engine': engine, 'beam_size': beam_size, 'beam_threshold': beam_threshold, 'coarse_threshold': coarse_threshold, 'commit': git_commit(),
+               'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'test_files': list(test_files)}
+
+    # building the grammar from the treebank, and loading the compiled grammar. The compiled grammar and the token matrix are
+    # written to a temporary directory, so that the files the parser runs from (./data/train.grammar, possibly updated by
+    # update_grammar.py or built with other settings) are left unchanged. The mapped files stay valid after their removal.
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        grammer = Grammer()
+        grammer.create_pcfg(train_file_path)
+        results['grammar_build_s'] = time.perf_counter() - start
+        compiled_file = os.path.join(cache_dir, os.path.basename(train_file_path) + '.grammar')
+        grammer.save(compiled_file)
+        start = time.perf_counter()
+        grammer = Grammer()
+        grammer.get_pcfg(train_file_path, compiled_file)
+        results['grammar_load_s'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        oov = OoV(grammer)
+        oov.get_embeddings(embedding_file)
+        oov.get_bigram(train_sent_file)
+        oov.get_token_matrix(os.path.join(cache_dir, os.path.basename(train_file_path) + '.embedding.npz'))
+        results['oov_build_s'] = time.perf_counter() - start
+        results['models_peak_mb'] = peak_memory()
+
+    sentences = []
+    for test_file in test_files:
+        with open(test_file, 'r') as f:
+            lines = [line.strip() for line in f if len(line.strip()) > 0]
+        sentences += lines[:limit] if limit is not None else lines
+
+    # resolving each unseen word in context once, with empty caches
+    oov_times = []
+    for sent in sentences:
+        words = sent.split(' ')
+        for j in range(1, len(words) + 1):
+            if words[j-1] not in grammer.token_tags_dict:
+                start = time.perf_counter()
+                parser.resolve_word(words, j, grammer.token_tags_dict, oov)
+                oov_times.append(time.perf_counter() - start)
+    results['oov_word'] = latency_stats(oov_times)
+
+    # parsing, the unseen words are now answered by the caches of the OoV module
+    parse = parser.ENGINES[engine]
+    options = engine_options(beam_size, beam_threshold, coarse_threshold)
+    parse_times = {}
+    tree_times = []
+    output_times = []
+    words_total = 0
+    phase_totals = {}
+    counts = {}
+    probe = Probe()
+    for sent in sentences:
+        probe.begin(sent)
+        start = time.perf_counter()
+        s, p = parse(sent, grammer, oov, probe=probe, **options)
+        elapsed = time.perf_counter() - start
+        record = probe.end()
+        length = len(sent.split(' '))
+        words_total += length
+        parse_times.setdefault(bucket_name(length), []).append(elapsed)
+        tree_times.append(record['times'].get('build_tree', 0.))
+        for name, value in record['times'].items():
+            phase_totals[name] = phase_totals.get(name, 0.) + value
+        for name, value in record['counts'].items():
+            counts[name] = counts.get(name, 0) + value
+        start = time.perf_counter()
+        to_bracket(s)
+        output_times.append(time.perf_counter() - start)
+
+    all_parse_times = [t for times in parse_times.values() for t in times]
+    results['parse'] = latency_stats(all_parse_times)
+    results['parse']['words_per_s'] = words_total / sum(all_parse_times)
+    results['parse_by_length'] = {name: latency_stats(parse_times[name]) for name in sorted(parse_times, key=lambda name: int(name.split('-')[0].rstrip('+')))}
+    results['build_tree'] = latency_stats(tree_times)
+    results['to_bracket'] = latency_stats(output_times)
+    results['phase_totals_s'] = phase_totals
+    results['counts'] = counts
+    results['peak_mb'] = peak_memory()
+    return results
+
+def print_results(results, reference=None):
+    '''Print the results of bench_parser as a table, with the ratio to the times of a reference run if it is given'''
+    def ratio(key, stat, sub=None):
+        if reference is None:
+            return ''
+        old = reference.get(key, {})
+        if sub is not None:
+            old = old.get(sub, {})
+        new = results[key] if sub is None else results[key][sub]
+        if not isinstance(old, dict) or old.get(stat) is None or new.get(stat) is None:
+            return ''
+        return 'x{:.2f}'.format(new[stat] / old[stat])
+
+    print('engine: {}, beam_size: {}, beam_threshold: {}, coarse_threshold: {}'.format(results['engine'], results['beam_size'], results['beam_threshold'], results.get('coarse_threshold')))
+    for key in ['grammar_build_s', 'grammar_load_s', 'oov_build_s', 'models_peak_mb', 'peak_mb']:
+        print('{:<24} {:>10.3f}'.format(key, results[key]))
+    print('{:<24} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>8}'.format('stage', 'count', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'per s', 'p50'))
+    rows = [('oov_word', None), ('parse', None)] + [('parse_by_length', name) for name in results['parse_by_length']] + [('build_tree', None), ('to_bracket', None)]
+    for key, sub in rows:
+        stats = results[key] if sub is None else results[key][sub]
+        if stats['count'] == 0:
+            continue
+        name = key if sub is None else '  length ' + sub
+        print('{:<24} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f} {:>8}'.format(
+            name, stats['count'], stats['mean_ms'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['per_s'] or 0., ratio(key, 'p50_ms', sub)))
+
+
+if __name__ == "__main__":
+    args = list(sys.argv)
+    engine = pop_option(args, '--engine', 'vectorized', parser.ENGINES.keys())
+    beam_size = pop_option(args, '--beam-size', None)
+    beam_threshold = pop_option(args, '--beam-threshold', None)
+    coarse_threshold = pop_option(args, '--coarse-threshold', None)
+    limit = pop_option(args, '--limit', None)
+    output = pop_option(args, '--output', 'bench_results.json')
+    compare = pop_option(args, '--compare', None)
+    test_files = args[1:] if len(args) > 1 else ['./data/dev', './data/test']
+    results = bench_parser(test_files, engine=engine,
+                           beam_size=int(beam_size) if beam_size is not None else None,
+                           beam_threshold=float(beam_threshold) if beam_threshold is not None else None,
+                           coarse_threshold=float(coarse_threshold) if coarse_threshold is not None else None,
+                           limit=int(limit) if limit is not None else None)
+    reference = None
+    if compare is not None:
+        with open(compare, 'r') as f:
+            reference = json.load(f)
+    print_results(results, reference)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
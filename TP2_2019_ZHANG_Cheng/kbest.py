@@ -0,0 +1,269 @@
+#####################################################################################################################
+# This python file extracts the k best parses of a sentence from the chart of the vectorized CYK engine, lazily:   #
+# the next best derivations of a cell are only enumerated when a larger cell asks for them (Huang and Chiang 2005). #
+#####################################################################################################################
+
+import heapq
+import sys
+import numpy as np
+from parse_tree import ParseTree
+from parser import Chart, fill_chart
+from probe import phase
+
+# The kinds of the items of the derivation graph: the cell of a tag after or before the unary rules of its span
+TOP = 0
+BOTTOM = 1
+
+class KBestChart(object):
+    '''The class KBestChart enumerates the derivations of a chart filled by fill_chart() in decreasing order of probability.
+        The derivation graph has two items per cell, as the vectorized engine which applies the unary rules after the binary rules:
+        --- (TOP, low, high, A): the tag A of the span after the unary rules, derived from a BOTTOM item (low, high, B)
+            by a chain of unary rules A -> ... -> B, the empty chain when B = A. Each of the k best chains A ->* B is an edge of its own,
+            so that the trees which only differ by their unary chains are enumerated as well, cycles such as NP -> NP included.
+        --- (BOTTOM, low, high, B): the tag B of the span before the unary rules, derived from its word when high = low + 1,
+            else by a binary rule B -> C D from the TOP items (low, k, C) and (k, high, D)
+        The derivations of an item are the lists self.derivations[item] of heap entries (-log probability, edge index, indexes of the
+        derivations of the children of the edge), and the next ones are waiting in the heap self.candidates[item].
+        An edge is a tuple (log probability of its rules, children items, tags of the unary chain below the tag of the item).
+    '''
+    def __init__(self, chart, bottom, grammer, words, k):
+        '''Init the lazy enumeration
+        ---------------------------
+            Input:
+                chart: the Chart filled by fill_chart(), after the unary rules
+                bottom: the Chart of the same cells before the unary rules
+                grammer: the compiled PCFG object
+                words: the words of the sentence
+                k: the largest number of derivations asked for an item, only the k best edges of an item are kept
+        ---------------------------
+        '''
+        self.chart = chart
+        self.bottom = bottom
+        self.grammer = grammer
+        self.words = words
+        self.k = k
+        self.T = len(grammer.tags2id)
+        self.edges = {}
+        self.derivations = {}
+        self.candidates = {}
+        self.seen = {}
+        self.expanded = set()
+        self.exhausted = set()
+        self.rows = {}
+        self.chains = {}
+        self.unary_children = {}
+        for parent, child, logprob in zip(grammer.unary_parent.tolist(), grammer.unary_child.tolist(), grammer.unary_logprob.tolist()):
+            self.unary_children.setdefault(parent, []).append((child, logprob))
+        self.rule_range = {}
+        starts = np.r_[grammer.binary_starts, len(grammer.binary_parent)].tolist()
+        for i in range(len(starts) - 1):
+            self.rule_range[int(grammer.binary_parent[starts[i]])] = (starts[i], starts[i+1])
+
+    def row(self, low, high):
+        '''Get the dense scores of the TOP items of a span, computed once'''
+        if (low, high) not in self.rows:
+            self.rows[(low, high)] = self.chart.row(low, high, self.T)
+        return self.rows[(low, high)]
+
+    def unary_chains(self, tag):
+        '''Get the k best chains of unary rules from a tag to each tag, computed once by a best-first search over the chains,
+            in which a tag ends at most k chains: the chains come out of the heap by decreasing probability, as the rules have probabilities <= 1.
+        ---------------------------
+            Input:
+                tag: the id of the tag at the top of the chains
+        ---------------------------
+            Return:
+                a dict mapping the id of the tag at the bottom of the chains to the list of their (log probability, tags below the top tag),
+                from the most probable, the empty chain () being the first one of the tag itself
+        '''
+        if tag not in self.chains:
+            chains = {}
+            heap = [(0., (tag,))]
+            while heap:
+                cost, path = heapq.heappop(heap)
+                found = chains.setdefault(path[-1], [])
+                if len(found) >= self.k:
+                    continue
+                found.append((-cost, path[1:]))
+                for child, logprob in self.unary_children.get(path[-1], ()):
+                    heapq.heappush(heap, (cost - logprob, path + (child,)))
+            self.chains[tag] = chains
+        return self.chains[tag]
+
+    def __init_item(self, item):
+        '''Find the incoming edges of an item with the best derivation through each of them, and keep the self.k best ones as candidates
+        ---------------------------
+            Input:
+                item: the item, a tuple (kind, low, high, tag)
+        ---------------------------
+            Do not return anything, but stores the edges and the candidates of the item, and its best derivation
+        '''
+        kind, low, high, tag = item
+        edges = []
+        scores = []
+        if kind == TOP:
+            bottom_row = self.bottom.row(low, high, self.T)
+            for child, chains in self.unary_chains(tag).items():
+                if np.isfinite(bottom_row[child]):
+                    for logprob, path in chains:
+                        edges.append((logprob, ((BOTTOM, low, high, child),), path))
+                        scores.append(logprob + bottom_row[child])
+        elif high - low > 1 and tag in self.rule_range:
+            start, end = self.rule_range[tag]
+            left = self.grammer.binary_left[start:end]
+            right = self.grammer.binary_right[start:end]
+            logprob = self.grammer.binary_logprob[start:end]
+            # scores of the rules of the tag at every split point: (splits, rules)
+            splits = np.arange(low + 1, high)
+            totals = np.array([self.row(low, m)[left] + self.row(m, high)[right] for m in splits.tolist()]) + logprob
+            flat = np.flatnonzero(np.isfinite(totals))
+            if len(flat) > self.k:
+                flat = flat[np.argpartition(-totals.flat[flat], self.k - 1)[:self.k]]
+            for f in flat.tolist():
+                m, r = divmod(f, end - start)
+                m = int(splits[m])
+                edges.append((logprob[r], ((TOP, low, m, int(left[r])), (TOP, m, high, int(right[r]))), ()))
+                scores.append(totals.flat[f])
+
+        self.edges[item] = edges
+        self.seen[item] = set()
+        if kind == BOTTOM and high - low == 1:
+            # a word is a leaf with a single derivation
+            self.derivations[item] = [(-self.bottom.score(low, high, tag), -1, ())]
+            self.candidates[item] = []
+            self.exhausted.add(item)
+            return
+        candidates = [(-score, e, (0,) * len(edges[e][1])) for e, score in enumerate(scores)]
+        candidates.sort()
+        candidates = candidates[:self.k]
+        heapq.heapify(candidates)
+        for _, e, js in candidates:
+            self.seen[item].add((e, js))
+        self.candidates[item] = candidates
+        self.derivations[item] = []
+        if candidates:
+            self.derivations[item].append(heapq.heappop(candidates))
+        else:
+            self.exhausted.add(item)
+
+    def get(self, item, count):
+        '''Enumerate the derivations of an item until it has count of them or none is left, with an explicit stack of items
+            instead of recursion: the next derivations of an item need the next derivations of the children of its last one.
+        ---------------------------
+            Input:
+                item: the item, a tuple (kind, low, high, tag)
+                count: the number of derivations wanted
+        ---------------------------
+            Return:
+                the list of the derivations of the item, with at most count of them
+        '''
+        stack = [(item, count)]
+        while stack:
+            item, count = stack[-1]
+            if item not in self.derivations:
+                self.__init_item(item)
+            derivations = self.derivations[item]
+            if len(derivations) >= count or item in self.exhausted:
+                stack.pop()
+                continue
+            if item not in self.expanded:
+                # the successors of the last derivation increase the index of the derivation of one child
+                _, e, js = derivations[-1]
+                tails = self.edges[item][e][1]
+                missing = [(tails[i], js[i] + 2) for i in range(len(tails))
+                           if len(self.derivations.get(tails[i], ())) < js[i] + 2 and tails[i] not in self.exhausted]
+                if missing:
+                    stack.extend(missing)
+                    continue
+                for i in range(len(tails)):
+                    if len(self.derivations[tails[i]]) > js[i] + 1:
+                        succ = js[:i] + (js[i] + 1,) + js[i+1:]
+                        if (e, succ) not in self.seen[item]:
+                            self.seen[item].add((e, succ))
+                            score = self.edges[item][e][0] + sum(-self.derivations[tail][j][0] for tail, j in zip(tails, succ))
+                            heapq.heappush(self.candidates[item], (-score, e, succ))
+                self.expanded.add(item)
+            if len(self.candidates[item]) == 0:
+                self.exhausted.add(item)
+                stack.pop()
+                continue
+            derivations.append(heapq.heappop(self.candidates[item]))
+            self.expanded.discard(item)
+        return self.derivations[item]
+
+    def tree(self, item, index):
+        '''Build the tree of a derivation
+        ---------------------------
+            Input:
+                item: the item, a tuple (kind, low, high, tag)
+                index: the rank of the derivation of the item, it must already be enumerated by self.get()
+        ---------------------------
+            Return:
+                the ParseTree of the derivation, in Chomsky normal form
+        '''
+        id2tags = self.grammer.id2tags
+        tree = ParseTree(self.words)
+        stack = [(tree.add_node(id2tags[item[3]]), item, index)]
+        while stack:
+            node, item, index = stack.pop()
+            kind, low, high, tag = item
+            _, e, js = self.get(item, index + 1)[index]
+            if e < 0:
+                tree.children[node].append(~low)
+                continue
+            tails = self.edges[item][e][1]
+            if kind == TOP:
+                # the tags of the unary chain below the tag, down to the tag of the child, each one a node of the span
+                for label in self.edges[item][e][2]:
+                    new = tree.add_node(id2tags[label])
+                    tree.children[node].append(new)
+                    node = new
+                stack.append((node, tails[0], js[0]))
+            else:
+                for tail, j in zip(tails, js):
+                    new = tree.add_node(id2tags[tail[3]])
+                    tree.children[node].append(new)
+                    stack.append((new, tail, j))
+        return tree
+
+
+def PCYK_kbest(sentence, grammer, oov, k=10, beam_size=None, beam_threshold=None, coarse_threshold=None, probe=None):
+    '''Get the k best parses of a sentence: the chart is filled once by the vectorized engine, then the derivations of the whole
+        sentence are enumerated lazily in decreasing order of probability, over all the binary rules and all the chains of unary rules
+        of the cells of the chart. The first parse is the Viterbi parse of the vectorized engine.
+    --------------------------------
+        Input:
+            sentence: the sentence to parse
+            grammer: the PCFG object, compiled by grammer.compile()
+            oov: the out of vocabulary object
+            k: the number of parses
+            beam_size, beam_threshold, coarse_threshold: the pruning of the chart, as in PCYK_vectorized
+            probe: the Probe timing the phases and counting the work, None to disable it
+    --------------------------------
+        Return:
+            the list of at most k pairs (ParseTree in Chomsky normal form, log probability), the best first, empty if there is no parse
+    '''
+    words = sentence.strip().split(' ')
+    bottom = Chart(len(words))
+    chart = fill_chart(words, grammer, oov, beam_size, beam_threshold, coarse_threshold, probe, bottom)
+    SENT = grammer.tags2id['SENT']
+    if chart.find(0, len(words), SENT) < 0:
+        return []
+    with phase(probe, 'kbest'):
+        kbest = KBestChart(chart, bottom, grammer, words, k)
+        root = (TOP, 0, len(words), SENT)
+        derivations = kbest.get(root, k)
+        return [(kbest.tree(root, i), -derivations[i][0]) for i in range(len(derivations))]
+
+
+if __name__ == "__main__":
+    from main import build_models, to_bracket
+    args = sys.argv
+    if len(args) != 4 and len(args) != 6:
+        print("Error: do not have correct number of arguments (expected 3 or 5)!")
+        sys.exit(1)
+    grammer, oov = build_models(*args[4:6])
+    with open(args[2], 'r') as test, open(args[3], 'w') as out:
+        for i, sent in enumerate(test):
+            for tree, logprob in PCYK_kbest(sent.strip(), grammer, oov, int(args[1])):
+                out.write('{}\t{:.6f}\t{}\n'.format(i, logprob, to_bracket(tree)))
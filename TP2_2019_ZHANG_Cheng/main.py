@@ -5,10 +5,19 @@
 import os  
 from Grammer import *
 from OOV import OoV
-from split_data import split
+from split_data import clean_line, split
 from parser import *
+from parse_tree import ParseTree
+from probe import Probe, json_lines_sink
+from scorer import COLLINS_PARAMETERS, format_results, read_parameters, score_files
+import io
+import multiprocessing
+import socketserver
 import sys
 
+# The models shared with the worker processes of parse_batch, inherited through fork instead of being pickled for each task
+WORKER_MODELS = None
+
 def preprocess(raw_file, processed_file):
     '''Preprocess the data, to remove functional labels
     --------------------------------
@@ -20,12 +29,8 @@ def preprocess(raw_file, processed_file):
     '''
     out = open(processed_file, 'w')
     with open(raw_file, 'r') as f:
-        for i, line in enumerate(f):
-            line = re.sub(r'-[A-Z].{0,3}[A-Z]\s',' ', line)
-            line = re.sub(r'-OBJ::OBJ##OBJ/OBJ', '', line)
-            line = re.sub(r'-DE_OBJ', '', line)
-            line = re.sub(r'-AFF.DEMSUJ', '', line)
-            out.write(line)
+        for line in f:
+            out.write(clean_line(line))
     out.close()
 
 def flat_print(t):
@@ -49,7 +54,194 @@ def flat_print(t):
             s.append(flat_print(t[i]))
         return '(' + tag + ' ' + ' '.join(s) + ')'
 
-def main(test_file_path, train_file_path='./data/train', train_sent_file='./data/train_sent', output_file='evaluation_data2.parser_output'):
+def to_bracket(s):
+    '''Turn the parsing result of a CYK engine into the output bracket format, by undoing the Chomsky normal form
+    -----------------------------------
+        Input:
+            s: the ParseTree returned by the parsing engine, or its string under bracket format
+    -----------------------------------
+        Return:
+            the string written to the output file
+    '''
+    if isinstance(s, ParseTree):
+        return s.to_bracket()
+    s = '( ' + s + ')'
+    t = Tree.fromstring(s)
+    t.un_chomsky_normal_form(unaryChar='_')
+    return flat_print(t)
+
+def build_models(train_file_path='./data/train', train_sent_file='./data/train_sent', embedding_file='./embedding/polyglot-fr.pkl', extra_sent_files=(), workers=1, grammar_settings=None):
+    '''Build the grammar and the OoV module used by the parsing engines
+    -------------------------------------
+        Input:
+            train_file_path: the path to the training file, its compiled grammar is cached at train_file_path + '.grammar'
+                             and the embeddings of its tokens at train_file_path + '.embedding.npz'
+            train_sent_file: the path to the training sentence file
+            embedding_file: the path to the pickle file containing the word embeddings
+            extra_sent_files: the paths to the sentences of the treebank files added to the grammar by update_grammar.py,
+                              their bigrams are added to the bigram model
+            workers: the number of processes counting the training trees when the grammar is created
+            grammar_settings: the build settings of the grammar given to Grammer() (horz_markov, vert_markov, min_count, top_n),
+                              the compiled grammar is rebuilt when they change, None for the default settings
+    -------------------------------------
+        Return:
+            the Grammer object and the OoV object
+    '''
+    grammer = Grammer(**(grammar_settings or {}))
+    grammer.get_pcfg(train_file_path, train_file_path + '.grammar', workers)
+
+    oov = OoV(grammer)
+    oov.get_embeddings(embedding_file)
+    oov.get_bigram(train_sent_file)
+    oov.get_token_matrix(train_file_path + '.embedding.npz')
+    for extra_sent_file in extra_sent_files:
+        oov.update_bigram(extra_sent_file)
+    return grammer, oov
+
+def parse_job(job):
+    '''Parse one sentence in a worker process of parse_batch, with the models of WORKER_MODELS
+    -------------------------------------
+        Input:
+            job: the index and the sentence to parse
+    -------------------------------------
+        Return:
+            the index, the parsing result under the output bracket format and the record of the sentence (None without tracing)
+    '''
+    i, sent = job
+    grammer, oov, parse, options, trace = WORKER_MODELS
+    probe = Probe() if trace else None
+    res = parse_sentence(sent, grammer, oov, parse, options, probe)
+    return i, res, probe.end() if trace else None
+
+def parse_batch(sentences, grammer, oov, parse, options, workers, sink=None):
+    '''Parse sentences with several worker processes.
+        The workers are forked after the models are built, so they share them without pickling.
+        The longest sentences are scheduled first, so that no long sentence is left alone at the end of the batch.
+    -------------------------------------
+        Input:
+            sentences: the list of sentences to parse
+            grammer: the PCFG object
+            oov: the out of vocabulary object
+            parse: the parsing engine, from parser.ENGINES
+            options: the keyword arguments of the parsing engine
+            workers: the number of worker processes
+            sink: the function called with the record of each sentence, in the order of the input sentences, None to not trace the parses
+    -------------------------------------
+        Return:
+            the list of parsing results under the output bracket format, in the order of the input sentences
+    '''
+    global WORKER_MODELS
+    WORKER_MODELS = (grammer, oov, parse, options, sink is not None)
+    order = sorted(range(len(sentences)), key=lambda i: -len(sentences[i].split(' ')))
+    results = [None] * len(sentences)
+    records = [None] * len(sentences)
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        for i, res, record in pool.imap_unordered(parse_job, [(i, sentences[i]) for i in order], chunksize=1):
+            results[i] = res
+            records[i] = record
+    WORKER_MODELS = None
+    if sink is not None:
+        for record in records:
+            sink(record)
+    return results
+
+def parse_sentence(sent, grammer, oov, parse, options, probe=None):
+    '''Parse a sentence and turn the result into the output bracket format
+    -------------------------------------
+        Input:
+            sent: the sentence to parse
+            grammer: the PCFG object
+            oov: the out of vocabulary object
+            parse: the parsing engine, from parser.ENGINES
+            options: the keyword arguments of the parsing engine
+            probe: the Probe timing the phases, None to disable it. The record of the sentence is started here, and ended by the caller.
+    -------------------------------------
+        Return:
+            the parsing result under the output bracket format
+    '''
+    if probe is None:
+        s, p = parse(sent, grammer, oov, **options)
+        return to_bracket(s)
+    probe.begin(sent)
+    s, p = parse(sent, grammer, oov, probe=probe, **options)
+    with probe.timer('output'):
+        return to_bracket(s)
+
+def parse_stream(lines, out, grammer, oov, parse, options, skip_errors=False, probe=None):
+    '''Parse the sentences one by one as they are read, and write and flush each result as soon as it is ready
+    -------------------------------------
+        Input:
+            lines: an iterable of sentences, such as an open file
+            out: the text stream to write the results to
+            grammer: the PCFG object
+            oov: the out of vocabulary object
+            parse: the parsing engine, from parser.ENGINES
+            options: the keyword arguments of the parsing engine
+            skip_errors: if True, a sentence which can not be parsed gives an empty line and an error message on stderr, instead of an exception
+            probe: the Probe recording each sentence, None to not trace the parses
+    -------------------------------------
+        Do not return anything, but writes one line to out for each sentence
+    '''
+    for line in lines:
+        sent = line.strip()
+        if len(sent) == 0:
+            out.write('\n')
+            out.flush()
+            continue
+        try:
+            res = parse_sentence(sent, grammer, oov, parse, options, probe)
+        except Exception as e:
+            if probe is not None and probe.record is not None:
+                probe.end('error')
+            if not skip_errors:
+                raise
+            print("Error: can not parse '" + sent + "': " + repr(e), file=sys.stderr)
+            res = ''
+        else:
+            if probe is not None:
+                probe.end()
+        out.write(res + '\n')
+        out.flush()
+
+def open_trace(trace):
+    '''Get the Probe writing the records of the sentences as json lines to a file
+    -------------------------------------
+        Input:
+            trace: the path to the trace file, '-' for stderr, None to not trace the parses
+    -------------------------------------
+        Return:
+            the Probe and the opened file, None, None if trace is None
+    '''
+    if trace is None:
+        return None, None
+    stream = sys.stderr if trace == '-' else open(trace, 'w')
+    return Probe(json_lines_sink(stream)), stream
+
+def status_sink(summary, sink=None):
+    '''Get a sink counting the status of the records and keeping the largest time of a sentence in summary, which then passes them to sink'''
+    def count(record):
+        summary[record['status']] = summary.get(record['status'], 0) + 1
+        summary['max_time'] = max(summary.get('max_time', 0.), record['time'])
+        if sink is not None:
+            sink(record)
+    return count
+
+def engine_options(beam_size=None, beam_threshold=None, coarse_threshold=None, time_budget=None, max_work=None):
+    '''Get the keyword arguments of the parsing engine from the pruning settings, leaving out the settings which are None'''
+    options = {}
+    if beam_size is not None:
+        options['beam_size'] = beam_size
+    if beam_threshold is not None:
+        options['beam_threshold'] = beam_threshold
+    if coarse_threshold is not None:
+        options['coarse_threshold'] = coarse_threshold
+    if time_budget is not None:
+        options['time_budget'] = time_budget
+    if max_work is not None:
+        options['max_work'] = max_work
+    return options
+
+def main(test_file_path, train_file_path='./data/train', train_sent_file='./data/train_sent', output_file='evaluation_data2.parser_output', engine='pcyk', beam_size=None, beam_threshold=None, coarse_threshold=None, time_budget=None, max_work=None, workers=1, oov_cache=None, trace=None, gold_file=None, prm_file=None, extra_sents=(), grammar_settings=None):
     '''main function to do the parsing task
     -------------------------------------
         Input:
@@ -57,42 +249,195 @@ def main(test_file_path, train_file_path='./data/train', train_sent_file='./data
             train_file_path: the path to the training file. 
             train_sent_file: the path to the training sentence file
             output_file: the path to the output file containing the parsing results on test file
+            engine: the name of the parsing engine in parser.ENGINES, 'pcyk' or 'vectorized'
+            beam_size: the number of tags kept for each span by the 'vectorized' engine, None to keep all of them
+            beam_threshold: the margin in log probability below the best tag of a span under which the 'vectorized' engine prunes the tags, None for no margin
+            coarse_threshold: the smallest posterior probability of the cells of the coarse grammar in which the 'vectorized' engine keeps the fine tags, None to not parse coarse-to-fine
+            time_budget: the largest time spent by the 'vectorized' engine on a sentence, in seconds, after which it prunes more and
+                         finally builds the tree from the partial chart, None for no bound
+            max_work: the largest number of rules scored by the 'vectorized' engine on a sentence by each pruning stage, None for no bound
+            workers: the number of processes parsing the sentences in parallel, and counting the training trees when the grammar is created
+            oov_cache: the path to the file keeping the resolutions of the unseen words between runs, None to not keep them
+            trace: the path to the file receiving one json record (phase times, counters, unseen words) per sentence, '-' for stderr, None to not trace
+            gold_file: the path to the gold trees of the test file, to score the results in-process as evalb does, None to not score them
+            prm_file: the path to the evalb parameter file of the scoring, None for the settings of EVALB/COLLINS.prm
+            extra_sents: the paths to the sentences of the treebank files added to the grammar by update_grammar.py
+            grammar_settings: the build settings of the grammar given to Grammer(), None for the default settings
     -------------------------------------
-        Do not return anything, but write the results to the output file
+        Do not return anything, but write the results to the output file, and print the scores if gold_file is given
     '''
-    if not os.path.exists('./processed_data'):
-        preprocess("./raw_data", './processed_data')
-
+    # the raw data is preprocessed and split in a single pass
     if not os.path.exists(train_file_path):
-        split('train', 'train_sent', 'dev', 'dev_res', 'test', 'test_res', 'processed_data')
-
-    grammer = Grammer()
-    grammer.create_pcfg(train_file_path)
+        if os.path.exists('./processed_data'):
+            split('train', 'train_sent', 'dev', 'dev_res', 'test', 'test_res', './processed_data')
+        else:
+            split('train', 'train_sent', 'dev', 'dev_res', 'test', 'test_res', './raw_data', processed_filename='./processed_data', clean=True)
 
-    oov = OoV(grammer)
-    oov.get_embeddings('./embedding/polyglot-fr.pkl')
-    oov.get_bigram(train_sent_file)
+    grammer, oov = build_models(train_file_path, train_sent_file, extra_sent_files=extra_sents, workers=workers, grammar_settings=grammar_settings)
+    if oov_cache is not None:
+        oov.load_cache(oov_cache)
 
+    parse = ENGINES[engine]
+    options = engine_options(beam_size, beam_threshold, coarse_threshold, time_budget, max_work)
+    probe, trace_file = open_trace(trace)
+    # under a budget, the status of the sentences are counted even without trace
+    summary = None
+    if time_budget is not None or max_work is not None:
+        summary = {}
+        probe = Probe(status_sink(summary, probe.sink if probe is not None else None))
     pred = open(output_file, 'w')
-    dev = open(test_file_path, 'r').read().splitlines()
-    for i, line in enumerate(dev):
-        sent = line.strip()
-        s, p = PCYK(sent, grammer, oov)
-        s = '( ' + s + ')'
-        t = Tree.fromstring(s)
-        t.un_chomsky_normal_form(unaryChar='_')
-        res = flat_print(t)
-        pred.write(res + '\n')
+    if workers > 1:
+        dev = open(test_file_path, 'r').read().splitlines()
+        for res in parse_batch([line.strip() for line in dev], grammer, oov, parse, options, workers, probe.sink if probe is not None else None):
+            pred.write(res + '\n')
+    else:
+        with open(test_file_path, 'r') as dev:
+            parse_stream(dev, pred, grammer, oov, parse, options, probe=probe)
     pred.close()
+    if trace_file is not None and trace_file is not sys.stderr:
+        trace_file.close()
+    if summary is not None:
+        print('Budget: ' + ', '.join('{} {}'.format(summary.get(status, 0), status) for status in ['ok', 'pruned', 'fallback', 'no_parse', 'error'])
+              + ', slowest sentence {:.2f} s'.format(summary.get('max_time', 0.)), file=sys.stderr)
+    if gold_file is not None:
+        params = read_parameters(prm_file) if prm_file is not None else COLLINS_PARAMETERS
+        results, summary, summary_cut = score_files(gold_file, output_file, params, workers)
+        print(format_results(results, summary, summary_cut, params['CUTOFF_LEN']))
+    # the workers resolve the unseen words in their own copy of the caches
+    if oov_cache is not None and workers <= 1:
+        oov.save_cache(oov_cache)
+
+def serve(address, train_file_path='./data/train', train_sent_file='./data/train_sent', engine='pcyk', beam_size=None, beam_threshold=None, coarse_threshold=None, time_budget=None, max_work=None, oov_cache=None, trace=None, extra_sents=(), grammar_settings=None):
+    '''Long-running parsing service: the models are built once, then the sentences are read line by line and
+       each parse is written and flushed as soon as it is ready.
+    -------------------------------------
+        Input:
+            address: '-' to read from stdin and write to stdout, else the path of a local (unix) socket to listen on,
+                     each connection sends sentences and receives the parses, one per line
+            train_file_path: the path to the training file
+            train_sent_file: the path to the training sentence file
+            engine: the name of the parsing engine in parser.ENGINES, 'pcyk' or 'vectorized'
+            beam_size: the number of tags kept for each span by the 'vectorized' engine, None to keep all of them
+            beam_threshold: the margin in log probability below the best tag of a span under which the 'vectorized' engine prunes the tags, None for no margin
+            coarse_threshold: the smallest posterior probability of the cells of the coarse grammar in which the 'vectorized' engine keeps the fine tags, None to not parse coarse-to-fine
+            time_budget: the largest time spent by the 'vectorized' engine on a sentence, in seconds, after which it prunes more and
+                         finally builds the tree from the partial chart, None for no bound
+            max_work: the largest number of rules scored by the 'vectorized' engine on a sentence by each pruning stage, None for no bound
+            oov_cache: the path to the file keeping the resolutions of the unseen words between runs, None to not keep them
+            trace: the path to the file receiving one json record (phase times, counters, unseen words) per sentence, '-' for stderr, None to not trace
+            extra_sents: the paths to the sentences of the treebank files added to the grammar by update_grammar.py
+            grammar_settings: the build settings of the grammar given to Grammer(), None for the default settings
+    -------------------------------------
+        Do not return anything, runs until the end of stdin or until interrupted
+    '''
+    grammer, oov = build_models(train_file_path, train_sent_file, extra_sent_files=extra_sents, grammar_settings=grammar_settings)
+    if oov_cache is not None:
+        oov.load_cache(oov_cache)
+    parse = ENGINES[engine]
+    options = engine_options(beam_size, beam_threshold, coarse_threshold, time_budget, max_work)
+    probe, trace_file = open_trace(trace)
+
+    class ParseHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            lines = (line.decode('utf-8') for line in self.rfile)
+            out = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+            parse_stream(lines, out, grammer, oov, parse, options, skip_errors=True, probe=probe)
+
+    try:
+        if address == '-':
+            parse_stream(sys.stdin, sys.stdout, grammer, oov, parse, options, skip_errors=True, probe=probe)
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            with socketserver.UnixStreamServer(address, ParseHandler) as server:
+                print("Listening on " + address, file=sys.stderr)
+                server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if address != '-' and os.path.exists(address):
+            os.remove(address)
+        if oov_cache is not None:
+            oov.save_cache(oov_cache)
+        if trace_file is not None and trace_file is not sys.stderr:
+            trace_file.close()
+
+def pop_option(args, name, default, choices=None):
+    '''Get the value of an option like '--name value' from the command line arguments, and remove it from them
+    -----------------------------------
+        Input:
+            args: the list of command line arguments, updated in place
+            name: the name of the option, such as '--engine'
+            default: the value to return if the option is not given
+            choices: the list of the accepted values, None to accept any value
+    -----------------------------------
+        Return:
+            the value of the option
+    '''
+    if name not in args:
+        return default
+    idx = args.index(name)
+    if idx + 1 >= len(args) or (choices is not None and args[idx+1] not in choices):
+        print("Error: " + name + " should be one of " + ', '.join(choices) + "!" if choices is not None else "Error: " + name + " needs a value!")
+        sys.exit(1)
+    value = args[idx+1]
+    del args[idx:idx+2]
+    return value
 
 
 if __name__ == "__main__":
-    args = sys.argv
+    args = list(sys.argv)
+    engine = pop_option(args, '--engine', 'pcyk', ENGINES.keys())
+    beam_size = pop_option(args, '--beam-size', None)
+    beam_threshold = pop_option(args, '--beam-threshold', None)
+    coarse_threshold = pop_option(args, '--coarse-threshold', None)
+    time_budget = pop_option(args, '--time-budget', None)
+    max_work = pop_option(args, '--max-work', None)
+    workers = int(pop_option(args, '--workers', 1))
+    oov_cache = pop_option(args, '--oov-cache', None)
+    address = pop_option(args, '--serve', None)
+    trace = pop_option(args, '--trace', None)
+    gold_file = pop_option(args, '--gold', None)
+    prm_file = pop_option(args, '--prm', None)
+    extra_sents = pop_option(args, '--extra-sents', None)
+    horz_markov = pop_option(args, '--horz-markov', None)
+    vert_markov = pop_option(args, '--vert-markov', 0)
+    min_count = pop_option(args, '--min-count', 1)
+    top_n = pop_option(args, '--top-n', None)
+    if engine != 'vectorized' and (beam_size is not None or beam_threshold is not None or coarse_threshold is not None or time_budget is not None or max_work is not None):
+        print("Error: the beam, coarse-to-fine pruning and budgets are only available with the vectorized engine!")
+        sys.exit(1)
+    options = {'engine': engine,
+               'beam_size': int(beam_size) if beam_size is not None else None,
+               'beam_threshold': float(beam_threshold) if beam_threshold is not None else None,
+               'coarse_threshold': float(coarse_threshold) if coarse_threshold is not None else None,
+               'time_budget': float(time_budget) if time_budget is not None else None,
+               'max_work': int(float(max_work)) if max_work is not None else None,
+               'workers': workers,
+               'oov_cache': oov_cache,
+               'trace': trace,
+               'extra_sents': extra_sents.split(',') if extra_sents is not None else (),
+               'grammar_settings': {'horz_markov': int(horz_markov) if horz_markov is not None else None,
+                                    'vert_markov': int(vert_markov),
+                                    'min_count': int(min_count),
+                                    'top_n': int(top_n) if top_n is not None else None}}
+    if address is not None:
+        if gold_file is not None or prm_file is not None:
+            print("Error: --gold and --prm are not available with --serve!")
+            sys.exit(1)
+        if len(args) != 1 and len(args) != 3:
+            print("Error: do not have correct number of arguments (expected 0 or 2 with --serve)!")
+            sys.exit(1)
+        del options['workers']
+        serve(address, *args[1:], **options)
+        sys.exit(0)
     if len(args) <= 1:
         print("Error: please give the test file path!")
     if len(args) != 2 and len(args) != 5:
         print("Error: do not have correct number of arguments (expected 1 or 4)!")
+    options['gold_file'] = gold_file
+    options['prm_file'] = prm_file
     if len(args) == 2:
-        main(args[1])
+        main(args[1], **options)
     if len(args) == 5:
-        main(args[1], args[2], args[3], args[4])
+        main(args[1], args[2], args[3], args[4], **options)
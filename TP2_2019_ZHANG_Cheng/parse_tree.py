@@ -0,0 +1,233 @@
+###################################################################################################################
+# This python file defines the compact tree built by the CYK engines from their backpointers, and its iterative #
+# conversion to the output bracket format, without going through nltk. It also builds the fallback tree of a    #
+# partial chart.                                                                                                #
+###################################################################################################################
+
+import numpy as np
+
+class ParseTree(object):
+    '''The class ParseTree stores a parse tree as flat lists, node 0 being the root:
+        --- self.labels[i]: the label of the node i
+        --- self.children[i]: the children of the node i, a child c >= 0 is the node c and a child c < 0 is the word ~c
+        --- self.words: the words of the sentence
+       All the methods are iterative, so that deep trees do not reach the recursion limit.
+    '''
+    def __init__(self, words, labels=None, children=None):
+        '''Init a tree
+        ---------------------------
+            Input:
+                words: the words of the sentence
+                labels, children: the nodes of the tree, None for an empty tree
+        ---------------------------
+        '''
+        self.words = words
+        self.labels = labels if labels is not None else []
+        self.children = children if children is not None else []
+
+    def add_node(self, label):
+        '''Add a node without children
+        ---------------------------
+            Input:
+                label: the label of the node
+        ---------------------------
+            Return:
+                the id of the node
+        '''
+        self.labels.append(label)
+        self.children.append([])
+        return len(self.labels) - 1
+
+    def graft(self, other):
+        '''Copy the nodes of another tree over the same words into this tree
+        ---------------------------
+            Input:
+                other: the ParseTree to copy
+        ---------------------------
+            Return:
+                the id of the root of the copy, which is not attached to any node
+        '''
+        offset = len(self.labels)
+        self.labels.extend(other.labels)
+        self.children.extend([[c + offset if c >= 0 else c for c in children] for children in other.children])
+        return offset
+
+    def bracket(self, node=0):
+        '''Write a subtree under the bracket format '(label child child ...)'
+        ---------------------------
+            Input:
+                node: the root of the subtree
+        ---------------------------
+            Return:
+                the string of the subtree
+        '''
+        out = []
+        stack = [node]
+        while stack:
+            item = stack.pop()
+            if type(item) is str:
+                out.append(item)
+            elif item < 0:
+                out.append(self.words[~item])
+            else:
+                out.append('(' + self.labels[item] + ' ')
+                stack.append(')')
+                children = self.children[item]
+                for i in range(len(children) - 1, 0, -1):
+                    stack.append(children[i])
+                    stack.append(' ')
+                if len(children) > 0:
+                    stack.append(children[0])
+        return ''.join(out)
+
+    def __str__(self):
+        '''The bracket format of the tree'''
+        return self.bracket()
+
+    def un_chomsky_normal_form(self, childChar='|', parentChar='^', unaryChar='_'):
+        '''Undo the Chomsky normal form as nltk.Tree.un_chomsky_normal_form does:
+            the artificial nodes (whose label contains childChar) are replaced by their children,
+            the parent annotations (after parentChar) are removed, and the collapsed unary rules (joined by unaryChar) are expanded.
+        ---------------------------
+            Return:
+                a new ParseTree
+        '''
+        tree = ParseTree(self.words)
+        if len(self.labels) == 0:
+            return tree
+        stack = [(0, tree.add_node(''))]
+        while stack:
+            node, new = stack.pop()
+            # the labels of a collapsed unary chain, each one stripped of its parent annotation
+            label = self.labels[node]
+            chain = []
+            while True:
+                i = label.find(parentChar)
+                if i != -1:
+                    label = label[:i]
+                i = label.find(unaryChar)
+                if i == -1:
+                    break
+                chain.append(label[:i])
+                label = label[i+1:]
+            chain.append(label)
+            tree.labels[new] = chain[0]
+            for label in chain[1:]:
+                child = tree.add_node(label)
+                tree.children[new].append(child)
+                new = child
+
+            # replace the artificial children by their own children, in order
+            pending = list(reversed(self.children[node]))
+            while pending:
+                child = pending.pop()
+                if child >= 0 and self.labels[child].find(childChar) != -1:
+                    pending.extend(reversed(self.children[child]))
+                elif child < 0:
+                    tree.children[new].append(child)
+                else:
+                    new_child = tree.add_node('')
+                    tree.children[new].append(new_child)
+                    stack.append((child, new_child))
+        return tree
+
+    def to_bracket(self):
+        '''Get the output bracket format of a tree in Chomsky normal form: the tree is de-binarized and put under an unlabelled root
+        ---------------------------
+            Return:
+                the string written to the output file, the same as with nltk
+        '''
+        return '( ' + self.un_chomsky_normal_form().bracket() + ')'
+
+
+def build_tree(chart, words, low, high, tag, id2tags):
+    '''Build the tree by back tracking the results of CYK algorithm, with an explicit stack
+    -------------------------------------
+        Input:
+            chart: the resultant Chart of CYK algorithm
+            words: the list of words in the sentence
+            low: the lowest index to consider
+            high: the highest index to consider
+            tag: the id of the tag to consider
+            id2tags: the dictionary mapping id to tags
+    -------------------------------------
+        Return:
+            the ParseTree of the span between the low and high indexes
+    '''
+    tree = ParseTree(words)
+    stack = [(tree.add_node(id2tags[tag]), low, high, tag)]
+    while stack:
+        node, low, high, tag = stack.pop()
+        idx = chart.find(low, high, tag)
+        length = high - low
+        if idx < 0 or chart.lefts[length][idx] < 0:
+            tree.children[node].append(~low)
+            continue
+        k, B, C = int(chart.splits[length][idx]), int(chart.lefts[length][idx]), int(chart.rights[length][idx])
+        left = tree.add_node(id2tags[B])
+        tree.children[node].append(left)
+        stack.append((left, low, k, B))
+        if C >= 0:
+            right = tree.add_node(id2tags[C])
+            tree.children[node].append(right)
+            stack.append((right, k, high, C))
+    return tree
+
+
+def fallback_tree(chart, words, max_length, id2tags, root='SENT', lexical=None):
+    '''Build a tree from a partial chart, whose spans are only filled up to max_length:
+        the sentence is cut into the fewest spans with a non-empty cell (then into the ones with the best scores),
+        the best tag of each span is built from the backpointers, and the subtrees are put under a flat root.
+        A word without any cell (removed by the coarse pruning, or a chart stopped before its words) is a span on its own:
+        its best tag in lexical over the word, or the bare word under the root when it has none.
+    -------------------------------------
+        Input:
+            chart: the partial Chart, in log probabilities
+            words: the list of words in the sentence
+            max_length: the length of the longest spans stored in the chart, 0 if no span is stored
+            id2tags: the dictionary mapping id to tags
+            root: the label of the root
+            lexical: the log probabilities of the tags of each word, shape (n, |tags|), None to put the words without cell under the root
+    -------------------------------------
+        Return:
+            the ParseTree covering the whole sentence
+    '''
+    n = len(words)
+    # best[j]: the number of spans, the number of words without cell and the score of the best cut of the words before j,
+    # back[j]: the last span of the cut and its tag, None for a word without cell
+    best = [(0, 0, 0.)] + [(n + 1, 0, 0.)] * n
+    back = [None] * (n + 1)
+    for high in range(1, n + 1):
+        for length in range(1, min(max_length, high) + 1):
+            low = high - length
+            begin, end = chart.ptr[length][low], chart.ptr[length][low+1]
+            if begin == end or best[low][0] > n:
+                continue
+            idx = begin + int(np.argmax(chart.scores[length][begin:end]))
+            candidate = (best[low][0] + 1, best[low][1], best[low][2] - chart.scores[length][idx])
+            if candidate < best[high]:
+                best[high] = candidate
+                back[high] = (low, int(chart.tags[length][idx]))
+        candidate = (best[high-1][0] + 1, best[high-1][1] + 1, best[high-1][2])
+        if candidate < best[high]:
+            best[high] = candidate
+            back[high] = (high - 1, None)
+
+    spans = []
+    high = n
+    while high > 0:
+        low, tag = back[high]
+        spans.append((low, high, tag))
+        high = low
+    tree = ParseTree(words)
+    tree.add_node(root)
+    for low, high, tag in reversed(spans):
+        if tag is not None:
+            tree.children[0].append(tree.graft(build_tree(chart, words, low, high, tag, id2tags)))
+        elif lexical is not None and np.isfinite(lexical[low]).any():
+            node = tree.add_node(id2tags[int(np.argmax(lexical[low]))])
+            tree.children[node].append(~low)
+            tree.children[0].append(node)
+        else:
+            tree.children[0].append(~low)
+    return tree
@@ -4,47 +4,168 @@
 
 import numpy as np
 from OOV import *
+from parse_tree import build_tree, fallback_tree
+from probe import phase
 import collections
+import time
 
-def build_tree(back, words, low, high, tag, tags_dict):
-    '''Build the tree by back tracking the results of CYK algorithm
-        Implemented by recursive function
-    -------------------------------------
+# The maximum number of rule scores computed at once by the vectorized engine, to bound its memory
+MAX_SCORES = 1 << 22
+
+# The stages of the parse of a sentence under a budget: the fraction of the time budget at which the stage is stopped,
+# and the pruning it adds to the pruning of the engine. When the last stage is stopped, the tree is built from the partial chart.
+BUDGET_STAGES = [(0.4, {}), (0.7, {'beam_size': 50}), (1., {'beam_size': 10})]
+
+class BudgetExceeded(Exception):
+    '''Raised when the budget of a sentence is exhausted while its chart is filled
+        --- self.chart: the partial Chart
+        --- self.length: the length of the longest spans stored in the chart
+    '''
+    def __init__(self, chart, length):
+        Exception.__init__(self, 'budget exceeded after the spans of length {}'.format(length))
+        self.chart = chart
+        self.length = length
+
+class Chart(object):
+    '''The class Chart stores the results of the CYK algorithm, only for the non-empty cells.
+        The cells of all spans of a same length are packed into typed arrays, sorted by start index and tag id:
+        --- self.ptr[length]: the offset of the cells of each span (low, low + length), of shape (n - length + 2,)
+        --- self.lows[length], self.tags[length], self.scores[length]: the start index, the tag id and the score of each cell
+        --- self.splits[length], self.lefts[length], self.rights[length]: the backpointer of each cell,
+            the split index, left child id and right child id, all -1 for a leaf, right child -1 for a unary rule
+    '''
+    def __init__(self, n, empty=-np.inf):
+        '''Init an empty chart
+        --------------------------------
+            Input:
+                n: the number of words in the sentence
+                empty: the score of an empty cell, 0 for probabilities and -inf for log probabilities
+        '''
+        self.n = n
+        self.empty = empty
+        self.ptr = {}
+        self.lows = {}
+        self.tags = {}
+        self.scores = {}
+        self.splits = {}
+        self.lefts = {}
+        self.rights = {}
+
+    def store(self, length, cells, splits, lefts, rights):
+        '''Store the cells of all spans of a length, keeping only the non-empty ones
+        --------------------------------
+            Input:
+                length: the length of the spans
+                cells: the scores of the spans (low, low + length) for all low, shape (n - length + 1, |tags|)
+                splits, lefts, rights: the backpointers of the spans, of the same shape
+        '''
+        rows, tags = np.nonzero(cells > self.empty)
+        self.ptr[length] = np.searchsorted(rows, np.arange(len(cells) + 1)).astype(np.int32)
+        self.lows[length] = rows.astype(np.int32)
+        self.tags[length] = tags.astype(np.int32)
+        self.scores[length] = cells[rows, tags]
+        self.splits[length] = splits[rows, tags].astype(np.int32)
+        self.lefts[length] = lefts[rows, tags].astype(np.int32)
+        self.rights[length] = rights[rows, tags].astype(np.int32)
+
+    def find(self, low, high, tag):
+        '''Find a cell
+        --------------------------------
+            Input:
+                low, high: the span of the cell
+                tag: the tag id of the cell
+        --------------------------------
+            Return:
+                the index of the cell in the arrays of its length, -1 if the cell is empty
+        '''
+        length = high - low
+        begin, end = self.ptr[length][low], self.ptr[length][low+1]
+        idx = begin + np.searchsorted(self.tags[length][begin:end], tag)
+        if idx < end and self.tags[length][idx] == tag:
+            return idx
+        return -1
+
+    def score(self, low, high, tag):
+        '''Get the score of a cell, self.empty if the cell is empty'''
+        idx = self.find(low, high, tag)
+        if idx < 0:
+            return self.empty
+        return self.scores[high - low][idx]
+
+    def row(self, low, high, size):
+        '''Get the scores of all tags of a span as a dense vector of length size'''
+        length = high - low
+        begin, end = self.ptr[length][low], self.ptr[length][low+1]
+        row = np.full(size, self.empty)
+        row[self.tags[length][begin:end]] = self.scores[length][begin:end]
+        return row
+
+    def gather(self, length, first, count, pos, width):
+        '''Get the scores of consecutive spans of a length as a dense matrix over a subset of the tags
+        --------------------------------
+            Input:
+                length: the length of the spans
+                first, count: the spans are (low, low + length) for low in [first, first + count)
+                pos: the column of each tag id in the result, -1 for the tags which are not needed
+                width: the number of columns of the result
+        --------------------------------
+            Return:
+                the scores, shape (count, width)
+        '''
+        begin, end = self.ptr[length][first], self.ptr[length][first+count]
+        cols = pos[self.tags[length][begin:end]]
+        keep = np.flatnonzero(cols >= 0)
+        result = np.full((count, width), self.empty)
+        result[self.lows[length][begin:end][keep] - first, cols[keep]] = self.scores[length][begin:end][keep]
+        return result
+
+    def nbytes(self):
+        '''Get the memory used by the chart arrays, in bytes'''
+        return sum(a.nbytes for d in [self.ptr, self.lows, self.tags, self.scores, self.splits, self.lefts, self.rights] for a in d.values())
+
+
+def resolve_word(words, j, token_tags_dict, oov, probe=None):
+    '''Get the token of the grammar to use for the j-th word (1-indexed) of the sentence.
+    --------------------------------
         Input:
-            back: the resultant table of CYK algorithm
             words: the list of words in the sentence
-            low: the lowest index to consider
-            high: the highest index to consider
-            tag: the tag to consider
-            tags_dict: the dictionary mapping tags to id, so that we can find the corresponding index of the tag in the back table
-    -------------------------------------
+            j: the position of the word, starting from 1
+            token_tags_dict: the dictionary mapping tokens to their tags in the grammar
+            oov: the out of vocabulary object
+            probe: the Probe recording the unseen words and their tokens, None to not record them
+    --------------------------------
         Return:
-            a string of the parsing result between the low and high indexes, under the bracket format
+            the word itself if it is in the grammar, else the similar token assigned by the OoV module
     '''
-    if back[low, high, tags_dict[tag]] is None:
-        s = '(' + tag + ' ' + words[low] + ')'
-        return s
-    else:
-        k, B, C = back[low, high, tags_dict[tag]]
-        left = build_tree(back, words, low, k, B, tags_dict)
-        right = ''
-        if C is not None:
-            right = build_tree(back, words, k, high, C, tags_dict)
-        if right != '':
-            return '(' + tag + ' ' + left + ' ' + right + ')'
-        return '(' + tag + ' ' + left + ')'       
+    word = words[j-1]
+    if word not in token_tags_dict.keys():
+        original = word
+        if j == 1:
+            prev_word = None
+        else:
+            prev_word = words[j-2]
+        if j == len(words):
+            next_word = None
+        else:
+            next_word = words[j]
+        word = oov.assign_similar_token(word, prev_word, next_word, probe=probe)
+        if probe is not None:
+            probe.count('oov_words')
+            probe.oov(original, word)
+    return word
 
 
-def PCYK(sentence, grammer, oov):
+def PCYK(sentence, grammer, oov, probe=None):
     '''Probabilistic CYK algorithm
     --------------------------------
         Input:
             sentence: the sentence to parse
             grammer: the PCFG object
             oov: the out of vocabulary object
+            probe: the Probe timing the phases and counting the work, None to disable it
     --------------------------------
         Return:
-            the string of parsing result, under bracket format
+            the ParseTree of the parsing result, in Chomsky normal form, and its probability
     '''
     words = sentence.strip().split(' ')
     # print(words)
@@ -54,44 +175,557 @@ def PCYK(sentence, grammer, oov):
     lhs_rhs_prob = grammer.lhs_rhs_prob
     lhs_rhss_dict = grammer.lhs_rhss_dict
    
-    table = np.zeros((len(words), len(words)+1, len(tags_dict.keys())))
-    back = [[[None for i in range(len(tags_dict.keys()))] for j in range(len(words)+1)] for l in range(len(words))]
-    back = np.array(back)
-
-    for j in range(1, len(words)+1):
-        word = words[j-1]
-        if word not in token_tags_dict.keys():
-            print("original word: " + word)
-            if j == 1:
-                prev_word = None
-            else:
-                prev_word = words[j-2]
-            if j == len(words):
-                next_word = None
-            else:
-                next_word = words[j]
-            word = oov.assign_similar_token(word, prev_word, next_word)
-            print("similar word: " + word)
-        tags = token_tags_dict[word]
-        for tag in tags:
-            table[j-1, j, tags_dict[tag]] = token_tag_prob[(word, tag)]
-        
-        for i in range(j-1, -1, -1):
-            for lhs, rhss in lhs_rhss_dict.items():
-                for rhs in rhss:
-                    if type(rhs) is tuple:
-                        B = rhs[0]
-                        C = rhs[1]
-                        for k in range(i+1, j):
-                            if table[i, k, tags_dict[B]] > 0 and table[k, j, tags_dict[C]] > 0:
-                                if table[i, j, tags_dict[lhs]] < lhs_rhs_prob[(lhs, rhs)] * table[i, k, tags_dict[B]] * table[k, j, tags_dict[C]]:
-                                    table[i, j, tags_dict[lhs]] = lhs_rhs_prob[(lhs, rhs)] * table[i, k, tags_dict[B]] * table[k, j, tags_dict[C]]
-                                    back[i, j, tags_dict[lhs]] = (k, B, C)
-                    else:
-                        if table[i, j, tags_dict[rhs]] > 0:
-                            if table[i, j, tags_dict[lhs]] < lhs_rhs_prob[(lhs, rhs)] * table[i, j, tags_dict[rhs]]:
-                                table[i, j, tags_dict[lhs]] = lhs_rhs_prob[(lhs, rhs)] * table[i, j, tags_dict[rhs]]
-                                back[i, j, tags_dict[lhs]] = (j, rhs, None)
-        
-    return build_tree(back, words, 0, len(words), 'SENT', tags_dict), table[0, len(words), tags_dict['SENT']]
+    n = len(words)
+    T = len(tags_dict)
+    chart = Chart(n, empty=0.)
+
+    lexicons = []
+    with phase(probe, 'lexical'):
+        for j in range(1, n+1):
+            word = resolve_word(words, j, token_tags_dict, oov, probe)
+            lexicons.append([(tags_dict[tag], token_tag_prob[(word, tag)]) for tag in token_tags_dict[word]])
+
+    for length in range(1, n+1):
+        cells = np.zeros((n - length + 1, T))
+        splits = np.full((n - length + 1, T), -1, dtype=np.int32)
+        lefts = np.full((n - length + 1, T), -1, dtype=np.int32)
+        rights = np.full((n - length + 1, T), -1, dtype=np.int32)
+        with phase(probe, 'binary'):
+            for i in range(n - length + 1):
+                j = i + length
+                # the cell of the current span, and the cells of its sub-spans, as dense vectors
+                table, split, left, right = cells[i], splits[i], lefts[i], rights[i]
+                if length == 1:
+                    for tag, prob in lexicons[i]:
+                        table[tag] = prob
+                left_rows = [chart.row(i, k, T) for k in range(i+1, j)]
+                right_rows = [chart.row(k, j, T) for k in range(i+1, j)]
+                for lhs, rhss in lhs_rhss_dict.items():
+                    A = tags_dict[lhs]
+                    for rhs in rhss:
+                        # the unary rules are applied below, by their closure
+                        if type(rhs) is tuple:
+                            B = tags_dict[rhs[0]]
+                            C = tags_dict[rhs[1]]
+                            for k in range(i+1, j):
+                                if left_rows[k-i-1][B] > 0 and right_rows[k-i-1][C] > 0:
+                                    if table[A] < lhs_rhs_prob[(lhs, rhs)] * left_rows[k-i-1][B] * right_rows[k-i-1][C]:
+                                        table[A] = lhs_rhs_prob[(lhs, rhs)] * left_rows[k-i-1][B] * right_rows[k-i-1][C]
+                                        split[A], left[A], right[A] = k, B, C
+        with phase(probe, 'unary'):
+            apply_unary_closure(grammer, cells, splits, lefts, rights, np.arange(length, n+1), log=False)
+        chart.store(length, cells, splits, lefts, rights)
+        if probe is not None:
+            # every binary rule is tried at every split point of every span
+            probe.count('rules', (n - length + 1) * (length - 1) * len(grammer.binary_parent))
+            probe.count('cells', np.count_nonzero(cells))
+
+    SENT = tags_dict['SENT']
+    with phase(probe, 'build_tree'):
+        tree = build_tree(chart, words, 0, n, SENT, grammer.id2tags)
+    return tree, chart.score(0, n, SENT)
+
+
+def apply_unary_closure(grammer, cells, splits, lefts, rights, high, log=True):
+    '''Apply the unary rules to a batch of cells at once, with the closure of the unary rules precomputed by the grammar.
+        Each tag A of the unary rules takes the best of its own score and of the best chain A ->* B times the score of B,
+        and points to the next tag of the chain in the same span.
+    --------------------------------
+        Input:
+            grammer: the compiled PCFG object
+            cells, splits, lefts, rights: the scores and backpointers of the cells, shape (batch, |tags|), updated in place
+            high: the end index of each cell, shape (batch,)
+            log: True if the scores are log probabilities, False if they are probabilities
+    --------------------------------
+        Do not return anything, but updates the cells
+    '''
+    U = grammer.unary_tags
+    scores = cells[:, U]
+    if log:
+        chains = grammer.unary_closure[None, :, :] + scores[:, None, :]
+    else:
+        chains = np.exp(grammer.unary_closure)[None, :, :] * scores[:, None, :]
+    # chains[s, a, b]: score of the chain from U[a] to U[b] in the span s
+    best = np.argmax(chains, axis=2)
+    value = np.take_along_axis(chains, best[:, :, None], axis=2)[:, :, 0]
+    rows, cols = np.nonzero(value > scores)
+    tags = U[cols]
+    cells[rows, tags] = value[rows, cols]
+    splits[rows, tags] = high[rows]
+    lefts[rows, tags] = grammer.unary_next[cols, best[rows, cols]]
+    rights[rows, tags] = -1
+
+
+def prune_cells(cells, beam_size=None, beam_threshold=None):
+    '''Viterbi beam pruning of a batch of cells: only the best tags of each span survive.
+    --------------------------------
+        Input:
+            cells: the log probabilities of the cells, shape (batch, |tags|), updated in place
+            beam_size: the number of tags kept for each span, None to keep all of them
+            beam_threshold: the tags whose log probability is below the best one of the span minus beam_threshold are removed, None to keep all of them
+    --------------------------------
+        Do not return anything, but sets the log probability of the pruned tags to -inf
+    '''
+    if beam_threshold is not None:
+        best = np.max(cells, axis=1, keepdims=True)
+        cells[cells < best - beam_threshold] = -np.inf
+    if beam_size is not None and beam_size < cells.shape[1]:
+        kth = -np.partition(-cells, beam_size - 1, axis=1)[:, beam_size-1:beam_size]
+        cells[cells < kth] = -np.inf
+
+
+def score_binary(chart, grammer, length, active, deadline=None):
+    '''Score the active binary rules over all split points, for all spans of a length.
+        The spans are processed by chunks so that the scores never hold more than MAX_SCORES values.
+    --------------------------------
+        Input:
+            chart: the Chart filled for the shorter spans
+            grammer: the compiled PCFG object
+            length: the length of the spans
+            active: the indexes of the binary rules to score
+            deadline: the time.perf_counter() after which BudgetExceeded is raised between two chunks, None for no deadline
+    --------------------------------
+        Return:
+            rule_best: the best log probability of each binary rule for each span, shape (n - length + 1, |binary rules|)
+            rule_split: the split index reaching rule_best
+    '''
+    S = chart.n - length + 1
+    T = len(grammer.tags2id)
+    rule_best = np.full((S, len(grammer.binary_parent)), -np.inf)
+    rule_split = np.zeros((S, len(grammer.binary_parent)), dtype=np.int32)
+    if len(active) == 0:
+        return rule_best, rule_split
+
+    # the children are gathered only for the tags used by the active rules
+    left_tags, left_idx = np.unique(grammer.binary_left[active], return_inverse=True)
+    right_tags, right_idx = np.unique(grammer.binary_right[active], return_inverse=True)
+    left_pos = np.full(T, -1, dtype=np.int32)
+    left_pos[left_tags] = np.arange(len(left_tags))
+    right_pos = np.full(T, -1, dtype=np.int32)
+    right_pos[right_tags] = np.arange(len(right_tags))
+
+    chunk = max(1, MAX_SCORES // ((length - 1) * len(active)))
+    for first in range(0, S, chunk):
+        if deadline is not None and time.perf_counter() > deadline:
+            raise BudgetExceeded(chart, length - 1)
+        count = min(chunk, S - first)
+        left = np.empty((length - 1, count, len(left_tags)))
+        right = np.empty((length - 1, count, len(right_tags)))
+        for m in range(1, length):
+            # left child (low, low + m) and right child (low + m, low + length)
+            left[m-1] = chart.gather(m, first, count, left_pos, len(left_tags))
+            right[m-1] = chart.gather(length - m, first + m, count, right_pos, len(right_tags))
+        # scores of every active binary rule at every split point: (splits, spans, rules)
+        scores = np.take(left, left_idx, axis=2)
+        scores += np.take(right, right_idx, axis=2)
+        scores += grammer.binary_logprob[active]
+        best_k = np.argmax(scores, axis=0)
+        rule_best[first:first+count, active] = np.take_along_axis(scores, best_k[None], axis=0)[0]
+        rule_split[first:first+count, active] = best_k + np.arange(first, first + count)[:, None] + 1
+    return rule_best, rule_split
+
+
+def log_dot(x, matrix):
+    '''Compute log(exp(x).dot(matrix)) without underflow, by scaling each row of x by its maximum
+    --------------------------------
+        Input:
+            x: log values, shape (batch, m)
+            matrix: non-negative weights, shape (m, k)
+    --------------------------------
+        Return:
+            the log of the weighted sums, shape (batch, k), -inf for the empty rows
+    '''
+    m = np.max(x, axis=1, keepdims=True)
+    m[~np.isfinite(m)] = 0.
+    with np.errstate(divide='ignore'):
+        return np.log(np.exp(x - m).dot(matrix)) + m
+
+
+def coarse_posteriors(grammer, lexical, deadline=None, max_work=None, probe=None):
+    '''Compute the posterior probabilities of the cells of the coarse grammar by the inside-outside algorithm.
+        The coarse grammar is small enough for its binary rules to be a dense array, so that both passes are matrix products.
+        Each cell is rescaled by its maximum, and the log of the scale is kept apart, so that long sentences do not underflow.
+        With a deadline or a work budget, the passes are stopped between two lengths as soon as it is exhausted.
+    --------------------------------
+        Input:
+            grammer: the compiled PCFG object, whose coarse grammar is used
+            lexical: the log probabilities of the fine tags of each word, shape (n, |fine tags|)
+            deadline: the time.perf_counter() after which the passes are stopped, None for no deadline
+            max_work: the largest number of products of both passes, counted as the scores of the pairs of children at every split point
+                      and of the rules of every span, None for no bound. The work of a length is known before it is computed.
+            probe: the Probe counting the stopped passes, None to disable it
+    --------------------------------
+        Return:
+            a dict mapping each length to the log posteriors of the coarse labels of the spans of this length, shape (n - length + 1, |coarse labels|),
+            the best of the posterior as the top and as the bottom of the unary chain of the span. None if the coarse grammar can not parse the sentence
+            or if the budget is exhausted.
+    '''
+    coarse = grammer.coarse_grammar()
+    n = len(lexical)
+    C = len(coarse.tags)
+    closure = coarse.unary_closure
+    rules = coarse.binary_tensor.reshape(C, C * C)
+    work = [0]
+
+    def exhausted(length):
+        # the budget check before the passes compute the spans of a length
+        work[0] += (n - length + 1) * ((length - 1) * C * C + C * C * C)
+        if (deadline is not None and time.perf_counter() > deadline) or (max_work is not None and work[0] > max_work):
+            if probe is not None:
+                probe.count('coarse_stopped')
+            return True
+        return False
+
+    def rescale(x):
+        m = np.max(x, axis=-1, keepdims=True)
+        m[~np.isfinite(m)] = 0.
+        return np.exp(x - m), m
+
+    def children(length):
+        # the inside of the left children (low, low + m) and of the right children (low + m, low + length), for all m, shape (length - 1, spans, C)
+        S = n - length + 1
+        left = np.stack([inside_top[m][:S] for m in range(1, length)])
+        right = np.stack([inside_top[length-m][m:m+S] for m in range(1, length)])
+        return rescale(left), rescale(right)
+
+    # inside: inside_bottom before the unary chains of the span, inside_top after them
+    inside_bottom = {1: log_dot(lexical, coarse.fine_onehot)}
+    inside_top = {1: log_dot(inside_bottom[1], closure.T)}
+    for length in range(2, n+1):
+        if exhausted(length):
+            return None
+        S = n - length + 1
+        (left, left_max), (right, right_max) = children(length)
+        scale = left_max + right_max
+        top = np.max(scale, axis=0)
+        left *= np.exp(scale - top)
+        # pairs[s, b, c]: the weight of the children b and c of the span s, summed over the split points
+        pairs = np.matmul(left.transpose(1, 2, 0), right.transpose(1, 0, 2))
+        with np.errstate(divide='ignore'):
+            inside_bottom[length] = np.log(pairs.reshape(S, C * C).dot(rules.T)) + top
+        inside_top[length] = log_dot(inside_bottom[length], closure.T)
+
+    SENT = coarse.tags2id['SENT']
+    Z = inside_top[n][0, SENT]
+    if not np.isfinite(Z):
+        return None
+
+    # outside, from the whole sentence down to the words
+    outside_top = {length: np.full((n - length + 1, C), -np.inf) for length in range(1, n+1)}
+    outside_top[n][0, SENT] = 0.
+    outside_bottom = {}
+    for length in range(n, 0, -1):
+        outside_bottom[length] = log_dot(outside_top[length], closure)
+        if length == 1:
+            break
+        if exhausted(length):
+            return None
+        S = n - length + 1
+        outer, outer_max = rescale(outside_bottom[length])
+        # pairs[s, b, c]: the outside weight of the children b and c of the span s
+        pairs = outer.dot(rules).reshape(S, C, C)
+        (left, left_max), (right, right_max) = children(length)
+        with np.errstate(divide='ignore'):
+            to_left = np.log(np.matmul(right.transpose(1, 0, 2), pairs.transpose(0, 2, 1))).transpose(1, 0, 2) + outer_max + right_max
+            to_right = np.log(np.matmul(left.transpose(1, 0, 2), pairs)).transpose(1, 0, 2) + outer_max + left_max
+        for m in range(1, length):
+            np.logaddexp(outside_top[m][:S], to_left[m-1], out=outside_top[m][:S])
+            np.logaddexp(outside_top[length-m][m:m+S], to_right[m-1], out=outside_top[length-m][m:m+S])
+
+    return {length: np.maximum(inside_top[length] + outside_top[length], inside_bottom[length] + outside_bottom[length]) - Z for length in range(1, n+1)}
+
+
+def mask_cells(cells, lefts, rights, allowed):
+    '''Remove the cells which are not allowed, except the tags of the unary chains of the remaining cells, so that the backpointers stay valid
+    --------------------------------
+        Input:
+            cells: the log probabilities of the cells, shape (batch, |tags|), updated in place
+            lefts, rights: the backpointers of the cells, of the same shape
+            allowed: the boolean mask of the allowed cells, of the same shape
+    --------------------------------
+        Do not return anything, but sets the log probability of the removed cells to -inf
+    '''
+    keep = allowed & np.isfinite(cells)
+    while True:
+        rows, cols = np.nonzero(keep & (lefts >= 0) & (rights < 0))
+        children = lefts[rows, cols]
+        missing = ~keep[rows, children]
+        if not missing.any():
+            break
+        keep[rows[missing], children[missing]] = True
+    cells[~keep] = -np.inf
+
+
+def lexical_scores(words, grammer, oov, probe=None):
+    '''Get the log probabilities of the tags of each word, the unseen words being resolved by the OoV module
+    --------------------------------
+        Input:
+            words: the words of the sentence
+            grammer: the PCFG object, compiled by grammer.compile()
+            oov: the out of vocabulary object
+            probe: the Probe timing the phases and counting the work, None to disable it
+    --------------------------------
+        Return:
+            the log probabilities, shape (n, |tags|), -inf for the tags which do not produce the word
+    '''
+    tags_dict = grammer.tags2id
+    cells = np.full((len(words), len(tags_dict)), -np.inf)
+    with phase(probe, 'lexical'):
+        for j in range(1, len(words)+1):
+            word = resolve_word(words, j, grammer.token_tags_dict, oov, probe)
+            for tag in grammer.token_tags_dict[word]:
+                cells[j-1, tags_dict[tag]] = np.log(grammer.token_tag_prob[(word, tag)])
+    return cells
+
+
+class LexicalLayer(object):
+    '''The class LexicalLayer stores the spans of length 1 of a sentence before the beam pruning, so that the stages of a budget
+        resolve the words, run the coarse grammar and apply the unary rules of the words only once.
+        --- self.lexical: the log probabilities of the tags of each word given by lexical_scores(), shape (n, |tags|)
+        --- self.coarse_threshold: the coarse pruning of the layer, None for no coarse pruning
+        --- self.allowed: a dict mapping each length to the mask of the fine tags allowed in its spans by the coarse grammar,
+            None without coarse pruning, when the coarse grammar can not parse the sentence or when its passes exhaust the budget
+        --- self.bottom: the scores of the cells before the unary rules, after the coarse pruning
+        --- self.cells, self.splits, self.lefts, self.rights: the scores of the cells after the unary rules and their backpointers
+    '''
+    def __init__(self, lexical, grammer, coarse_threshold=None, probe=None, deadline=None, max_work=None):
+        '''Build the layer
+        --------------------------------
+            Input:
+                lexical: the log probabilities of the tags of each word given by lexical_scores()
+                grammer: the PCFG object, compiled by grammer.compile()
+                coarse_threshold: the smallest posterior probability of the coarse cells allowing their fine tags, None to not use the coarse grammar
+                probe: the Probe timing the phases and counting the work, None to disable it
+                deadline, max_work: the budget of the coarse passes, as in coarse_posteriors(), None for no bound
+        '''
+        n, T = lexical.shape
+        self.lexical = lexical
+        self.coarse_threshold = coarse_threshold
+        self.allowed = None
+        cells = lexical.copy()
+        if coarse_threshold is not None:
+            with phase(probe, 'coarse'):
+                posteriors = coarse_posteriors(grammer, cells, deadline, max_work, probe)
+            if posteriors is not None:
+                coarse_of = grammer.coarse_grammar().coarse_of
+                self.allowed = {length: (posterior >= np.log(coarse_threshold))[:, coarse_of] for length, posterior in posteriors.items()}
+                cells[~self.allowed[1]] = -np.inf
+        self.bottom = cells.copy()
+        self.splits = np.full((n, T), -1, dtype=np.int32)
+        self.lefts = np.full((n, T), -1, dtype=np.int32)
+        self.rights = np.full((n, T), -1, dtype=np.int32)
+        with phase(probe, 'unary'):
+            apply_unary_closure(grammer, cells, self.splits, self.lefts, self.rights, np.arange(1, n+1))
+            if self.allowed is not None:
+                mask_cells(cells, self.lefts, self.rights, self.allowed[1])
+        self.cells = cells
+
+
+def fill_chart(words, grammer, oov, beam_size=None, beam_threshold=None, coarse_threshold=None, probe=None, bottom=None, deadline=None, max_work=None, layer=None):
+    '''Fill the chart of the vectorized CYK algorithm, over the rules and the split points with the compiled grammar.
+        All the spans of a same length are filled at once, in log space.
+        The unary rules are applied after the binary rules of each span, with the unary closure of the grammar.
+        Only the rules whose children are present in spans of complementary lengths are scored, so that pruning the cells also reduces the work.
+        With coarse_threshold, the sentence is first parsed with the coarse grammar, and the fine tags are only allowed in the spans
+        where their coarse label has a posterior probability of at least coarse_threshold (coarse-to-fine parsing).
+        If the pruned chart has no parse, the sentence is parsed again without the coarse pruning.
+        With a deadline or a work budget, BudgetExceeded is raised with the partial chart as soon as it is exhausted.
+    --------------------------------
+        Input:
+            words: the words of the sentence
+            grammer: the PCFG object, compiled by grammer.compile()
+            oov: the out of vocabulary object
+            beam_size: the number of tags kept for each span, None to keep all of them
+            beam_threshold: the margin in log probability below the best tag of a span under which the tags are pruned, None for no margin
+            coarse_threshold: the smallest posterior probability of the coarse cells allowing their fine tags, None to not use the coarse grammar
+            probe: the Probe timing the phases and counting the work, None to disable it
+            bottom: a Chart receiving the cells before the unary rules of their span, None to not keep them
+            deadline: the time.perf_counter() after which the filling is stopped, None for no deadline
+            max_work: the largest number of rules scored at every split point of every span, None for no bound.
+                      The work of a length is known before it is scored, so the filling stops before exceeding it.
+            layer: the LexicalLayer of the sentence, None to build it. It is only used as is if it has the same coarse_threshold,
+                   else its lexical scores are reused.
+    --------------------------------
+        Return:
+            the filled Chart
+    '''
+    n = len(words)
+    tags_dict = grammer.tags2id
+    T = len(tags_dict)
+    R = len(grammer.binary_parent)
+    parents = grammer.binary_parent[grammer.binary_starts]
+    parent_sizes = np.diff(np.r_[grammer.binary_starts, R])
+    chart = Chart(n)
+
+    if layer is None or layer.coarse_threshold != coarse_threshold:
+        lexical = layer.lexical if layer is not None else lexical_scores(words, grammer, oov, probe)
+        layer = LexicalLayer(lexical, grammer, coarse_threshold, probe, deadline, max_work)
+    allowed = layer.allowed
+    if bottom is not None:
+        leaves = np.full((n, T), -1, dtype=np.int32)
+        bottom.store(1, layer.bottom, leaves, leaves, leaves)
+    # the cells are pruned in place, the backpointers are only read
+    cells, splits, lefts, rights = layer.cells.copy(), layer.splits, layer.lefts, layer.rights
+    if n > 1:
+        with phase(probe, 'prune'):
+            prune_cells(cells, beam_size, beam_threshold)
+    # the tags present in some span of each length
+    present = {1: np.isfinite(cells).any(axis=0)}
+    chart.store(1, cells, splits, lefts, rights)
+    if probe is not None:
+        probe.count('cells', np.isfinite(cells).sum())
+
+    work = 0
+    for length in range(2, n+1):
+        if deadline is not None and time.perf_counter() > deadline:
+            raise BudgetExceeded(chart, length - 1)
+        low = np.arange(n - length + 1)
+        high = low + length
+        # only the rules whose both children survive in some spans of complementary lengths are scored
+        active = np.zeros(R, dtype=bool)
+        for m in range(1, length):
+            active |= present[m][grammer.binary_left] & present[length-m][grammer.binary_right]
+        if allowed is not None:
+            active &= allowed[length].any(axis=0)[grammer.binary_parent]
+        active = np.flatnonzero(active)
+        work += len(low) * (length - 1) * len(active)
+        if max_work is not None and work > max_work:
+            raise BudgetExceeded(chart, length - 1)
+        with phase(probe, 'binary'):
+            rule_best, rule_split = score_binary(chart, grammer, length, active, deadline)
+
+            # best binary rule of each parent, the first one in case of tie
+            parent_best = np.maximum.reduceat(rule_best, grammer.binary_starts, axis=1)
+            rule_ids = np.where(rule_best == np.repeat(parent_best, parent_sizes, axis=1), np.arange(R), R)
+            parent_rule = np.minimum.reduceat(rule_ids, grammer.binary_starts, axis=1)
+
+            cells = np.full((len(low), T), -np.inf)
+            splits = np.full((len(low), T), -1, dtype=np.int32)
+            lefts = np.full((len(low), T), -1, dtype=np.int32)
+            rights = np.full((len(low), T), -1, dtype=np.int32)
+            rows, cols = np.nonzero(np.isfinite(parent_best))
+            rules = parent_rule[rows, cols]
+            cells[rows, parents[cols]] = parent_best[rows, cols]
+            splits[rows, parents[cols]] = rule_split[rows, rules]
+            lefts[rows, parents[cols]] = grammer.binary_left[rules]
+            rights[rows, parents[cols]] = grammer.binary_right[rules]
+            if allowed is not None:
+                cells[~allowed[length]] = -np.inf
+            if bottom is not None:
+                bottom.store(length, cells, splits, lefts, rights)
+        with phase(probe, 'unary'):
+            apply_unary_closure(grammer, cells, splits, lefts, rights, high)
+            if allowed is not None:
+                mask_cells(cells, lefts, rights, allowed[length])
+        if length < n:
+            with phase(probe, 'prune'):
+                prune_cells(cells, beam_size, beam_threshold)
+            present[length] = np.isfinite(cells).any(axis=0)
+        chart.store(length, cells, splits, lefts, rights)
+        if probe is not None:
+            # the active rules are scored at every split point of every span
+            probe.count('rules', len(low) * (length - 1) * len(active))
+            probe.count('cells', np.isfinite(cells).sum())
+
+    if allowed is not None and chart.find(0, n, tags_dict['SENT']) < 0:
+        if probe is not None:
+            probe.count('coarse_fallbacks')
+        return fill_chart(words, grammer, oov, beam_size, beam_threshold, probe=probe, bottom=bottom, deadline=deadline, max_work=max_work, layer=layer)
+    return chart
+
+
+def tighten(options, pruning):
+    '''Combine the pruning of the engine with the pruning of a budget stage, keeping the tightest of both
+    --------------------------------
+        Input:
+            options: a dict with the beam_size, beam_threshold and coarse_threshold of the engine, None for no pruning
+            pruning: a dict with some of these settings for the stage
+    --------------------------------
+        Return:
+            the dict of the settings of the stage
+    '''
+    options = dict(options)
+    for name, value in pruning.items():
+        if options[name] is None:
+            options[name] = value
+        elif name == 'coarse_threshold':
+            options[name] = max(options[name], value)
+        else:
+            options[name] = min(options[name], value)
+    return options
+
+
+def PCYK_vectorized(sentence, grammer, oov, beam_size=None, beam_threshold=None, coarse_threshold=None, time_budget=None, max_work=None, probe=None):
+    '''Probabilistic CYK algorithm, vectorized over the rules and the split points with the compiled grammar, the chart is filled by fill_chart().
+        Without pruning, it gives the same trees as PCYK.
+        With a time or work budget, the sentence is parsed by the stages of BUDGET_STAGES: when a stage exhausts its share of the budget,
+        the next one parses again with a tighter beam, from the same spans of length 1 (the words are resolved once for all the stages),
+        and a stage whose deadline is already over is skipped. When the last one is stopped, or when the chart has no parse, the tree
+        is built by fallback_tree() from the longest spans of the partial chart, so that there is still one tree per sentence.
+        The status of the sentence is given to the probe: 'ok', 'pruned' (parsed by a later stage), 'fallback' (budget exhausted) or 'no_parse'.
+    --------------------------------
+        Input:
+            sentence: the sentence to parse
+            grammer: the PCFG object, compiled by grammer.compile()
+            oov: the out of vocabulary object
+            beam_size: the number of tags kept for each span, None to keep all of them
+            beam_threshold: the margin in log probability below the best tag of a span under which the tags are pruned, None for no margin
+            coarse_threshold: the smallest posterior probability of the coarse cells allowing their fine tags, None to not use the coarse grammar
+            time_budget: the largest time spent on the sentence, in seconds, None for no bound
+            max_work: the largest number of rules scored at every split point of every span by each stage, None for no bound
+            probe: the Probe timing the phases and counting the work, None to disable it
+    --------------------------------
+        Return:
+            the ParseTree of the parsing result, in Chomsky normal form, and its probability (0 for a fallback tree)
+    '''
+    words = sentence.strip().split(' ')
+    n = len(words)
+    SENT = grammer.tags2id['SENT']
+    if time_budget is None and max_work is None:
+        chart = fill_chart(words, grammer, oov, beam_size, beam_threshold, coarse_threshold, probe)
+        with phase(probe, 'build_tree'):
+            tree = build_tree(chart, words, 0, n, SENT, grammer.id2tags)
+        return tree, np.exp(chart.score(0, n, SENT))
+
+    start = time.perf_counter()
+    lexical = lexical_scores(words, grammer, oov, probe)
+    # the spans of length 1 of each coarse pruning of the stages
+    layers = {}
+    partial = None
+    for i, (fraction, pruning) in enumerate(BUDGET_STAGES):
+        options = tighten({'beam_size': beam_size, 'beam_threshold': beam_threshold, 'coarse_threshold': coarse_threshold}, pruning)
+        deadline = start + fraction * time_budget if time_budget is not None else None
+        if partial is not None and deadline is not None and time.perf_counter() > deadline:
+            if probe is not None:
+                probe.count('budget_stages')
+            continue
+        if options['coarse_threshold'] not in layers:
+            layers[options['coarse_threshold']] = LexicalLayer(lexical, grammer, options['coarse_threshold'], probe, deadline, max_work)
+        try:
+            chart = fill_chart(words, grammer, oov, probe=probe, deadline=deadline, max_work=max_work, layer=layers[options['coarse_threshold']], **options)
+        except BudgetExceeded as e:
+            if probe is not None:
+                probe.count('budget_stages')
+            if partial is None or e.length >= partial.length:
+                partial = e
+            continue
+        if chart.find(0, n, SENT) < 0:
+            status, partial = 'no_parse', BudgetExceeded(chart, n)
+            break
+        if probe is not None:
+            probe.set_status('ok' if i == 0 else 'pruned')
+        with phase(probe, 'build_tree'):
+            tree = build_tree(chart, words, 0, n, SENT, grammer.id2tags)
+        return tree, np.exp(chart.score(0, n, SENT))
+    else:
+        status = 'fallback'
+
+    if probe is not None:
+        probe.set_status(status)
+    with phase(probe, 'build_tree'):
+        tree = fallback_tree(partial.chart, words, partial.length, grammer.id2tags, lexical=lexical)
+    return tree, 0.
+
 
+# The parsing engines which can be selected in main.main
+ENGINES = {'pcyk': PCYK, 'vectorized': PCYK_vectorized}
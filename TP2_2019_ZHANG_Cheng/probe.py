@@ -0,0 +1,110 @@
+#####################################################################################################################
+# This python file defines the instrumentation of the parsing engines and the OoV module: timers and counters of  #
+# the parsing phases, collected in one record per sentence.                                                       #
+#####################################################################################################################
+
+import contextlib
+import json
+import time
+
+# The timer returned for a disabled probe, it does nothing
+NULL_TIMER = contextlib.nullcontext()
+
+class PhaseTimer(object):
+    '''Add the time spent in a with block to a phase of the record of a probe'''
+    def __init__(self, times, name):
+        self.times = times
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.times[self.name] = self.times.get(self.name, 0.) + time.perf_counter() - self.start
+
+
+class Probe(object):
+    '''The class Probe collects the timers and counters of the parsing of each sentence.
+        The engines and the OoV module take an optional probe, and only call it when it is not None,
+        so that the instrumentation costs nothing when it is disabled.
+        --- self.record: the record of the current sentence, with its phase times (in seconds), its counters and its unseen words
+        --- self.sink: a function called with each finished record, None to only return them
+    '''
+    def __init__(self, sink=None):
+        '''Init the probe
+        ---------------------------
+            Input:
+                sink: a function called with each finished record, None to only return them
+        ---------------------------
+        '''
+        self.sink = sink
+        self.record = None
+
+    def begin(self, sentence):
+        '''Start the record of a sentence
+        ---------------------------
+            Input:
+                sentence: the sentence to parse
+        ---------------------------
+        '''
+        self.record = {'sentence': sentence, 'length': len(sentence.split(' ')), 'status': None, 'time': None,
+                       'times': {}, 'counts': {}, 'oov': []}
+        self.start = time.perf_counter()
+
+    def end(self, status=None):
+        '''Finish the record of the current sentence, and send it to the sink
+        ---------------------------
+            Input:
+                status: the outcome of the parse, such as 'ok' or 'error', None for the status set by the engine, 'ok' if none was set
+        ---------------------------
+            Return:
+                the record of the sentence
+        '''
+        record = self.record
+        record['time'] = time.perf_counter() - self.start
+        if status is not None or record['status'] is None:
+            record['status'] = status if status is not None else 'ok'
+        self.record = None
+        if self.sink is not None:
+            self.sink(record)
+        return record
+
+    def set_status(self, status):
+        '''Set the status of the current sentence, such as 'pruned' or 'fallback' when the engine degrades its parse'''
+        self.record['status'] = status
+
+    def timer(self, name):
+        '''Get a context manager adding the time of its block to the phase name'''
+        return PhaseTimer(self.record['times'], name)
+
+    def count(self, name, n=1):
+        '''Add n to the counter name'''
+        counts = self.record['counts']
+        counts[name] = counts.get(name, 0) + int(n)
+
+    def oov(self, word, token):
+        '''Record the token assigned to an unseen word'''
+        self.record['oov'].append([word, token])
+
+
+def phase(probe, name):
+    '''Get the timer of a phase, which does nothing if the probe is None
+    ---------------------------
+        Input:
+            probe: a Probe object, or None when the instrumentation is disabled
+            name: the name of the phase
+    ---------------------------
+        Return:
+            a context manager
+    '''
+    if probe is None:
+        return NULL_TIMER
+    return probe.timer(name)
+
+def json_lines_sink(stream):
+    '''Get a sink writing each record as one line of json to a text stream'''
+    def sink(record):
+        stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+        stream.flush()
+    return sink
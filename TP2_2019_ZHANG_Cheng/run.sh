@@ -1,2 +1,2 @@
 #!/bin/bash
-python main.py $1
\ No newline at end of file
+python main.py "$@"
\ No newline at end of file
@@ -0,0 +1,337 @@
+###############################################################################################################################
+# This python file scores parsed trees against gold trees in-process, with the same algorithm and parameter files as EVALB. #
+###############################################################################################################################
+
+import multiprocessing
+import sys
+
+# The whitespace characters of the C isspace() used by evalb
+SPACES = ' \t\n\r\f\v'
+
+# The parameters of EVALB/COLLINS.prm
+COLLINS_PARAMETERS = {'MAX_ERROR': 10, 'CUTOFF_LEN': 40, 'LABELED': 1,
+                      'DELETE_LABEL': ['TOP', '-NONE-', ',', ':', '``', "''", '.'],
+                      'DELETE_LABEL_FOR_LENGTH': ['-NONE-'],
+                      'EQ_LABEL': [('ADVP', 'PRT')], 'EQ_WORD': []}
+
+# The status of a sentence, as printed by evalb
+OK, ERROR, SKIP = 0, 1, 2
+
+def read_parameters(filename):
+    '''Read an evalb parameter file, such as EVALB/COLLINS.prm
+    ---------------------------------
+        Input:
+            filename: the path to the parameter file
+    ---------------------------------
+        Return:
+            the parameters as a dict, with the evalb defaults for the missing ones
+    '''
+    params = {'MAX_ERROR': 10, 'CUTOFF_LEN': 40, 'LABELED': 1,
+              'DELETE_LABEL': [], 'DELETE_LABEL_FOR_LENGTH': [], 'EQ_LABEL': [], 'EQ_WORD': []}
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.rstrip(SPACES)
+            if line.startswith('#') or len(line) < 3:
+                continue
+            fields = line.split(None, 1)
+            name = fields[0]
+            value = fields[1] if len(fields) > 1 else ''
+            if name in ['MAX_ERROR', 'CUTOFF_LEN', 'LABELED']:
+                params[name] = int(value.split()[0])
+            elif name in ['DELETE_LABEL', 'DELETE_LABEL_FOR_LENGTH']:
+                params[name].append(value)
+            elif name in ['EQ_LABEL', 'EQ_WORD'] and len(value.split()) == 2:
+                params[name].append(tuple(value.split()))
+    return params
+
+def same(s1, s2, pairs):
+    '''Compare two labels or words, with the pairs of equivalent strings of EQ_LABEL or EQ_WORD'''
+    return s1 == s2 or (s1, s2) in pairs or (s2, s1) in pairs
+
+def read_tree(line, params):
+    '''Read the terminals and the brackets of a tree in bracket format, as evalb does
+    ---------------------------------
+        Input:
+            line: the tree, such as '( (SENT (NP (DET Le) (NC chat)) (VN (V dort))))'
+            params: the evalb parameters
+    ---------------------------------
+        Return:
+            terminals: the (word, tag) of the words which are not deleted
+            brackets: the [start, end, label] of each non-terminal, in the order of the opening brackets
+            length: the number of words whose tag is not in DELETE_LABEL_FOR_LENGTH, used for the cut-off
+            errors: the list of reading errors
+    '''
+    delete = set(params['DELETE_LABEL'])
+    delete_for_length = set(params['DELETE_LABEL_FOR_LENGTH'])
+    terminals = []
+    brackets = []
+    errors = []
+    stack = []
+    length = 0
+    p = 0
+    n = len(line)
+    while p < n:
+        c = line[p]
+        if c in SPACES:
+            p += 1
+        elif c == '(':
+            p += 1
+            start = p
+            while p < n and line[p] not in SPACES and line[p] not in '()':
+                p += 1
+            label = line[start:p]
+            if p < n and line[p] in SPACES:
+                q = p
+                while q < n and line[q] in SPACES:
+                    q += 1
+                start = q
+                while q < n and line[q] not in SPACES and line[q] not in '()':
+                    q += 1
+                word = line[start:q]
+                if q < n and line[q] == ')':
+                    if label not in delete_for_length:
+                        length += 1
+                    if label not in delete:
+                        terminals.append((word, label))
+                    p = q + 1
+                    continue
+                elif q >= n or line[q] != '(':
+                    errors.append('More than two elements in a bracket')
+            stack.append(len(brackets))
+            brackets.append([len(terminals), -1, label])
+        elif c == ')':
+            if len(stack) == 0:
+                errors.append('Bracketing unbalance (too many close bracket)')
+            else:
+                brackets[stack.pop()][1] = len(terminals)
+            p += 1
+        else:
+            errors.append('Reading sentence')
+            p += 1
+    if len(stack) > 0:
+        errors.append('Bracketing is unbalanced (too many open bracket)')
+    return terminals, brackets, length, errors
+
+def modify_label(label):
+    '''Remove the functional tags of a label, which start with '-' or \'=\''''
+    for i, c in enumerate(label):
+        if c == '-' or c == '=':
+            return label[:i]
+    return label
+
+def kept_brackets(brackets, params):
+    '''Get the brackets which are scored: not empty, and whose label without functional tags is not deleted'''
+    delete = params['DELETE_LABEL']
+    eq_label = params['EQ_LABEL']
+    kept = []
+    for start, end, label in brackets:
+        if start == end:
+            continue
+        label = modify_label(label)
+        if any(same(label, d, eq_label) for d in delete):
+            continue
+        kept.append((start, end, label))
+    return kept
+
+def score_sentence(gold, test, params):
+    '''Score one parsed tree against its gold tree
+    ---------------------------------
+        Input:
+            gold: the gold tree in bracket format
+            test: the parsed tree in bracket format
+            params: the evalb parameters
+    ---------------------------------
+        Return:
+            a dict with the status (OK, ERROR or SKIP), the length of the gold sentence, the numbers of words, correct tags,
+            gold brackets, test brackets, matched brackets and crossing brackets, and the error messages
+    '''
+    gold_terminals, gold_brackets, length, errors = read_tree(gold, params)
+    test_terminals, test_brackets, _, test_errors = read_tree(test, params)
+    errors = errors + test_errors
+    result = {'status': ERROR if len(errors) > 0 else OK, 'length': length, 'words': 0, 'correct_tags': 0,
+              'gold': 0, 'test': 0, 'match': 0, 'crossing': 0, 'errors': errors}
+    if len(test_terminals) == 0:
+        result['status'] = SKIP
+        return result
+    if len(gold_terminals) != len(test_terminals):
+        result['status'] = ERROR
+        result['errors'].append('Length unmatch ({}|{})'.format(len(gold_terminals), len(test_terminals)))
+        return result
+    for (w1, _), (w2, _) in zip(gold_terminals, test_terminals):
+        if not same(w1, w2, params['EQ_WORD']):
+            result['status'] = ERROR
+            result['errors'].append('Words unmatch ({}|{})'.format(w1, w2))
+            return result
+
+    gold_kept = kept_brackets(gold_brackets, params)
+    test_kept = kept_brackets(test_brackets, params)
+    eq_label = params['EQ_LABEL']
+    # each gold bracket matches the first unmatched test bracket of the same span and label
+    matched = [False] * len(test_kept)
+    match = 0
+    for start, end, label in gold_kept:
+        for j, (s, e, l) in enumerate(test_kept):
+            if not matched[j] and s == start and e == end and (params['LABELED'] == 0 or same(label, l, eq_label)):
+                matched[j] = True
+                match += 1
+                break
+    # the test brackets crossing a gold bracket
+    crossing = 0
+    for s, e, _ in test_kept:
+        for start, end, _ in gold_kept:
+            if (start < s and end > s and end < e) or (start > s and start < e and end > e):
+                crossing += 1
+                break
+    correct_tags = sum(1 for (_, t1), (_, t2) in zip(gold_terminals, test_terminals) if same(t1, t2, eq_label))
+
+    result.update({'words': len(gold_terminals), 'correct_tags': correct_tags,
+                   'gold': len(gold_kept), 'test': len(test_kept), 'match': match, 'crossing': crossing})
+    return result
+
+def summarize(results, cutoff=None):
+    '''Sum the scores of the sentences, as the summary of evalb
+    ---------------------------------
+        Input:
+            results: the list of results of score_sentence
+            cutoff: only the sentences of at most cutoff words are summed, None for all of them
+    ---------------------------------
+        Return:
+            a dict with the numbers of sentences, the bracketing recall, precision and F-measure, the complete match,
+            the average crossing, the no crossing and 2 or less crossing rates and the tagging accuracy, all in percent
+    '''
+    if cutoff is not None:
+        results = [res for res in results if res['length'] <= cutoff]
+    valid = [res for res in results if res['status'] == OK]
+    totals = {key: sum(res[key] for res in valid) for key in ['gold', 'test', 'match', 'crossing', 'words', 'correct_tags']}
+    sentn = len(valid)
+    recall = 100.0 * totals['match'] / totals['gold'] if totals['gold'] > 0 else 0.0
+    precision = 100.0 * totals['match'] / totals['test'] if totals['test'] > 0 else 0.0
+    summary = {'sentences': len(results),
+               'error_sentences': sum(1 for res in results if res['status'] == ERROR),
+               'skip_sentences': sum(1 for res in results if res['status'] == SKIP),
+               'valid_sentences': sentn,
+               'recall': recall,
+               'precision': precision,
+               'fmeasure': 2 * precision * recall / (precision + recall) if precision + recall > 0 else float('nan'),
+               'complete_match': 100.0 * sum(1 for res in valid if res['gold'] == res['test'] == res['match']) / sentn if sentn > 0 else 0.0,
+               'average_crossing': 1.0 * totals['crossing'] / sentn if sentn > 0 else 0.0,
+               'no_crossing': 100.0 * sum(1 for res in valid if res['crossing'] == 0) / sentn if sentn > 0 else 0.0,
+               'two_or_less_crossing': 100.0 * sum(1 for res in valid if res['crossing'] <= 2) / sentn if sentn > 0 else 0.0,
+               'tagging_accuracy': 100.0 * totals['correct_tags'] / totals['words'] if totals['words'] > 0 else 0.0}
+    summary.update(totals)
+    return summary
+
+def score_job(job):
+    '''Score a chunk of sentences in a worker process of score_trees'''
+    pairs, params = job
+    return [score_sentence(gold, test, params) for gold, test in pairs]
+
+def score_trees(gold_trees, test_trees, params=COLLINS_PARAMETERS, workers=1, chunksize=64):
+    '''Score parsed trees against gold trees, in parallel over chunks of sentences
+    ---------------------------------
+        Input:
+            gold_trees: the list of gold trees in bracket format
+            test_trees: the list of parsed trees in bracket format, such as the lines written by main.main
+            params: the evalb parameters, COLLINS_PARAMETERS by default, or read by read_parameters()
+            workers: the number of processes
+            chunksize: the number of sentences scored by a process at once
+    ---------------------------------
+        Return:
+            the list of results of score_sentence for each gold tree (a missing parsed tree is an error, as in evalb),
+            the summary of all sentences and the summary of the sentences of at most CUTOFF_LEN words
+    '''
+    pairs = list(zip(gold_trees, test_trees))
+    if workers > 1 and len(pairs) > chunksize:
+        jobs = [(pairs[i:i+chunksize], params) for i in range(0, len(pairs), chunksize)]
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results = [res for chunk in pool.map(score_job, jobs) for res in chunk]
+    else:
+        results = score_job((pairs, params))
+    for gold in gold_trees[len(pairs):]:
+        _, _, length, _ = read_tree(gold, params)
+        results.append({'status': ERROR, 'length': length, 'words': 0, 'correct_tags': 0, 'gold': 0, 'test': 0,
+                        'match': 0, 'crossing': 0, 'errors': ['Number of lines unmatch (too many lines in gold file)']})
+    return results, summarize(results), summarize(results, params['CUTOFF_LEN'])
+
+def format_results(results, summary, summary_cut, cutoff=40):
+    '''Format the scores in the same layout as the output of evalb
+    ---------------------------------
+        Input:
+            results, summary, summary_cut: the outputs of score_trees
+            cutoff: the cut-off length of summary_cut
+    ---------------------------------
+        Return:
+            the text of the scores
+    '''
+    lines = ['  Sent.                        Matched  Bracket   Cross        Correct Tag',
+             ' ID  Len.  Stat. Recal  Prec.  Bracket gold test Bracket Words  Tags Accracy',
+             '============================================================================']
+    for i, res in enumerate(results):
+        lines.append('{:4d}  {:3d}    {:d}  {:6.2f} {:6.2f}   {:3d}    {:3d}  {:3d}    {:3d}   {:4d}  {:4d}   {:6.2f}'.format(
+            i + 1, res['length'], res['status'],
+            100.0 * res['match'] / res['gold'] if res['gold'] > 0 else 0.0,
+            100.0 * res['match'] / res['test'] if res['test'] > 0 else 0.0,
+            res['match'], res['gold'], res['test'], res['crossing'], res['words'], res['correct_tags'],
+            100.0 * res['correct_tags'] / res['words'] if res['words'] > 0 else 0.0))
+    lines.append('============================================================================')
+    total = ''
+    if summary['gold'] > 0 and summary['test'] > 0:
+        total = '                {:6.2f} {:6.2f} {:6d} {:5d} {:5d}  {:5d}'.format(
+            summary['recall'], summary['precision'], summary['match'], summary['gold'], summary['test'], summary['crossing'])
+    lines.append(total + '  {:5d} {:5d}   {:6.2f}'.format(summary['words'], summary['correct_tags'], summary['tagging_accuracy']))
+    lines.append('=== Summary ===')
+    for name, s in [('All', summary), ('len<=' + str(cutoff), summary_cut)]:
+        lines += ['', '-- ' + name + ' --',
+                  'Number of sentence        = {:6d}'.format(s['sentences']),
+                  'Number of Error sentence  = {:6d}'.format(s['error_sentences']),
+                  'Number of Skip  sentence  = {:6d}'.format(s['skip_sentences']),
+                  'Number of Valid sentence  = {:6d}'.format(s['valid_sentences']),
+                  'Bracketing Recall         = {:6.2f}'.format(s['recall']),
+                  'Bracketing Precision      = {:6.2f}'.format(s['precision']),
+                  'Bracketing FMeasure       = {:6.2f}'.format(s['fmeasure']),
+                  'Complete match            = {:6.2f}'.format(s['complete_match']),
+                  'Average crossing          = {:6.2f}'.format(s['average_crossing']),
+                  'No crossing               = {:6.2f}'.format(s['no_crossing']),
+                  '2 or less crossing        = {:6.2f}'.format(s['two_or_less_crossing']),
+                  'Tagging accuracy          = {:6.2f}'.format(s['tagging_accuracy'])]
+    return '\n'.join(lines)
+
+def score_files(gold_file, test_file, params=COLLINS_PARAMETERS, workers=1):
+    '''Score a file of parsed trees against a file of gold trees, one tree per line
+    ---------------------------------
+        Input:
+            gold_file: the path to the gold trees
+            test_file: the path to the parsed trees
+            params: the evalb parameters
+            workers: the number of processes
+    ---------------------------------
+        Return:
+            the outputs of score_trees
+    '''
+    with open(gold_file, 'r') as f:
+        gold_trees = f.read().splitlines()
+    with open(test_file, 'r') as f:
+        test_trees = f.read().splitlines()
+    return score_trees(gold_trees, test_trees, params, workers)
+
+
+if __name__ == "__main__":
+    args = list(sys.argv)
+    params = COLLINS_PARAMETERS
+    workers = 1
+    if '-p' in args:
+        idx = args.index('-p')
+        params = read_parameters(args[idx+1])
+        del args[idx:idx+2]
+    if '--workers' in args:
+        idx = args.index('--workers')
+        workers = int(args[idx+1])
+        del args[idx:idx+2]
+    if len(args) != 3:
+        print("Error: do not have correct number of arguments (expected [-p param_file] [--workers N] gold_file test_file)!")
+        sys.exit(1)
+    results, summary, summary_cut = score_files(args[1], args[2], params, workers)
+    for i, res in enumerate(results):
+        for error in res['errors']:
+            print('{} : {}'.format(i + 1, error), file=sys.stderr)
+    print(format_results(results, summary, summary_cut, params['CUTOFF_LEN']))
@@ -1,13 +1,68 @@
-###################################################################################################################
-# This python file splits data to training set (2479 lines), validation set (309 lines) and test set (311 lines). #
-###################################################################################################################
+#####################################################################################################################
+# This python file preprocesses the raw treebank and splits it to training set (80%), validation set (10%) and test #
+# set (10%) in a single streaming pass, each tree being assigned to a set by the hash of its line.                  #
+#####################################################################################################################
 
-import numpy as np
+import hashlib
+import re
 
-np.random.seed(2019)
+# The functional labels removed from the raw treebank, in the order they are applied
+FUNCTIONAL_LABELS = [(re.compile(r'-[A-Z].{0,3}[A-Z]\s'), ' '),
+                     (re.compile(r'-OBJ::OBJ##OBJ/OBJ'), ''),
+                     (re.compile(r'-DE_OBJ'), ''),
+                     (re.compile(r'-AFF.DEMSUJ'), '')]
 
-def split(train_filename, train_sent, dev_filename, dev_res, test_filename, test_res, raw_filename):
-    '''function to split data, the split results will be stored under data folder
+# The salt of the hash assigning the lines to the sets, change it to draw another split
+SPLIT_SALT = '2019'
+
+def clean_line(line):
+    '''Remove the functional labels of a line of the raw treebank'''
+    for pattern, repl in FUNCTIONAL_LABELS:
+        line = pattern.sub(repl, line)
+    return line
+
+def extract_words(line):
+    '''Get the words of a tree in bracket format, in one pass over the line.
+        A word is the text between the last space and a ')' which does not follow another ')'.
+    ---------------------------------------------
+        Input:
+            line: the tree
+    ---------------------------------------------
+        Return:
+            the list of the words
+    '''
+    words = []
+    for token in line.split(' '):
+        j = token.find(')')
+        while j != -1:
+            if j == 0 or token[j-1] != ')':
+                words.append(token[:j])
+            j = token.find(')', j+1)
+    return words
+
+def assign_set(line, dev_ratio=0.1, test_ratio=0.1, salt=SPLIT_SALT):
+    '''Assign a line to a set by its hash, so that the split does not depend on the order nor on the number of lines
+    ---------------------------------------------
+        Input:
+            line: the tree, without the end of line
+            dev_ratio, test_ratio: the expected proportions of the validation and test sets
+            salt: the salt of the hash
+    ---------------------------------------------
+        Return:
+            'train', 'dev' or 'test'
+    '''
+    digest = hashlib.md5((salt + line).encode('utf-8')).digest()
+    u = int.from_bytes(digest[:8], 'big') / 2.**64
+    if u < 1. - dev_ratio - test_ratio:
+        return 'train'
+    if u < 1. - test_ratio:
+        return 'dev'
+    return 'test'
+
+def split(train_filename, train_sent, dev_filename, dev_res, test_filename, test_res, raw_filename, processed_filename=None, clean=False,
+          dev_ratio=0.1, test_ratio=0.1, salt=SPLIT_SALT):
+    '''function to split data, the split results will be stored under data folder.
+        The raw file is read line by line once, so the memory does not depend on its size.
     ---------------------------------------------
         Input:
             train_filename: the path to the output training file
@@ -17,83 +72,37 @@ def split(train_filename, train_sent, dev_filename, dev_res, test_filename, test
             test_filename: the path to the output test file
             test_res: the path to the output test result file
             raw_filename: the path to the file containing raw data
+            processed_filename: the path to also write the preprocessed lines to, None to not write them
+            clean: True to remove the functional labels of the raw lines
+            dev_ratio, test_ratio: the expected proportions of the validation and test sets
+            salt: the salt of the hash assigning the lines to the sets
     ---------------------------------------------
         Do not return anything, but write results to files
     '''
-    train_f = open('./data/'+train_filename, "w")
-    train_sent = open('./data/'+train_sent, "w")
-    dev_f = open('./data/'+dev_filename, "w")
-    test_f = open('./data/'+test_filename, "w")
-    dev_res = open('./data/'+dev_res, "w")
-    test_res = open('./data/'+test_res, "w")
+    names = {'train': (train_filename, train_sent), 'dev': (dev_res, dev_filename), 'test': (test_res, test_filename)}
+    trees = {key: open('./data/' + value[0], 'w') for key, value in names.items()}
+    sentences = {key: open('./data/' + value[1], 'w') for key, value in names.items()}
+    processed = open(processed_filename, 'w') if processed_filename is not None else None
+    counts = {key: 0 for key in names}
 
-    raw_lines = []
     with open(raw_filename, 'r') as f:
-        for _, line in enumerate(f):
+        for line in f:
+            if clean:
+                line = clean_line(line)
+            if processed is not None:
+                processed.write(line)
             if not line.endswith('\n'):
                 line += '\n'
-            raw_lines.append(line)
-
-    total_num = len(raw_lines)
-    indexes = np.array(range(total_num))
-    np.random.shuffle(indexes)
-    print(total_num)
-    train_num = int(total_num * 0.8)
-    train_indexes = indexes[0:train_num]
-    print(train_num)
-    dev_num = int(total_num * 0.1)
-    dev_indexes = indexes[train_num:train_num+dev_num]
-    print(dev_num)
-    test_num = total_num - train_num - dev_num
-    test_indexes = indexes[train_num+dev_num:]
-    print(test_num)
-
-    for i in train_indexes:
-        line = raw_lines[i]
-        train_f.write('{}'.format(line))
-
-        words = []
-        for j, c in enumerate(line):
-            if c == ')' and line[j-1] != ")":
-                end = j-1
-                start = end
-                while line[start] != " ":
-                    start -= 1
-                words.append(line[start+1:end+1])
-        sentence = ' '.join(words)
-        train_sent.write('{}\n'.format(sentence))
-    train_f.close()
-    train_sent.close()
-
-    for i in dev_indexes:
-        line = raw_lines[i]
-        words = []
-        for j, c in enumerate(line):
-            if c == ')' and line[j-1] != ")":
-                end = j-1
-                start = end
-                while line[start] != " ":
-                    start -= 1
-                words.append(line[start+1:end+1])
-        sentence = ' '.join(words)
-        dev_f.write('{}\n'.format(sentence))
-        dev_res.write('{}'.format(line))
-    dev_f.close()
-    dev_res.close()
-
-    for i in test_indexes:
-        line = raw_lines[i]
-        words = []
-        for j, c in enumerate(line):
-            if c == ')' and line[j-1] != ")":
-                end = j-1
-                start = end
-                while line[start] != " ":
-                    start -= 1
-                words.append(line[start+1:end+1])
-        sentence = ' '.join(words)
-        test_f.write('{}\n'.format(sentence))
-        test_res.write('{}'.format(line))
-    test_f.close()
-    test_res.close()
+            key = assign_set(line[:-1], dev_ratio, test_ratio, salt)
+            counts[key] += 1
+            trees[key].write(line)
+            sentences[key].write(' '.join(extract_words(line)) + '\n')
 
+    for out in list(trees.values()) + list(sentences.values()):
+        out.close()
+    if processed is not None:
+        processed.close()
+    print(sum(counts.values()))
+    print(counts['train'])
+    print(counts['dev'])
+    print(counts['test'])
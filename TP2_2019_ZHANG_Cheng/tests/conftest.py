@@ -0,0 +1,45 @@
+#####################################################################################################################
+# This python file sets up the tests: the modules of the parser are imported from the parent folder, and the        #
+# grammar built from the training trees is shared by all the tests.                                                 #
+#####################################################################################################################
+
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+DATA = os.path.join(ROOT, 'data')
+
+from Grammer import Grammer
+
+@pytest.fixture(scope='session')
+def grammer():
+    '''The grammar built from the training trees, with the default settings'''
+    grammer = Grammer()
+    grammer.create_pcfg(os.path.join(DATA, 'train'))
+    return grammer
+
+@pytest.fixture(scope='session')
+def train_lines():
+    '''The training trees, one per line'''
+    with open(os.path.join(DATA, 'train'), 'r') as f:
+        return f.read().splitlines()
+
+@pytest.fixture(scope='session')
+def oov(grammer):
+    '''The OoV module of the grammar with its bigram model and candidate index, without the embeddings'''
+    from OOV import OoV
+    oov = OoV(grammer)
+    oov.get_bigram(os.path.join(DATA, 'train_sent'))
+    return oov
+
+@pytest.fixture(scope='session')
+def unseen_words(grammer):
+    '''The words of the validation and test sentences which are not tokens of the grammar'''
+    words = []
+    for name in ['dev', 'test']:
+        with open(os.path.join(DATA, name), 'r') as f:
+            for line in f:
+                words.extend(word for word in line.split() if word not in grammer.token_tags_dict)
+    return sorted(set(words))
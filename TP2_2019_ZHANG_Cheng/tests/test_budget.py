@@ -0,0 +1,35 @@
+#####################################################################################################################
+# This python file tests the budget of the vectorized engine: a parse with a time or work budget and the coarse     #
+# grammar stops its coarse passes as well as the filling of its chart, and still gives one tree.                    #
+#####################################################################################################################
+
+import os
+import time
+import pytest
+from conftest import DATA
+from parser import PCYK_vectorized
+from probe import Probe
+
+@pytest.fixture(scope='module')
+def long_sentences(grammer):
+    '''The longest training sentences, whose words are all tokens of the grammar so that no OoV module is needed'''
+    with open(os.path.join(DATA, 'train_sent'), 'r') as f:
+        lines = [line.strip() for line in f]
+    return sorted(lines, key=lambda line: -len(line.split(' ')))[:3]
+
+def test_time_budget_with_coarse_threshold(grammer, long_sentences):
+    budget = 0.2
+    # the coarse grammar is built once for the grammar, outside of the budget of the sentences
+    grammer.coarse_grammar()
+    for sentence in long_sentences:
+        start = time.perf_counter()
+        tree, _ = PCYK_vectorized(sentence, grammer, None, coarse_threshold=1e-3, time_budget=budget)
+        assert time.perf_counter() - start < 3 * budget
+        assert len(tree.words) == len(sentence.split(' '))
+
+def test_max_work_stops_coarse_passes(grammer, long_sentences):
+    probe = Probe()
+    probe.begin(long_sentences[0])
+    tree, _ = PCYK_vectorized(long_sentences[0], grammer, None, coarse_threshold=0.5, max_work=10**5, probe=probe)
+    assert probe.end()['counts']['coarse_stopped'] > 0
+    assert len(tree.words) == len(long_sentences[0].split(' '))
@@ -0,0 +1,78 @@
+#####################################################################################################################
+# This python file tests the compiled grammar file: the round trip of Grammer.save() and Grammer.load(), the rebuild#
+# of the compiled grammar by Grammer.get_pcfg() when the training file changes, and the incremental update of       #
+# Grammer.update_pcfg() against a full build.                                                                       #
+#####################################################################################################################
+
+import os
+import numpy as np
+from conftest import DATA
+from Grammer import COMPILED_ARRAYS, Grammer
+
+def test_save_load_round_trip(grammer, tmp_path):
+    compiled_file = str(tmp_path / 'train.grammar')
+    grammer.save(compiled_file)
+    loaded = Grammer()
+    loaded.load(compiled_file)
+    for name in COMPILED_ARRAYS:
+        assert np.array_equal(getattr(loaded, name), getattr(grammer, name)), name
+    assert loaded.tags == grammer.tags
+    assert loaded.id2tokens == grammer.id2tokens
+    assert loaded.settings() == grammer.settings()
+    assert loaded.fingerprint() == grammer.fingerprint()
+    assert loaded.lhs_rhs_prob == grammer.lhs_rhs_prob
+    assert loaded.token_tag_prob == grammer.token_tag_prob
+    assert loaded.token_tags_dict == grammer.token_tags_dict
+
+def test_get_pcfg_rebuilds_on_new_training_file(tmp_path):
+    train_file = str(tmp_path / 'train')
+    compiled_file = train_file + '.grammar'
+    with open(os.path.join(DATA, 'train'), 'r') as f:
+        lines = f.read().splitlines()
+    with open(train_file, 'w') as f:
+        f.write('\n'.join(lines[:200]) + '\n')
+    first = Grammer()
+    first.get_pcfg(train_file, compiled_file)
+    header, _ = Grammer.read_header(compiled_file)
+    assert header['train_hash'] == first.train_hash
+
+    # the same training file: the compiled grammar is loaded as it is
+    again = Grammer()
+    again.get_pcfg(train_file, compiled_file)
+    assert isinstance(again.rule_parent, np.memmap)
+    assert again.lhs_rhs_prob == first.lhs_rhs_prob
+
+    # another training file: the compiled grammar is built again
+    with open(train_file, 'w') as f:
+        f.write('\n'.join(lines[:300]) + '\n')
+    rebuilt = Grammer()
+    rebuilt.get_pcfg(train_file, compiled_file)
+    assert rebuilt.train_hash != first.train_hash
+    assert Grammer.read_header(compiled_file)[0]['train_hash'] == rebuilt.train_hash
+
+def test_update_equals_full_build(train_lines, tmp_path):
+    first_file, second_file, full_file = (str(tmp_path / name) for name in ['first', 'second', 'full'])
+    with open(first_file, 'w') as f:
+        f.write('\n'.join(train_lines[:300]) + '\n')
+    with open(second_file, 'w') as f:
+        f.write('\n'.join(train_lines[300:600]) + '\n')
+    with open(full_file, 'w') as f:
+        f.write('\n'.join(train_lines[:600]) + '\n')
+    updated = Grammer()
+    updated.create_pcfg(first_file)
+    known_tags = list(updated.tags)
+    known_tokens = list(updated.id2tokens)
+    new_tokens = updated.update_pcfg(second_file)
+    full = Grammer()
+    full.create_pcfg(full_file)
+
+    # the counts are sums of integers, so the probabilities are exactly the ones of the full build
+    assert updated.lhs_rhs_prob == full.lhs_rhs_prob
+    assert updated.token_tag_prob == full.token_tag_prob
+    assert {token: set(tags) for token, tags in updated.token_tags_dict.items()} == \
+        {token: set(tags) for token, tags in full.token_tags_dict.items()}
+    # the known tags and tokens keep their ids, the new ones are numbered after them
+    assert updated.tags[:len(known_tags)] == known_tags
+    assert sorted(updated.tags) == sorted(full.tags)
+    assert updated.id2tokens == known_tokens + new_tokens
+    assert sorted(updated.id2tokens) == sorted(full.id2tokens)
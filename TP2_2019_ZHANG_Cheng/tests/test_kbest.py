@@ -0,0 +1,103 @@
+#####################################################################################################################
+# This python file tests the lazy k-best enumeration of kbest.py against an exhaustive one, which keeps the k best  #
+# scores of every tag of every span bottom-up, merging all the binary rules and all the chains of unary rules.      #
+#####################################################################################################################
+
+import os
+import numpy as np
+import pytest
+from conftest import DATA
+from kbest import PCYK_kbest
+from parser import Chart, fill_chart
+
+K = 8
+
+def top_k(scores, k):
+    '''The k largest finite scores of an array, in decreasing order'''
+    scores = np.sort(scores[np.isfinite(scores)])[::-1]
+    return scores[:k]
+
+def unary_chains(grammer, k):
+    '''Get the k best log probabilities of the chains of unary rules A ->* B, the empty chain included, by extending the chains
+        by one rule until the k best ones of every pair of tags do not change: the rules have probabilities < 1, so it ends.
+    ---------------------------
+        Input:
+            grammer: the compiled PCFG object
+            k: the number of chains kept for each pair of tags
+    ---------------------------
+        Return:
+            a dict mapping (A, B) to the array of the k best log probabilities of the chains from A to B
+    '''
+    tags = set(grammer.unary_parent.tolist()) | set(grammer.unary_child.tolist())
+    chains = {(tag, tag): np.zeros(1) for tag in tags}
+    while True:
+        # the chains of at most d + 1 rules are the empty chains and the chains of at most d rules below one more rule
+        extended = {(tag, tag): [np.zeros(1)] for tag in tags}
+        for parent, child, logprob in zip(grammer.unary_parent.tolist(), grammer.unary_child.tolist(), grammer.unary_logprob.tolist()):
+            for (top, bottom), scores in chains.items():
+                if top == child:
+                    extended.setdefault((parent, bottom), []).append(scores + logprob)
+        extended = {pair: top_k(np.concatenate(scores), k) for pair, scores in extended.items()}
+        if extended.keys() == chains.keys() and all(np.array_equal(extended[pair], chains[pair]) for pair in chains):
+            return chains
+        chains = extended
+
+def exhaustive_kbest(words, grammer, k):
+    '''Get the k best log probabilities of the parses of a sentence, with the k best scores of every tag of every span
+        before (BOTTOM) and after (TOP) the unary rules, computed from all the split points, binary rules and unary chains
+    ---------------------------
+        Input:
+            words: the words of the sentence, all of them tokens of the grammar
+            grammer: the compiled PCFG object
+            k: the number of parses
+    ---------------------------
+        Return:
+            the array of the k best log probabilities of the SENT parses of the whole sentence
+    '''
+    n = len(words)
+    T = len(grammer.tags2id)
+    bottom_chart = Chart(n)
+    fill_chart(words, grammer, None, bottom=bottom_chart)
+    chains = unary_chains(grammer, k)
+    parents = np.r_[grammer.binary_starts, len(grammer.binary_parent)]
+    top = {}
+    for length in range(1, n + 1):
+        for low in range(n - length + 1):
+            high = low + length
+            bottom = np.full((T, k), -np.inf)
+            if length == 1:
+                bottom[:, 0] = bottom_chart.row(low, high, T)
+            else:
+                # all the pairs of the k best scores of the children, for each rule and split point
+                totals = [(top[(low, m)][grammer.binary_left][:, :, None] + top[(m, high)][grammer.binary_right][:, None, :])
+                          .reshape(len(grammer.binary_left), -1) for m in range(low + 1, high)]
+                totals = np.concatenate(totals, axis=1) + grammer.binary_logprob[:, None]
+                for i in range(len(parents) - 1):
+                    scores = top_k(totals[parents[i]:parents[i+1]].ravel(), k)
+                    bottom[grammer.binary_parent[parents[i]], :len(scores)] = scores
+            # the tags without unary rules keep their scores, the others take the k best of their chains down to every tag
+            cell = bottom.copy()
+            merged = {}
+            for (a, b), scores in chains.items():
+                merged.setdefault(a, []).append((scores[:, None] + bottom[b][None, :]).ravel())
+            for a, scores in merged.items():
+                scores = top_k(np.concatenate(scores), k)
+                cell[a] = np.r_[scores, np.full(k - len(scores), -np.inf)]
+            top[(low, high)] = cell
+    return top_k(top[(0, n)][grammer.tags2id['SENT']], k)
+
+@pytest.fixture(scope='module')
+def sentences():
+    '''Short training sentences, whose words are all tokens of the grammar so that no OoV module is needed'''
+    with open(os.path.join(DATA, 'train_sent'), 'r') as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if 3 <= len(line.split(' ')) <= 6][:6]
+
+def test_lazy_kbest_equals_exhaustive(grammer, sentences):
+    for sentence in sentences:
+        parses = PCYK_kbest(sentence, grammer, None, k=K)
+        expected = exhaustive_kbest(sentence.split(' '), grammer, K)
+        assert len(parses) == len(expected)
+        assert np.allclose([logprob for _, logprob in parses], expected)
+        # every derivation is a different tree
+        assert len(set(str(tree) for tree, _ in parses)) == len(parses)
@@ -0,0 +1,59 @@
+#####################################################################################################################
+# This python file tests the OoV module against its references: the candidates found by the symmetric delete index  #
+# against the scan of all the tokens, the bounded distance kernels against the full dynamic programming, and the    #
+# sparse bigram model against the dense matrix of the original module.                                              #
+#####################################################################################################################
+
+import os
+import numpy as np
+from conftest import DATA
+from Grammer import Grammer
+from OOV import Damerau_Levenshtein_distance, Damerau_Levenshtein_within, OoV, bounded_Damerau_Levenshtein_distance
+
+def test_indexed_candidates_equal_scan(oov, unseen_words):
+    words = unseen_words[::8] + [word.lower() for word in unseen_words[1::16]]
+    index = oov.delete_index
+    try:
+        indexed = [oov.generate_candidates(word, 2) for word in words]
+        oov.delete_index = None
+        scanned = [oov.generate_candidates(word, 2) for word in words]
+    finally:
+        oov.delete_index = index
+    assert indexed == scanned
+    assert sum(len(candidates) > 0 for candidates in indexed) > 0
+
+def test_bounded_distances_equal_full_distance(oov, unseen_words):
+    tokens = list(oov.token2id.keys())[::50]
+    for word in unseen_words[::40]:
+        # the close strings: a deletion, a transposition, an insertion and a substitution of the word
+        close = [word[1:], word[1::-1] + word[2:], word + 's', 'x' + word[1:-1] + 'y']
+        for k in [1, 2, 3]:
+            expected = [min(int(Damerau_Levenshtein_distance(word, token)), k + 1) for token in tokens + close]
+            assert [bounded_Damerau_Levenshtein_distance(word, token, k) for token in tokens + close] == expected
+            assert Damerau_Levenshtein_within(word, tokens + close, k).tolist() == expected
+
+def test_sparse_bigram_equals_dense_matrix(tmp_path):
+    # a small treebank, so that the dense matrix of the original module fits in memory
+    for name in ['train', 'train_sent']:
+        with open(os.path.join(DATA, name), 'r') as f:
+            lines = f.read().splitlines()[:300]
+        with open(str(tmp_path / name), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    grammer = Grammer()
+    grammer.create_pcfg(str(tmp_path / 'train'))
+    oov = OoV(grammer)
+    oov.get_bigram(str(tmp_path / 'train_sent'))
+
+    # the transition matrix as the original get_bigram() computed it
+    l = len(oov.token2id)
+    dense = np.zeros((l+1, l+1))
+    for line in lines:
+        words = line.strip().split(' ')
+        dense[l, oov.token2id[words[0]]] += 1
+        for i in range(len(words) - 1):
+            dense[oov.token2id[words[i]], oov.token2id[words[i+1]]] += 1
+        dense[oov.token2id[words[-1]], l] += 1
+    dense = dense / np.sum(dense, axis=1)
+
+    prevs, nexts = np.meshgrid(np.arange(l+1), np.arange(l+1), indexing='ij')
+    assert np.array_equal(oov.bigram.probs(prevs, nexts), dense)
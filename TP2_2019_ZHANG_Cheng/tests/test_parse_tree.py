@@ -0,0 +1,42 @@
+#####################################################################################################################
+# This python file tests ParseTree.to_bracket() against the de-binarization of nltk, which main.to_bracket() uses   #
+# for the trees given as strings, on the parses of the vectorized, k-best and fallback engines.                     #
+#####################################################################################################################
+
+import os
+import pytest
+from conftest import DATA
+from Grammer import Grammer
+from kbest import PCYK_kbest
+from main import to_bracket
+from parser import PCYK_vectorized
+
+@pytest.fixture(scope='module')
+def sentences(grammer):
+    '''Short training sentences, whose words are all tokens of the grammar so that no OoV module is needed'''
+    with open(os.path.join(DATA, 'train_sent'), 'r') as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if 4 <= len(line.split(' ')) <= 12][:15]
+
+@pytest.fixture(scope='module')
+def markov_grammer():
+    '''The grammar built from the training trees with markovized binarization and parent annotation'''
+    grammer = Grammer(horz_markov=1, vert_markov=1)
+    grammer.create_pcfg(os.path.join(DATA, 'train'))
+    return grammer
+
+def check_trees(trees):
+    for tree in trees:
+        assert to_bracket(tree) == to_bracket(str(tree))
+
+def test_to_bracket_equals_nltk(grammer, markov_grammer, sentences):
+    for g in [grammer, markov_grammer]:
+        check_trees(PCYK_vectorized(sentence, g, None)[0] for sentence in sentences)
+
+def test_to_bracket_equals_nltk_kbest(grammer, sentences):
+    for sentence in sentences[:5]:
+        check_trees(tree for tree, _ in PCYK_kbest(sentence, grammer, None, k=5))
+
+def test_to_bracket_equals_nltk_fallback(grammer, sentences):
+    # a tiny work budget stops the parses early, their trees are built by fallback_tree()
+    check_trees(PCYK_vectorized(sentence, grammer, None, max_work=10)[0] for sentence in sentences)
@@ -0,0 +1,49 @@
+#####################################################################################################################
+# This python file tests scorer.py against the output of evalb on the sample files of EVALB/sample.                 #
+#####################################################################################################################
+
+import os
+from conftest import ROOT
+from scorer import format_results, read_parameters, score_files
+
+SAMPLE = os.path.join(ROOT, 'EVALB', 'sample')
+
+def read_report(lines):
+    '''
+    Split a report of evalb in its sentence rows and its summary values
+    ----
+    Input:
+        lines: the lines of the report
+    Return:
+        the list of the columns of each sentence row, and the dict {(section, name): value} of the summary lines
+    '''
+    rows, summary, section = [], {}, None
+    for line in lines:
+        if line.startswith('-- '):
+            section = line.strip('- ')
+        elif section is not None and '=' in line:
+            name, value = line.split('=')
+            summary[(section, name.strip())] = float(value)
+        elif section is None and line[:4].strip().isdigit():
+            rows.append(line.split())
+    return rows, summary
+
+def test_scorer_equals_evalb_sample():
+    params = read_parameters(os.path.join(SAMPLE, 'sample.prm'))
+    report = format_results(*score_files(os.path.join(SAMPLE, 'sample.gld'), os.path.join(SAMPLE, 'sample.tst'),
+                                         params))
+    rows, summary = read_report(report.split('\n'))
+    with open(os.path.join(SAMPLE, 'sample.rsl')) as f:
+        expected_rows, expected_summary = read_report(f.read().split('\n'))
+
+    assert len(rows) == len(expected_rows)
+    for row, expected in zip(rows, expected_rows):
+        # sample.rsl comes from an older evalb which printed the length as the number of words of the error and skip
+        # sentences; evalb.c (and scorer.py) print 0 words for them, so only their id, length and status are compared
+        assert row[:3] == expected[:3]
+        if expected[2] == '0':
+            assert row == expected
+    # sample.rsl has no FMeasure line, every other summary value must be equal
+    assert len(expected_summary) > 0
+    for key, value in expected_summary.items():
+        assert summary[key] == value, key
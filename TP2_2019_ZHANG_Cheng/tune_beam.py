@@ -0,0 +1,85 @@
+###########################################################################################################################
+# This python file compares the beam widths of the vectorized CYK engine, by the parse time and the F1 score with EVALB. #
+###########################################################################################################################
+
+import math
+import sys
+import time
+from main import build_models, to_bracket
+from parser import PCYK_vectorized, resolve_word
+from scorer import read_parameters, score_trees
+
+# The beams to compare, the first one is the exhaustive search used as the reference
+BEAMS = [{}, {'beam_size': 200}, {'beam_size': 100}, {'beam_size': 50}, {'beam_size': 20}, {'beam_size': 10},
+         {'beam_threshold': 20.}, {'beam_threshold': 15.}, {'beam_threshold': 10.},
+         {'coarse_threshold': 1e-6}, {'coarse_threshold': 1e-4}, {'coarse_threshold': 1e-3}]
+
+class MemoOoV(object):
+    '''Wrap the OoV module to resolve each unseen word only once, so that all beams are timed on the same work.
+    '''
+    def __init__(self, oov):
+        self.oov = oov
+        self.memo = {}
+
+    def assign_similar_token(self, word, prev_word, next_word, probe=None):
+        key = (word, prev_word, next_word)
+        if key not in self.memo:
+            self.memo[key] = self.oov.assign_similar_token(word, prev_word, next_word, probe=probe)
+        return self.memo[key]
+
+def beam_name(beam):
+    '''Get a readable name of a beam setting'''
+    if len(beam) == 0:
+        return 'exhaustive'
+    return ', '.join(key + '=' + str(value) for key, value in beam.items())
+
+def tune_beam(dev_file='./data/dev', dev_res='./data/dev_res', prm_file='./EVALB/sample/sample.prm'):
+    '''Parse the validation set with each beam of BEAMS, and print the parse time and the F1 change against the exhaustive search
+    -------------------------------------
+        Input:
+            dev_file: the path to the validation sentences
+            dev_res: the path to the validation gold trees
+            prm_file: the path to the parameter file of evalb
+    -------------------------------------
+        Do not return anything, but prints the results and writes the parsed trees to dev_file + '.beam<i>'
+    '''
+    grammer, oov = build_models()
+    params = read_parameters(prm_file)
+    gold_trees = open(dev_res, 'r').read().splitlines()
+    oov = MemoOoV(oov)
+    sentences = [line.strip() for line in open(dev_file, 'r').read().splitlines()]
+    # resolve the unseen words before timing
+    for sent in sentences:
+        words = sent.split(' ')
+        for j in range(1, len(words) + 1):
+            resolve_word(words, j, grammer.token_tags_dict, oov)
+
+    reference = None
+    print('{:<24} {:>10} {:>12} {:>8} {:>8}'.format('beam', 'time (s)', 's/sentence', 'F1', 'dF1'))
+    for i, beam in enumerate(BEAMS):
+        output_file = dev_file + '.beam' + str(i)
+        start = time.time()
+        results = [PCYK_vectorized(sent, grammer, oov, **beam)[0] for sent in sentences]
+        elapsed = time.time() - start
+        trees = [to_bracket(s) for s in results]
+        with open(output_file, 'w') as pred:
+            for tree in trees:
+                pred.write(tree + '\n')
+        f1 = score_trees(gold_trees, trees, params)[1]['fmeasure']
+        if reference is None:
+            reference = f1
+        if math.isnan(f1) or math.isnan(reference):
+            f1, delta = 'n/a', 'n/a'
+        else:
+            f1, delta = '{:.2f}'.format(f1), '{:+.2f}'.format(f1 - reference)
+        print('{:<24} {:>10.1f} {:>12.3f} {:>8} {:>8}'.format(beam_name(beam), elapsed, elapsed / len(sentences), f1, delta))
+
+
+if __name__ == "__main__":
+    args = sys.argv
+    if len(args) != 1 and len(args) != 4:
+        print("Error: do not have correct number of arguments (expected 0 or 3)!")
+    if len(args) == 1:
+        tune_beam()
+    if len(args) == 4:
+        tune_beam(args[1], args[2], args[3])
@@ -0,0 +1,89 @@
+#####################################################################################################################
+# This python file compares the build settings of the grammar (markovization and rule pruning), by the size of the #
+# grammar, the parse time with the vectorized CYK engine and the F1 score with EVALB.                               #
+#####################################################################################################################
+
+import math
+import sys
+import time
+from Grammer import Grammer
+from main import build_models, pop_option, to_bracket
+from parser import PCYK_vectorized, resolve_word
+from scorer import read_parameters, score_trees
+from tune_beam import MemoOoV
+
+# The settings to compare, the first one is the full grammar used as the reference
+SETTINGS = [{}, {'min_count': 2}, {'min_count': 3}, {'min_count': 5}, {'top_n': 50}, {'top_n': 20}, {'top_n': 10},
+            {'horz_markov': 2}, {'horz_markov': 1}, {'horz_markov': 2, 'vert_markov': 1},
+            {'horz_markov': 2, 'min_count': 2}, {'horz_markov': 1, 'min_count': 2, 'top_n': 20}]
+
+def setting_name(setting):
+    '''Get a readable name of a grammar setting'''
+    if len(setting) == 0:
+        return 'full'
+    return ', '.join(key + '=' + str(value) for key, value in setting.items())
+
+def flat_tree(sentence):
+    '''Get a flat tree '( (SENT (X word) ...))' for a sentence without parse, so that it is scored with a low recall instead of being skipped'''
+    return '( (SENT ' + ' '.join('(X ' + word + ')' for word in sentence.split(' ')) + '))'
+
+def tune_grammar(dev_file='./data/dev', dev_res='./data/dev_res', prm_file='./EVALB/sample/sample.prm', train_file='./data/train', limit=None):
+    '''Build the grammar with each setting of SETTINGS, parse the validation set with it, and print the size of the grammar,
+        the build and parse times, the number of sentences without parse and the F1 change against the full grammar.
+        The sentences without parse are scored as flat trees, so that the F1 of all the settings are computed on the same sentences.
+    -------------------------------------
+        Input:
+            dev_file: the path to the validation sentences
+            dev_res: the path to the validation gold trees
+            prm_file: the path to the parameter file of evalb
+            train_file: the path to the training file
+            limit: the number of validation sentences to parse, None for all of them
+    -------------------------------------
+        Do not return anything, but prints the results
+    '''
+    # the settings do not change the lexicon, so the OoV module and the resolution of the unseen words are shared
+    grammer, oov = build_models(train_file)
+    params = read_parameters(prm_file)
+    gold_trees = open(dev_res, 'r').read().splitlines()[:limit]
+    oov = MemoOoV(oov)
+    sentences = [line.strip() for line in open(dev_file, 'r').read().splitlines()][:limit]
+    for sent in sentences:
+        words = sent.split(' ')
+        for j in range(1, len(words) + 1):
+            resolve_word(words, j, grammer.token_tags_dict, oov)
+
+    reference = None
+    print('{:<36} {:>6} {:>7} {:>6} {:>9} {:>9} {:>8} {:>8} {:>8}'.format(
+        'setting', 'tags', 'binary', 'unary', 'build (s)', 'parse (s)', 'no parse', 'F1', 'dF1'))
+    for setting in SETTINGS:
+        grammer = Grammer(**setting)
+        start = time.time()
+        grammer.create_pcfg(train_file)
+        build = time.time() - start
+
+        start = time.time()
+        results = [PCYK_vectorized(sent, grammer, oov) for sent in sentences]
+        elapsed = time.time() - start
+        trees = [to_bracket(s) if p > 0 else flat_tree(sent) for sent, (s, p) in zip(sentences, results)]
+        failures = sum(1 for _, p in results if p == 0)
+        f1 = score_trees(gold_trees, trees, params)[1]['fmeasure']
+        if reference is None:
+            reference = f1
+        if math.isnan(f1) or math.isnan(reference):
+            f1, delta = 'n/a', 'n/a'
+        else:
+            f1, delta = '{:.2f}'.format(f1), '{:+.2f}'.format(f1 - reference)
+        print('{:<36} {:>6} {:>7} {:>6} {:>9.1f} {:>9.1f} {:>8} {:>8} {:>8}'.format(
+            setting_name(setting), len(grammer.tags), len(grammer.binary_parent), len(grammer.unary_parent), build, elapsed, failures, f1, delta))
+
+
+if __name__ == "__main__":
+    args = list(sys.argv)
+    limit = pop_option(args, '--limit', None)
+    limit = int(limit) if limit is not None else None
+    if len(args) != 1 and len(args) != 4:
+        print("Error: do not have correct number of arguments (expected 0 or 3)!")
+    if len(args) == 1:
+        tune_grammar(limit=limit)
+    if len(args) == 4:
+        tune_grammar(args[1], args[2], args[3], limit=limit)
@@ -0,0 +1,50 @@
+#################################################################################################################################
+# This python file adds newly annotated trees to the compiled grammar and to the OOV artifacts, without retraining from scratch. #
+#################################################################################################################################
+
+import os
+import sys
+import time
+from Grammer import Grammer
+from main import build_models
+
+def update_grammar(tree_files, sent_files, train_file_path='./data/train', train_sent_file='./data/train_sent'):
+    '''Add treebank files to the grammar compiled from the training file, and update the cached token matrix
+    -------------------------------------
+        Input:
+            tree_files: the paths to the new treebank files, one tree per line
+            sent_files: the paths to the sentences of the new trees, to give to main.py with '--extra-sents'
+            train_file_path: the path to the training file, its compiled grammar is train_file_path + '.grammar'
+            train_sent_file: the path to the training sentence file
+    -------------------------------------
+        Do not return anything, but rewrites train_file_path + '.grammar' and train_file_path + '.embedding.npz'
+    '''
+    # the grammar keeps the build settings it was compiled with
+    grammar_settings = None
+    if os.path.exists(train_file_path + '.grammar'):
+        header, _ = Grammer.read_header(train_file_path + '.grammar')
+        if header is not None:
+            grammar_settings = header.get('settings')
+    grammer, oov = build_models(train_file_path, train_sent_file, grammar_settings=grammar_settings)
+    start = time.time()
+    n_tags, n_rules = len(grammer.tags), len(grammer.lhs_rhs_count)
+    new_tokens = []
+    for tree_file in tree_files:
+        new_tokens += grammer.update_pcfg(tree_file)
+    grammer.save(train_file_path + '.grammar')
+    for sent_file in sent_files:
+        oov.update_bigram(sent_file)
+    oov.update_tokens()
+    oov.save_token_matrix(train_file_path + '.embedding.npz')
+    print('{} new tags, {} new rules, {} new tokens in {:.2f} s'.format(
+        len(grammer.tags) - n_tags, len(grammer.lhs_rhs_count) - n_rules, len(new_tokens), time.time() - start))
+
+
+if __name__ == "__main__":
+    args = sys.argv
+    if len(args) != 3 and len(args) != 5:
+        print("Error: do not have correct number of arguments (expected 2 or 4)!")
+    if len(args) == 3:
+        update_grammar(args[1].split(','), args[2].split(','))
+    if len(args) == 5:
+        update_grammar(args[1].split(','), args[2].split(','), args[3], args[4])